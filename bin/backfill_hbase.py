@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Backfill the HBase science table from the science Parquet archive.
+
+Instead of writing Puts to the region servers, alerts are written into
+HFiles, sorted and partitioned to match the regions of the table, which
+are then bulk loaded (moved) into the table. The table must exist, and
+should be pre-split for large backfills.
+
+The rowkey is given by `science_db_rowkey` (candid by default), and can be
+composite and salted (`science_db_salt_buckets`). If `science_db_regions`
+is greater than 1, a missing table is created pre-split from a sample of
+the rowkeys.
+
+The HBase catalog is read from `science_db_catalog` if the file exists.
+Otherwise it is built from the schema of the flattened alerts, with the
+history and the cutouts in their own column families, and arrays encoded in
+Avro, and saved there.
+"""
+import argparse
+import time
+
+from fink_broker.parser import getargs
+from fink_broker.sparkUtils import init_sparksession, get_hadoop_path
+from fink_broker.hbaseUtils import science_table_df, science_table_catalog
+from fink_broker.hbaseUtils import encode_for_catalog
+from fink_broker.hbaseUtils import write_hfiles, bulk_load_hfiles
+from fink_broker.hbaseUtils import compute_split_keys, create_presplit_table
+from fink_broker.loggingUtils import get_fink_logger, inspect_application
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = getargs(parser)
+
+    # Initialise Spark session
+    spark = init_sparksession(
+        name="backfill_hbase", profile=args.spark_profile,
+        input_rate=args.input_rate, tinterval=args.tinterval)
+
+    # The level here should be controlled by an argument.
+    logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
+
+    # debug statements
+    inspect_application(logger)
+
+    # Flatten the alerts, with one typed array per field of the history.
+    # The rowkey can be composite (nested fields are allowed) and salted.
+    df, rowkey = science_table_df(
+        spark.read.parquet(args.scitmpdatapath),
+        args.science_db_rowkey.split(","), args.science_db_salt_buckets)
+
+    catalog = science_table_catalog(
+        df, args.science_db_catalog, args.science_db_name, rowkey)
+
+    # Arrays are stored in Avro, or as strings with older catalogs
+    df = encode_for_catalog(df, catalog)
+
+    # Regions of a new table follow the distribution of the (string)
+    # rowkeys
+    if args.science_db_regions > 1 and rowkey != args.science_db_rowkey:
+        create_presplit_table(
+            catalog, compute_split_keys(
+                df, args.science_db_regions,
+                args.science_db_salt_buckets, rowkey))
+    elif args.science_db_regions > 1:
+        logger.warning(
+            "The table is not pre-split: {} is not a composite or salted "
+            "rowkey".format(rowkey))
+
+    # HFiles from a previous run are replaced
+    jpath, fs = get_hadoop_path(args.hfilepath)
+    if fs.exists(jpath):
+        fs.delete(jpath, True)
+
+    start = time.time()
+    ncells = write_hfiles(df, catalog, args.hfilepath)
+    logger.info("{} cells written in {:.1f} seconds in {}".format(
+        ncells, time.time() - start, args.hfilepath))
+
+    if args.bulkload == 'true':
+        start = time.time()
+        bulk_load_hfiles(
+            args.hfilepath, "default:{}".format(args.science_db_name))
+        logger.info("HFiles loaded in {:.1f} seconds".format(
+            time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
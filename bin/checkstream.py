@@ -30,7 +30,9 @@ def main():
     args = getargs(parser)
 
     # Initialise Spark session
-    spark = init_sparksession(name="checkstream", shuffle_partitions=2)
+    spark = init_sparksession(
+        name="checkstream", profile=args.spark_profile,
+        input_rate=args.input_rate, tinterval=args.tinterval)
 
     # The level here should be controlled by an argument.
     logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
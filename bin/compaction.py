@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compact the small files of the raw and science databases.
+
+Closed hourly partitions older than `maxfileage` are periodically rewritten
+into a few large files, and swapped in the sink logs atomically. Optionally,
+duplicated alerts (same candid) are dropped. The number of files, bytes and
+rows before and after is reported for each database. Optionally, the
+objectId/candid index of each database is then updated. The segments of the
+light-curve store, if any, are merged as well.
+"""
+import argparse
+import time
+
+from fink_broker.parser import getargs
+from fink_broker.sparkUtils import init_sparksession
+from fink_broker.compactionUtils import compact_database
+from fink_broker.indexUtils import update_index
+from fink_broker.lightcurveUtils import compact_lightcurves
+from fink_broker.loggingUtils import get_fink_logger, inspect_application
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = getargs(parser)
+
+    # Initialise Spark session
+    spark = init_sparksession(
+        name="compaction", profile=args.spark_profile,
+        input_rate=args.input_rate, tinterval=args.tinterval)
+
+    # The level here should be controlled by an argument.
+    logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
+
+    # debug statements
+    inspect_application(logger)
+
+    # Streaming readers must not see compacted files as new files:
+    # only partitions older than their maxFileAge are compacted.
+    maxfileage = args.maxfileage if args.maxfileage > 0 else 7 * 24
+    minage = maxfileage + 1
+    dedupkey = 'candid' if args.compaction_dedup == 'true' else None
+
+    start = time.time()
+    while True:
+        for path in [args.rawdatapath, args.scitmpdatapath]:
+            if path == '':
+                continue
+            report = compact_database(
+                path, target_size=args.compaction_target_size * 1024**2,
+                minage=minage, dedupkey=dedupkey)
+            logger.info(
+                "{}: {} partitions compacted ({} skipped), "
+                "{} files ({} bytes) -> {} files ({} bytes)".format(
+                    path, report["partitions"], report["skipped"],
+                    report["files_before"], report["bytes_before"],
+                    report["files_after"], report["bytes_after"]))
+            logger.info(
+                "{}: {} previous swaps confirmed, {} reverted".format(
+                    path, report["confirmed"], report["reverted"]))
+            if dedupkey is not None:
+                duplicates = report["rows_before"] - report["rows_after"]
+                logger.info("{}: {} duplicates dropped ({:.2%})".format(
+                    path, duplicates,
+                    duplicates / max(report["rows_before"], 1)))
+
+            # Index the new files, drop the compacted ones, and merge
+            # the segments of the index
+            if args.archive_index == 'true':
+                report = update_index(path, merge=True)
+                logger.info(
+                    "{}: index updated ({} files added, {} removed)".format(
+                        path, report["added"], report["removed"]))
+
+        # Merge the segments of the light-curve store
+        if args.lightcurvedatapath != '':
+            report = compact_lightcurves(args.lightcurvedatapath)
+            logger.info("{}: {} files -> {} files".format(
+                args.lightcurvedatapath, report["files_before"],
+                report["files_after"]))
+
+        elapsed = time.time() - start
+        if args.exit_after is not None and elapsed > args.exit_after:
+            logger.info("Exiting the compaction service normally...")
+            break
+        time.sleep(args.compaction_interval)
+
+
+if __name__ == "__main__":
+    main()
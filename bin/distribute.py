@@ -21,14 +21,26 @@
 3. Serialize into Avro
 3. Publish to Kafka Topic(s)
 """
-from pyspark.sql.functions import lit
+from pyspark.sql.functions import lit, col
 
 import argparse
+import json
+import os
 import time
 
 from fink_broker.parser import getargs
 from fink_broker.sparkUtils import init_sparksession, connect_to_raw_database
+from fink_broker.sparkUtils import get_resume_starttime
 from fink_broker.distributionUtils import get_kafka_df
+from fink_broker.distributionUtils import get_distribution_offset
+from fink_broker.distributionUtils import commit_offsets
+from fink_broker.distributionUtils import get_passthrough_kafka_df
+from fink_broker.distributionUtils import update_status_in_hbase
+from fink_broker.schemaRegistry import build_registry, FileSchemaRegistry
+from fink_broker.schemaRegistry import PAYLOAD_COLUMN, PAYLOAD_VERSION_COLUMN
+from fink_broker.cutoutUtils import has_cutouts, fetch_cutouts
+from fink_broker.detectionUtils import fetch_prv_candidates, PRV_START_COLUMN
+from fink_broker.spatialUtils import SKYINDEX_COLUMN
 from fink_broker.filters import apply_user_defined_filter
 from fink_broker.loggingUtils import get_fink_logger, inspect_application
 
@@ -37,12 +49,34 @@ userfilters = [
     'fink_filters.filter_rrlyr.filter.rrlyr'
 ]
 
+def wrap_alert_data(df):
+    """ Cast fields of the alerts to ease the distribution """
+    cnames = df.columns
+    cnames[cnames.index('timestamp')] = 'cast(timestamp as string) as timestamp'
+    cnames[cnames.index('cutoutScience')] = 'struct(cutoutScience.*) as cutoutScience'
+    cnames[cnames.index('cutoutTemplate')] = 'struct(cutoutTemplate.*) as cutoutTemplate'
+    cnames[cnames.index('cutoutDifference')] = 'struct(cutoutDifference.*) as cutoutDifference'
+    cnames[cnames.index('prv_candidates')] = 'explode(array(prv_candidates)) as prv_candidates'
+    cnames[cnames.index('candidate')] = 'struct(candidate.*) as candidate'
+    return df.selectExpr(cnames)
+
+def save_passthrough_schema(schema: dict, path: str, version: str):
+    """ Save the schema of the alerts distributed in pass-through mode,
+    next to the distribution schema (local file system only).
+    """
+    root, ext = os.path.splitext(path)
+    fn = "{}_{}{}".format(root, version, ext or ".avsc")
+    with open(fn, 'w') as f:
+        json.dump(schema, f, indent=2)
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     args = getargs(parser)
 
     # Initialise Spark session
-    spark = init_sparksession(name="distribute", shuffle_partitions=2)
+    spark = init_sparksession(
+        name="distribute", profile=args.spark_profile,
+        input_rate=args.input_rate, tinterval=args.tinterval)
 
     # The level here should be controlled by an argument.
     logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
@@ -50,28 +84,61 @@ def main():
     # debug statements
     inspect_application(logger)
 
-    # Connect to the TMP science database
+    # Connect to the TMP science database. Only the partitions
+    # after the last distributed alert (or in the resume window) are read.
+    starttime = get_resume_starttime(
+        args.resume_window,
+        get_distribution_offset(
+            args.checkpointpath_dist, args.startingOffset_dist))
+    logger.info("Resume distribution from: {}".format(starttime))
     df = connect_to_raw_database(
-        args.scitmpdatapath, args.scitmpdatapath + "/*", latestfirst=False)
-
-    # Drop partitioning columns
-    df = df.drop('year').drop('month').drop('day').drop('hour')
+        args.scitmpdatapath, args.scitmpdatapath, latestfirst=False,
+        starttime=starttime, maxfileage=args.maxfileage)
+
+    # Pass-through mode: the original Avro data kept by stream2raw is
+    # published as is, followed by the Fink fields.
+    passthrough = args.keep_avro_payload == 'true' and \
+        PAYLOAD_COLUMN in df.columns
+    if passthrough:
+        registry = build_registry(args.schema, args.schema_topics)
+        alertfields = [f["name"] for f in registry.reader_schema["fields"]]
+        internals = [
+            'topic', 'status', PAYLOAD_COLUMN, PAYLOAD_VERSION_COLUMN,
+            PRV_START_COLUMN]
+    else:
+        df = df.drop(PAYLOAD_COLUMN, PAYLOAD_VERSION_COLUMN)
+
+    # Cutouts and previous detections stored separately are fetched for
+    # the distributed alerts only. Partitioning columns are needed to
+    # locate the cutouts in the cutout store.
+    fetch = not has_cutouts(df) and args.cutoutdatapath != '' \
+        and not passthrough
+    fetch_prv = PRV_START_COLUMN in df.columns and \
+        args.detectiondatapath != '' and not passthrough
+    partitions = ['year', 'month', 'day', 'hour']
+
+    # Drop partitioning columns, and the internal sky index
+    if not fetch:
+        df = df.drop(*partitions)
+    df = df.drop(SKYINDEX_COLUMN)
 
     # Switch publisher
     df = df.withColumn('publisher-tmp', lit('Fink')) \
         .drop('publisher') \
         .withColumnRenamed('publisher-tmp', 'publisher')
 
-    # Cast fields to ease the distribution
-    cnames = df.columns
-    cnames[cnames.index('timestamp')] = 'cast(timestamp as string) as timestamp'
-    cnames[cnames.index('cutoutScience')] = 'struct(cutoutScience.*) as cutoutScience'
-    cnames[cnames.index('cutoutTemplate')] = 'struct(cutoutTemplate.*) as cutoutTemplate'
-    cnames[cnames.index('cutoutDifference')] = 'struct(cutoutDifference.*) as cutoutDifference'
-    cnames[cnames.index('prv_candidates')] = 'explode(array(prv_candidates)) as prv_candidates'
-    cnames[cnames.index('candidate')] = 'struct(candidate.*) as candidate'
-
     broker_list = args.distribution_servers
+    kafka_options = {
+        "kafka.bootstrap.servers": broker_list,
+        "kafka.security.protocol": "SASL_PLAINTEXT",
+        "kafka.sasl.mechanism": "SCRAM-SHA-512"}
+
+    # Distribution schemas are registered, and messages framed with
+    # the ID of their schema (see get_kafka_df)
+    dist_registry = None
+    if args.distribution_registry != '':
+        dist_registry = FileSchemaRegistry(args.distribution_registry)
+
     for userfilter in userfilters:
         # The topic name is the filter name
         topicname = userfilter.split('.')[-1]
@@ -79,25 +146,87 @@ def main():
         # Apply user-defined filter
         df_tmp = apply_user_defined_filter(df, userfilter)
 
-        # Wrap alert data
-        df_tmp = df_tmp.selectExpr(cnames)
-
-        # Get the DataFrame for publishing to Kafka (avro serialized)
-        df_kafka = get_kafka_df(df_tmp, '')
-
-        # Ensure that the topic(s) exist on the Kafka Server)
-        disquery = df_kafka\
+        finkcols = None
+        if passthrough:
+            # Fink fields: the columns added to the original alerts
+            finkcols = [
+                c for c in df_tmp.columns
+                if c not in alertfields + internals + ['timestamp']]
+            finkcols = [
+                col('timestamp').cast('string').alias('timestamp'),
+                lit('Fink').alias('publisher')] + finkcols
+            _, schemas = get_passthrough_kafka_df(df_tmp, registry, finkcols)
+            for version, schema in schemas.items():
+                logger.info("Distribution schema for alerts {}: {}".format(
+                    version, json.dumps(schema)))
+                if args.distribution_schema != '':
+                    save_passthrough_schema(
+                        schema, args.distribution_schema, version)
+
+        def publish(
+                batchdf, batchid, topicname=topicname, finkcols=finkcols):
+            """ Serialise the filtered alerts (attaching cutouts and
+            previous detections if needed), publish, and commit the
+            distributed offset of the topic
+            """
+            last = batchdf.agg({'timestamp': 'max'}).first()[0]
+            if last is None:
+                return
+            if passthrough:
+                df_kafka, _ = get_passthrough_kafka_df(
+                    batchdf, registry, finkcols)
+            else:
+                if fetch:
+                    batchdf = fetch_cutouts(batchdf, args.cutoutdatapath)\
+                        .drop(*partitions)
+                if fetch_prv:
+                    batchdf = fetch_prv_candidates(
+                        batchdf, args.detectiondatapath)
+                df_kafka = get_kafka_df(
+                    wrap_alert_data(batchdf), args.distribution_schema,
+                    saveschema=args.distribution_schema != '',
+                    registry=dist_registry,
+                    subject="{}-value".format(topicname))
+            df_kafka\
+                .write\
+                .format("kafka")\
+                .options(**kafka_options)\
+                .option("topic", topicname)\
+                .save()
+            if args.checkpointpath_dist != '':
+                commit_offsets(
+                    args.checkpointpath_dist,
+                    {topicname: int(last.timestamp() * 1000)})
+
+        disquery = df_tmp\
             .writeStream\
-            .format("kafka")\
-            .option("kafka.bootstrap.servers", broker_list)\
-            .option("kafka.security.protocol", "SASL_PLAINTEXT")\
-            .option("kafka.sasl.mechanism", "SCRAM-SHA-512")\
-            .option("topic", topicname)\
+            .foreachBatch(publish)\
             .option("checkpointLocation", args.checkpointpath_kafka)\
             .start()
 
+    # Mark the distributed alerts in the HBase science table, from the
+    # offsets committed by publish. Only the rows written to HBase since
+    # the previous update are scanned (see update_status_in_hbase).
+    update_status = args.hbase_stream == 'true' and \
+        args.checkpointpath_dist != '' and \
+        os.path.exists(args.science_db_catalog)
+    if update_status:
+        with open(args.science_db_catalog) as f:
+            hbcatalog = f.read()
+        deadline = None
+        if args.exit_after is not None:
+            deadline = time.time() + args.exit_after
+        while not disquery.awaitTermination(max(args.tinterval, 1)):
+            batch = update_status_in_hbase(
+                hbcatalog, args.checkpointpath_dist)
+            if batch is not None:
+                logger.info("Status of the distributed alerts updated")
+            if deadline is not None and time.time() >= deadline:
+                disquery.stop()
+                logger.info("Exiting the distribute service normally...")
+                break
     # Keep the Streaming running until something or someone ends it!
-    if args.exit_after is not None:
+    elif args.exit_after is not None:
         time.sleep(args.exit_after)
         disquery.stop()
         logger.info("Exiting the distribute service normally...")
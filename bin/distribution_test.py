@@ -38,7 +38,9 @@ def main():
     args = getargs(parser)
 
     # Initialise Spark session
-    spark = init_sparksession(name="distribution_test", shuffle_partitions=2)
+    spark = init_sparksession(
+        name="distribution_test", profile=args.spark_profile,
+        input_rate=args.input_rate, tinterval=args.tinterval)
 
     # The level here should be controlled by an argument.
     logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
@@ -60,8 +62,13 @@ def main():
         .option("subscribe", topic) \
         .load()
 
-    # Decode df_kafka into a Spark DataFrame with StructType column
-    df = decode_kafka_df(df_kafka, args.distribution_schema)
+    # Decode df_kafka into a Spark DataFrame with StructType column.
+    # Messages framed with a schema ID are decoded using the registry.
+    if args.distribution_registry != '':
+        df = decode_kafka_df(
+            df_kafka, args.distribution_registry, "{}-value".format(topic))
+    else:
+        df = decode_kafka_df(df_kafka, args.distribution_schema)
 
     # Print received stream to the console
     df = df.select("struct.*")
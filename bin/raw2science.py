@@ -18,7 +18,8 @@
 Step 1: Connect to the raw database
 Step 2: Filter alerts based on instrumental or environmental criteria.
 Step 3: Run processors (aka science modules) on alerts to generate added value.
-Step 4: Push alert data into the tmp science database (parquet)
+Step 4: Push alert data into the tmp science database (parquet), and
+optionally into the HBase science table
 
 See http://cdsxmatch.u-strasbg.fr/ for more information on the SIMBAD catalog.
 """
@@ -33,8 +34,18 @@ import json
 from fink_broker.parser import getargs
 from fink_broker.sparkUtils import init_sparksession
 from fink_broker.sparkUtils import connect_to_raw_database
+from fink_broker.sparkUtils import get_resume_starttime
+from fink_broker.sparkUtils import get_hadoop_path
 from fink_broker.filters import apply_user_defined_filter
 from fink_broker.filters import apply_user_defined_processors
+from fink_broker.lightcurveUtils import append_lightcurves
+from fink_broker.lightcurveUtils import add_lightcurve_columns
+from fink_broker.lightcurveUtils import requested_lightcurve_fields
+from fink_broker.lightcurveUtils import LIGHTCURVE_PREFIX
+from fink_broker.summaryUtils import new_object_column
+from fink_broker.summaryUtils import update_object_summary
+from fink_broker.hbaseUtils import science_table_df, science_table_catalog
+from fink_broker.hbaseUtils import encode_for_catalog, hbase_stream_writer
 from fink_broker.loggingUtils import get_fink_logger, inspect_application
 
 qualitycuts = 'fink_broker.filters.qualitycuts'
@@ -48,7 +59,9 @@ def main():
     args = getargs(parser)
 
     # Initialise Spark session
-    spark = init_sparksession(name="raw2science", shuffle_partitions=2)
+    spark = init_sparksession(
+        name="raw2science", profile=args.spark_profile,
+        input_rate=args.input_rate, tinterval=args.tinterval)
 
     # Logger to print useful debug statements
     logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
@@ -56,16 +69,45 @@ def main():
     # debug statements
     inspect_application(logger)
 
+    starttime = get_resume_starttime(args.resume_window)
     df = connect_to_raw_database(
-        args.rawdatapath, args.rawdatapath + "/*", latestfirst=False)
+        args.rawdatapath, args.rawdatapath, latestfirst=False,
+        starttime=starttime, maxfileage=args.maxfileage)
+
+    # Update the light-curve store with the detections of new alerts
+    queries = []
+    if args.lightcurvedatapath != '':
+        lcquery = df\
+            .writeStream\
+            .foreachBatch(
+                lambda batchdf, batchid:
+                    append_lightcurves(batchdf, args.lightcurvedatapath))\
+            .option("checkpointLocation", args.checkpointpath_lightcurves)\
+            .start()
+        queries.append(lcquery)
 
     # Apply level one filters
     logger.info(qualitycuts)
     df = apply_user_defined_filter(df, qualitycuts)
 
+    # Flag the alerts of objects never seen before (Bloom filter). The
+    # filter is updated by the summary query below, so the flag lags: the
+    # alerts of an object in the same micro-batch, or before the summary
+    # catches up, are all flagged new.
+    if args.objectsummarypath != '':
+        df = df.withColumn(
+            "new_object", new_object_column(args.objectsummarypath))
+
+    # Full light curves requested by processors (arguments named lc_*)
+    fields = requested_lightcurve_fields(processors)
+    if len(fields) > 0 and args.lightcurvedatapath != '':
+        logger.info("Light-curve fields requested: {}".format(fields))
+        df = add_lightcurve_columns(df, args.lightcurvedatapath, fields)
+
     # Apply level one processors
     logger.info(processors)
     df = apply_user_defined_processors(df, processors)
+    df = df.drop(*[LIGHTCURVE_PREFIX + field for field in fields])
 
     # Partition the data hourly
     df_partitionedby = df\
@@ -83,11 +125,49 @@ def main():
         .option("path", args.scitmpdatapath)\
         .partitionBy("year", "month", "day", "hour") \
         .start()
+    queries.append(countquery)
+
+    # The queries below read the alerts committed in the tmp science
+    # database, such that the processors are only applied once.
+    if args.objectsummarypath != '' or args.hbase_stream == 'true':
+        jpath, fs = get_hadoop_path(args.scitmpdatapath)
+        if not fs.exists(jpath):
+            fs.mkdirs(jpath)
+        df_scitmp = spark\
+            .readStream\
+            .schema(df_partitionedby.schema)\
+            .parquet(args.scitmpdatapath)
+
+    # Update the summary of objects, such that the classes given by the
+    # processors are known.
+    if args.objectsummarypath != '':
+        summaryquery = df_scitmp\
+            .writeStream\
+            .foreachBatch(
+                lambda batchdf, batchid:
+                    update_object_summary(
+                        batchdf, args.objectsummarypath, batchid))\
+            .option("checkpointLocation", args.checkpointpath_objects)\
+            .start()
+        queries.append(summaryquery)
+
+    # Write the alerts into the HBase science table, with batched Puts
+    if args.hbase_stream == 'true':
+        df_hbase, rowkey = science_table_df(
+            df_scitmp, args.science_db_rowkey.split(","),
+            args.science_db_salt_buckets)
+        catalog = science_table_catalog(
+            df_hbase, args.science_db_catalog, args.science_db_name, rowkey)
+        hbasequery = hbase_stream_writer(
+            encode_for_catalog(df_hbase, catalog), catalog,
+            args.checkpointpath_sci).start()
+        queries.append(hbasequery)
 
     # Keep the Streaming running until something or someone ends it!
     if args.exit_after is not None:
         time.sleep(args.exit_after)
-        countquery.stop()
+        for query in queries:
+            query.stop()
         logger.info("Exiting the raw2science service normally...")
     else:
         # Wait for the end of queries
@@ -29,49 +29,140 @@ from pyspark.sql import SparkSession
 from pyspark.sql.functions import date_format
 
 import argparse
+import json
 import time
+import os
 
 from fink_broker.parser import getargs
 
-from fink_broker.sparkUtils import from_avro
 from fink_broker.sparkUtils import init_sparksession, connect_to_kafka
-from fink_broker.sparkUtils import get_schemas_from_avro
+from fink_broker.sparkUtils import deduplicate_alerts, append_to_file_sink
+from fink_broker.sparkUtils import connect_to_avro_files
+from fink_broker.schemaRegistry import build_registry
+from fink_broker.schemaRegistry import PAYLOAD_COLUMN, PAYLOAD_VERSION_COLUMN
+from fink_broker.cutoutUtils import split_cutouts, CUTOUT_PARTITIONS
+from fink_broker.detectionUtils import split_detections
+from fink_broker.detectionUtils import append_new_detections
+from fink_broker.spatialUtils import add_skyindex
+from fink_broker.monitoring import IngestionRateController
+from fink_broker.monitoring import duplicates_from_progress
 from fink_broker.loggingUtils import get_fink_logger, inspect_application
 
-def main():
-    parser = argparse.ArgumentParser(description=__doc__)
-    args = getargs(parser)
-
-    # Initialise Spark session
-    spark = init_sparksession(name="stream2raw", shuffle_partitions=2)
-
-    # The level here should be controlled by an argument.
-    logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
+def decode_kafka_stream(args, registry, maxoffsetspertrigger: int):
+    """ Decoded stream of alerts from Kafka.
 
-    # debug statements
-    inspect_application(logger)
+    Parameters
+    ----------
+    args: argparse.Namespace
+        Arguments of the service.
+    registry: AlertSchemaRegistry
+        Schema(s) to decode the alerts.
+    maxoffsetspertrigger: int
+        Maximum number of alerts per micro-batch. None or 0 means no limit.
 
+    Returns
+    ----------
+    df: Streaming DataFrame
+        timestamp, topic, (payload), and the alert fields.
+    """
     # Create a streaming dataframe pointing to a Kafka stream
     df = connect_to_kafka(
         servers=args.servers, topic=args.topic,
-        startingoffsets=args.startingoffsets_stream, failondataloss=False)
+        startingoffsets=args.startingoffsets_stream, failondataloss=False,
+        maxoffsetspertrigger=maxoffsetspertrigger,
+        minpartitions=args.minpartitions)
 
-    # Get Schema of alerts
-    _, _, alert_schema_json = get_schemas_from_avro(args.schema)
+    # Optionally, keep the original Avro data for pass-through distribution
+    df = df.select(["timestamp", "topic", "value"])
+    if args.keep_avro_payload == 'true':
+        df = df\
+            .withColumn(PAYLOAD_COLUMN, registry.payload("value"))\
+            .withColumn(
+                PAYLOAD_VERSION_COLUMN,
+                registry.version_column("value", "topic"))
 
     # Decode the Avro data, and keep only (timestamp, data)
-    df_decoded = df.select(
-        [
-            "timestamp",
-            "topic",
-            from_avro(df["value"], alert_schema_json).alias("decoded")
-        ]
-    )
+    df_decoded = registry.decode_dataframe(
+        df, valuecol="value", topiccol="topic", alias="decoded")
 
     # Flatten the data columns to match the incoming alert data schema
     cnames = df_decoded.columns
     cnames[cnames.index('decoded')] = 'decoded.*'
-    df_decoded = df_decoded.selectExpr(cnames)
+    return df_decoded.selectExpr(cnames)
+
+# Partitioning of the raw database
+RAW_PARTITIONS = ["topic", "year", "month", "day", "hour"]
+
+def write_batch(batchdf, batchid: int, args):
+    """ Write a micro-batch of alerts to the raw database, and to the
+    cutout and detection stores if any.
+
+    The stores are written first: once the batch is committed in the raw
+    database, the cutouts and detections of its alerts are available. A
+    batch replayed after a failure is skipped by the stores which already
+    committed it (see append_to_file_sink and append_new_detections).
+
+    Parameters
+    ----------
+    batchdf: DataFrame
+        Alerts of the micro-batch, with the hourly partitioning columns.
+    batchid: int
+        Index of the micro-batch.
+    args: argparse.Namespace
+        Arguments of the service.
+    """
+    # The alerts are read from Kafka and decoded once for all outputs
+    batchdf.persist()
+
+    # Optionally, store the cutouts separately (keyed by candid)
+    df_alerts = batchdf
+    if args.cutoutdatapath != '':
+        df_alerts, df_cutouts = split_cutouts(df_alerts)
+        append_to_file_sink(
+            df_cutouts, batchid, args.cutoutdatapath, CUTOUT_PARTITIONS)
+
+    # Optionally, store each previous detection once (detection store)
+    if args.detectiondatapath != '':
+        df_alerts, df_detections = split_detections(df_alerts)
+        append_new_detections(df_detections, args.detectiondatapath)
+
+    append_to_file_sink(df_alerts, batchid, args.rawdatapath, RAW_PARTITIONS)
+    batchdf.unpersist()
+
+def start_ingestion(args, registry, maxoffsetspertrigger: int):
+    """ Define and start the streaming query from Kafka (or from a
+    directory of Avro files) to the raw database, and the cutout and
+    detection stores if any.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        Arguments of the service.
+    registry: AlertSchemaRegistry
+        Schema(s) to decode the alerts.
+    maxoffsetspertrigger: int
+        Maximum number of alerts per micro-batch. None or 0 means no limit.
+
+    Returns
+    ----------
+    query: StreamingQuery
+        The query writing all the outputs (see write_batch).
+    """
+    if args.alertdropdir != '':
+        # Alerts are read from Avro files, decoded in parallel
+        df_decoded = connect_to_avro_files(
+            args.alertdropdir, registry.reader_ddl(),
+            json.dumps(registry.reader_schema),
+            maxfilespertrigger=args.maxfilespertrigger)
+    else:
+        df_decoded = decode_kafka_stream(args, registry, maxoffsetspertrigger)
+
+    # Drop alerts received twice (at-least-once delivery, replays)
+    if args.dedup_delay != '':
+        df_decoded = deduplicate_alerts(df_decoded, args.dedup_delay)
+
+    # Index of the sky position, to cluster compacted partitions
+    df_decoded = add_skyindex(df_decoded)
 
     # Partition the data hourly
     df_partitionedby = df_decoded\
@@ -83,11 +174,9 @@ def main():
     # Append new rows every `tinterval` seconds
     countquery_tmp = df_partitionedby\
         .writeStream\
-        .outputMode("append") \
-        .format("parquet") \
-        .option("checkpointLocation", args.checkpointpath_raw) \
-        .option("path", args.rawdatapath)\
-        .partitionBy("topic", "year", "month", "day", "hour")
+        .foreachBatch(
+            lambda batchdf, batchid: write_batch(batchdf, batchid, args))\
+        .option("checkpointLocation", args.checkpointpath_raw)
 
     # Fixed interval micro-batches or ASAP
     if args.tinterval > 0:
@@ -97,13 +186,126 @@ def main():
     else:
         countquery = countquery_tmp.start()
 
+    return countquery
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = getargs(parser)
+
+    # Initialise Spark session
+    spark = init_sparksession(
+        name="stream2raw", profile=args.spark_profile,
+        input_rate=args.input_rate, tinterval=args.tinterval)
+
+    # The level here should be controlled by an argument.
+    logger = get_fink_logger(spark.sparkContext.appName, args.log_level)
+
+    # debug statements
+    inspect_application(logger)
+
+    # Get Schema(s) of alerts. The first one is the reader schema,
+    # and alerts encoded with other versions are projected into it.
+    registry = build_registry(args.schema, args.schema_topics)
+    logger.info("Alert schema versions: {}".format(registry.versions))
+
+    # The original Avro data is only available from Kafka
+    if args.alertdropdir != '' and args.keep_avro_payload == 'true':
+        logger.warning(
+            "Ingestion from {}: the original Avro data is not kept"
+            .format(args.alertdropdir))
+        args.keep_avro_payload = 'false'
+
+    # Files of the drop directory are not read in order of observation
+    # date: the watermark of the deduplication would drop older alerts
+    if args.alertdropdir != '' and args.dedup_delay != '':
+        logger.warning(
+            "Ingestion from {}: the alerts are not deduplicated"
+            .format(args.alertdropdir))
+        args.dedup_delay = ''
+
+    # Rate control of the ingestion. In adaptive mode, the cap on the
+    # number of alerts per micro-batch follows the measured processing rate.
+    maxoffsets = args.maxoffsetspertrigger
+    controller = None
+    if args.ingestion_mode == "adaptive" and args.alertdropdir == '':
+        target = args.target_batch_duration
+        if target <= 0:
+            target = max(args.tinterval, 1)
+        controller = IngestionRateController(
+            target_duration=target,
+            initial_offsets=maxoffsets if maxoffsets > 0 else 10000,
+            statefile=os.path.join(args.finkwebpath, "ingestion_rate.json"))
+        maxoffsets = controller.maxoffsets
+    logger.info("Ingestion mode: {} (maxOffsetsPerTrigger={})".format(
+        args.ingestion_mode, maxoffsets))
+
+    query = start_ingestion(args, registry, maxoffsets)
+
     # Keep the Streaming running until something or someone ends it!
-    if args.exit_after is not None:
+    monitored = controller is not None or args.dedup_delay != ''
+    if not monitored and args.exit_after is not None:
         time.sleep(args.exit_after)
-        countquery.stop()
+        query.stop()
         logger.info("Exiting the stream2raw service normally...")
+    elif not monitored:
+        spark.streams.awaitAnyTermination()
     else:
-        countquery.awaitTermination()
+        start = time.time()
+        lastbatch = -1
+        period = max(args.tinterval, 1)
+        ninput, nduplicates = 0, 0
+        while not query.awaitTermination(period):
+            for progress in query.recentProgress:
+                if progress["batchId"] <= lastbatch:
+                    continue
+                lastbatch = progress["batchId"]
+
+                # Feed the controller with the new micro-batches
+                if controller is not None:
+                    controller.update_from_progress(progress)
+
+                # Report the duplicate rate, and the late alerts dropped
+                if args.dedup_delay != '':
+                    numrows, duplicates, late = duplicates_from_progress(
+                        progress)
+                    ninput += numrows
+                    if late is None:
+                        logger.warning(
+                            "Batch {}: {}/{} alerts dropped, duplicates or "
+                            "later than {}".format(
+                                lastbatch, duplicates, numrows,
+                                args.dedup_delay))
+                        continue
+                    nduplicates += duplicates
+                    if numrows > 0:
+                        logger.info(
+                            "Batch {}: {}/{} duplicates ({:.2%} overall)"
+                            .format(
+                                lastbatch, duplicates, numrows,
+                                nduplicates / max(ninput, 1)))
+                    if late > 0:
+                        logger.warning(
+                            "Batch {}: {} alerts dropped, later than {}"
+                            .format(lastbatch, late, args.dedup_delay))
+
+            # The cap cannot be changed on a running query: restart it
+            # (from its checkpoint) when the cap changed significantly.
+            restart = controller is not None and \
+                controller.needs_restart(maxoffsets)
+            if restart:
+                maxoffsets = controller.maxoffsets
+                logger.info(
+                    "Restarting ingestion with maxOffsetsPerTrigger={}"
+                    .format(maxoffsets))
+                query.stop()
+                query = start_ingestion(args, registry, maxoffsets)
+                lastbatch = -1
+
+            elapsed = time.time() - start
+            if args.exit_after is not None and elapsed > args.exit_after:
+                query.stop()
+                logger.info("Exiting the stream2raw service normally...")
+                break
 
 
 if __name__ == "__main__":
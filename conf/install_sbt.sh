@@ -0,0 +1,24 @@
+#!/bin/bash
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Install sbt, to compile and test the Scala part of Fink
+SBT_VERSION=`grep sbt.version project/build.properties | cut -d= -f2`
+
+wget https://github.com/sbt/sbt/releases/download/v${SBT_VERSION}/sbt-${SBT_VERSION}.tgz
+tar -zxf sbt-${SBT_VERSION}.tgz
+rm sbt-${SBT_VERSION}.tgz
+
+export PATH=$(pwd)/sbt/bin:$PATH
@@ -28,7 +28,35 @@ from fink_broker.tester import regular_unit_tests
 __all__ = [
     'writeavrodata',
     'readschemadata',
-    'readschemafromavrofile']
+    'readschemafromavrofile',
+    'canonicalschema',
+    'schemafingerprint']
+
+# Primitive Avro types (see the Avro specification)
+AVRO_PRIMITIVES = [
+    'null', 'boolean', 'int', 'long', 'float', 'double', 'bytes', 'string']
+
+# Seed of the CRC-64-AVRO (Rabin) fingerprint
+EMPTY64 = 0xc15d213aa4d7a795
+
+def _build_fingerprint_table() -> list:
+    """ Pre-compute the lookup table of the CRC-64-AVRO fingerprint.
+    See https://avro.apache.org/docs/current/spec.html#schema_fingerprints
+
+    Returns
+    ----------
+    table: list of int
+        256 entries used to fingerprint one byte at a time.
+    """
+    table = []
+    for i in range(256):
+        fp = i
+        for _ in range(8):
+            fp = (fp >> 1) ^ (EMPTY64 & -(fp & 1))
+        table.append(fp)
+    return table
+
+FP_TABLE = _build_fingerprint_table()
 
 def writeavrodata(json_data: dict, json_schema: dict) -> io._io.BytesIO:
     """ Encode json into Avro format given a schema.
@@ -113,6 +141,138 @@ def readschemafromavrofile(fn: str) -> dict:
         schema = data.schema
     return schema
 
+def _canonicalise(schema, namespace: str, seen: set):
+    """ Recursively reduce a schema to its Parsing Canonical Form.
+
+    Parameters
+    ----------
+    schema: str, list or dict
+        (Sub-)schema to reduce.
+    namespace: str
+        Enclosing namespace, used to resolve short names.
+    seen: set
+        Full names of the named types already defined.
+
+    Returns
+    ----------
+    out: str, list or dict
+        Canonical (sub-)schema.
+    """
+    if isinstance(schema, list):
+        return [_canonicalise(i, namespace, seen) for i in schema]
+
+    if isinstance(schema, str):
+        if schema in AVRO_PRIMITIVES or "." in schema or namespace == "":
+            return schema
+        return "{}.{}".format(namespace, schema)
+
+    kind = schema["type"]
+    if not isinstance(kind, str):
+        return _canonicalise(kind, namespace, seen)
+
+    if kind in AVRO_PRIMITIVES:
+        return kind
+
+    if kind == "array":
+        return {
+            "type": "array",
+            "items": _canonicalise(schema["items"], namespace, seen)}
+
+    if kind == "map":
+        return {
+            "type": "map",
+            "values": _canonicalise(schema["values"], namespace, seen)}
+
+    if kind not in ["record", "error", "enum", "fixed"]:
+        # Reference to a named type
+        return _canonicalise(kind, namespace, seen)
+
+    name = schema["name"]
+    space = schema.get("namespace", namespace)
+    if "." not in name and space:
+        name = "{}.{}".format(space, name)
+
+    # Named types are only defined once
+    if name in seen:
+        return name
+    seen.add(name)
+
+    out = {"name": name, "type": kind}
+    if kind in ["record", "error"]:
+        space = name.rsplit(".", 1)[0] if "." in name else ""
+        out["fields"] = [
+            {
+                "name": field["name"],
+                "type": _canonicalise(field["type"], space, seen)
+            } for field in schema["fields"]]
+    elif kind == "enum":
+        out["symbols"] = schema["symbols"]
+    else:
+        out["size"] = schema["size"]
+
+    return out
+
+def canonicalschema(schema: dict) -> str:
+    """ Return the Parsing Canonical Form of an Avro schema.
+
+    Two schemas having the same canonical form describe the same
+    binary encoding, whatever their documentation or attribute order.
+
+    Parameters
+    ----------
+    schema: dict
+        Avro schema (JSON).
+
+    Returns
+    ----------
+    canonical: str
+        Canonical form of the schema, as a compact JSON string.
+
+    Examples
+    ----------
+    >>> schema = {
+    ...     "type": "record", "name": "candidate", "namespace": "ztf",
+    ...     "doc": "some documentation",
+    ...     "fields": [
+    ...         {"name": "jd", "type": {"type": "double"}},
+    ...         {"name": "fid", "type": ["null", "int"], "default": None}]}
+    >>> print(canonicalschema(schema))
+    {"name":"ztf.candidate","type":"record","fields":[{"name":"jd","type":"double"},{"name":"fid","type":["null","int"]}]}
+    """
+    canonical = _canonicalise(schema, "", set())
+    return json.dumps(canonical, separators=(",", ":"))
+
+def schemafingerprint(schema: dict) -> int:
+    """ Compute the CRC-64-AVRO fingerprint of an Avro schema.
+
+    The fingerprint is computed on the Parsing Canonical Form of the schema,
+    and it is the one used by the Avro single-object encoding.
+
+    Parameters
+    ----------
+    schema: dict
+        Avro schema (JSON).
+
+    Returns
+    ----------
+    fingerprint: int
+        64-bit fingerprint of the schema.
+
+    Examples
+    ----------
+    >>> print(hex(schemafingerprint("int")))
+    0x7275d51a3f395c8f
+
+    >>> schema = readschemafromavrofile(ztf_alert_sample)
+    >>> schemafingerprint(schema) == schemafingerprint(
+    ...     json.loads(canonicalschema(schema)))
+    True
+    """
+    fp = EMPTY64
+    for byte in canonicalschema(schema).encode("utf-8"):
+        fp = (fp >> 8) ^ FP_TABLE[(fp ^ byte) & 0xff]
+    return fp
+
 
 if __name__ == "__main__":
     """ Execute the test suite """
@@ -0,0 +1,753 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Utilities to compact the small files written by the streaming sinks
+(raw and science databases) into a few large files per hourly partition.
+
+The streaming sinks write a few files per partition and per micro-batch.
+Once an hourly partition is closed (no more writes), its files are rewritten
+into files of about `target_size` bytes in a staging directory, moved into
+the partition, and swapped in the `_spark_metadata` log of the sink with a
+single atomic rename.
+
+The sink keeps writing its log meanwhile, and builds its next compacted
+batch from the previous one: if it read the log before the swap, the swap
+is lost. Hence the original files are only deleted once a later compacted
+batch of the sink confirms the swap (see confirm_pending_swaps). If the
+swap was lost, the compacted files are deleted instead, and the partition
+is compacted again later.
+
+Compacted files keep the modification time of the files they replace, such
+that streaming readers with a `maxFileAge` smaller than the age of compacted
+partitions do not consider them as new files (see connect_to_raw_database).
+"""
+from pyspark.sql import SparkSession
+
+import os
+import json
+import math
+import time
+
+from fink_broker.sparkUtils import get_spark_context, get_hadoop_path
+from fink_broker.sparkUtils import read_file_sink_log, get_partition_values
+from fink_broker.spatialUtils import SKYINDEX_COLUMN
+from fink_broker.tester import spark_unit_tests
+
+# Levels of the hourly partitioning of the databases
+HOURLY_LEVELS = ["year", "month", "day", "hour"]
+
+# Staging area for compacted files, ignored by Spark readers
+STAGING_DIR = "_compaction"
+
+# Swaps waiting for a confirmation by the sink log (see confirm_pending_swaps)
+PENDING_DIR = "_compaction_pending"
+
+# Size of Parquet row groups in compacted files. Rows are sorted by sky
+# index, so that small row groups can be skipped by sky-region queries.
+ROWGROUP_SIZE = 16 * 1024**2
+
+def partition_values_from_path(path: str) -> list:
+    """ Return the hourly partition values (year, month, day, hour)
+    of a file or folder of the database.
+
+    Parameters
+    ----------
+    path: str
+        Path of a file or a partition folder.
+
+    Returns
+    ----------
+    values: list of str
+        [year, month, day, hour], or None if the path is not in an
+        hourly partition.
+
+    Examples
+    ----------
+    >>> path = "file:/data/topic=ztf/year=2019/month=11/day=01/hour=03/a.parquet"
+    >>> partition_values_from_path(path)
+    ['2019', '11', '01', '03']
+    >>> partition_values_from_path("file:/data/a.parquet") is None
+    True
+    """
+    values = {}
+    for level in path.split("/"):
+        name, _, value = level.partition("=")
+        if name in HOURLY_LEVELS:
+            values[name] = value
+
+    if len(values) != len(HOURLY_LEVELS):
+        return None
+    return [values[name] for name in HOURLY_LEVELS]
+
+def partition_subpath(folder: str) -> str:
+    """ Return all the partition levels of a partition folder, i.e. its
+    path relative to the base path of the database.
+
+    Parameters
+    ----------
+    folder: str
+        Partition folder.
+
+    Returns
+    ----------
+    subpath: str
+        Partition levels, from the first to the last one.
+
+    Examples
+    ----------
+    >>> folder = "file:/data/topic=ztf/year=2019/month=11/day=01/hour=03"
+    >>> partition_subpath(folder)
+    'topic=ztf/year=2019/month=11/day=01/hour=03'
+    >>> partition_subpath("/data/year=2019/month=11/day=01/hour=03/")
+    'year=2019/month=11/day=01/hour=03'
+    """
+    levels = []
+    for level in reversed(folder.rstrip("/").split("/")):
+        if "=" not in level:
+            break
+        levels.insert(0, level)
+    return "/".join(levels)
+
+def group_files_by_partition(files: list) -> dict:
+    """ Group the entries of a file sink log by hourly partition folder.
+
+    Parameters
+    ----------
+    files: list of dict
+        Entries with at least `path`, `size` and `modificationTime`
+        (see read_file_sink_log).
+
+    Returns
+    ----------
+    partitions: dict
+        Partition folder -> list of entries. Files outside of
+        hourly partitions are discarded.
+
+    Examples
+    ----------
+    >>> files = [
+    ...     {"path": "/d/year=2019/month=11/day=01/hour=03/a.parquet"},
+    ...     {"path": "/d/year=2019/month=11/day=01/hour=03/b.parquet"},
+    ...     {"path": "/d/year=2019/month=11/day=01/hour=04/c.parquet"},
+    ...     {"path": "/d/c.parquet"}]
+    >>> partitions = group_files_by_partition(files)
+    >>> sorted([(k, len(v)) for k, v in partitions.items()])
+    [('/d/year=2019/month=11/day=01/hour=03', 2), ('/d/year=2019/month=11/day=01/hour=04', 1)]
+    """
+    partitions = {}
+    for entry in files:
+        if partition_values_from_path(entry["path"]) is None:
+            continue
+        folder = entry["path"].rsplit("/", 1)[0]
+        partitions.setdefault(folder, []).append(entry)
+    return partitions
+
+def list_database_files(basepath: str) -> list:
+    """ Return the data files of a database, from the file sink log if
+    any, or by listing the database otherwise.
+
+    Parameters
+    ----------
+    basepath: str
+        Base path of the database.
+
+    Returns
+    ----------
+    files: list of dict
+        Entries with `path`, `size` and `modificationTime`.
+
+    Examples
+    ----------
+    >>> files = list_database_files("archive/alerts_store")
+    >>> len(files) > 0
+    True
+    """
+    files = read_file_sink_log(basepath)
+    if len(files) > 0:
+        return files
+
+    jpath, fs = get_hadoop_path(basepath)
+    if not fs.exists(jpath):
+        return []
+
+    iterator = fs.listFiles(jpath, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        name = status.getPath().getName()
+        parents = status.getPath().toUri().getPath()
+        if not name.endswith(".parquet") or "/_" in parents:
+            continue
+        files.append({
+            "path": status.getPath().toString(),
+            "size": status.getLen(),
+            "modificationTime": status.getModificationTime()})
+    return files
+
+def select_partitions(
+        partitions: dict, now: float, minage: float,
+        minfiles: int = 2) -> list:
+    """ Select the partition folders which can be compacted: closed hourly
+    partitions whose newest file is older than `minage` hours, and with at
+    least `minfiles` files.
+
+    Parameters
+    ----------
+    partitions: dict
+        Partition folder -> list of entries (see group_files_by_partition).
+    now: float
+        Current Unix time in seconds.
+    minage: float
+        Minimum age of the files of a partition, in hours.
+    minfiles: int, optional
+        Minimum number of files in a partition. Default is 2.
+
+    Returns
+    ----------
+    folders: list of str
+        Sorted partition folders.
+
+    Examples
+    ----------
+    >>> now = 1572566400.0
+    >>> old = int((now - 10 * 3600) * 1000)
+    >>> partitions = {
+    ...     "/d/year=2019/month=10/day=31/hour=12": [
+    ...         {"modificationTime": old}, {"modificationTime": old}],
+    ...     "/d/year=2019/month=10/day=31/hour=13": [
+    ...         {"modificationTime": old}]}
+    >>> select_partitions(partitions, now, minage=1)
+    ['/d/year=2019/month=10/day=31/hour=12']
+    >>> select_partitions(partitions, now, minage=24)
+    []
+    """
+    # The partition of the current hour is never closed
+    current = get_partition_values(int(now * 1000))
+    threshold = (now - minage * 3600) * 1000
+
+    folders = []
+    for folder, entries in partitions.items():
+        if len(entries) < minfiles:
+            continue
+        if partition_values_from_path(folder) >= current:
+            continue
+        if max(e["modificationTime"] for e in entries) >= threshold:
+            continue
+        folders.append(folder)
+    return sorted(folders)
+
+def _read_text(fs, jpath) -> str:
+    """ Read a text file with a Hadoop FileSystem """
+    sc = get_spark_context()
+    stream = fs.open(jpath)
+    try:
+        return sc._jvm.org.apache.commons.io.IOUtils.toString(stream, "UTF-8")
+    finally:
+        stream.close()
+
+def _write_text_atomically(fs, jpath, text: str):
+    """ Write a text file with a Hadoop FileSystem: the content is written
+    in a temporary file, renamed (with overwrite) into `jpath`.
+    """
+    sc = get_spark_context()
+    jvm = sc._jvm
+    tmppath = jvm.org.apache.hadoop.fs.Path(
+        jpath.getParent(), ".{}.tmp".format(jpath.getName()))
+    stream = fs.create(tmppath, True)
+    try:
+        stream.write(bytearray(text.encode("utf-8")))
+    finally:
+        stream.close()
+
+    # FileSystem.rename does not overwrite on all file systems
+    filecontext = jvm.org.apache.hadoop.fs.FileContext.getFileContext(
+        jpath.toUri(), sc._jsc.hadoopConfiguration())
+    options = sc._gateway.new_array(
+        jvm.org.apache.hadoop.fs.Options.Rename, 1)
+    options[0] = jvm.org.apache.hadoop.fs.Options.Rename.OVERWRITE
+    filecontext.rename(tmppath, jpath, options)
+
+def _latest_compact_log(basepath: str):
+    """ Return the path of the latest compacted batch of a file sink log,
+    and the paths referenced by the batches written after it.
+    """
+    logpath, fs = get_hadoop_path(os.path.join(basepath, "_spark_metadata"))
+    if not fs.exists(logpath):
+        return None, set()
+
+    batches = {}
+    for status in fs.listStatus(logpath):
+        name = status.getPath().getName()
+        batchid = name.split(".")[0]
+        if batchid.isdigit() and not name.endswith(".tmp"):
+            batches[int(batchid)] = status.getPath()
+
+    compacted = [
+        k for k, v in batches.items() if v.getName().endswith(".compact")]
+    if len(compacted) == 0:
+        return None, set()
+    latest = max(compacted)
+
+    later = set()
+    for batchid in sorted(k for k in batches if k > latest):
+        for line in _read_text(fs, batches[batchid]).split("\n")[1:]:
+            if line.strip() != "":
+                later.add(json.loads(line)["path"])
+    return batches[latest], later
+
+def swap_in_sink_log(basepath: str, removed: list, added: list) -> int:
+    """ Replace files in the latest compacted batch of a file sink log, with
+    a single atomic rename. Nothing is done if one of the removed files is
+    referenced by a batch written after it.
+
+    The sink may have read the compacted batch before the swap, to build
+    its next compacted batch: the swap must be confirmed by a later
+    compacted batch before deleting the removed files (see
+    confirm_pending_swaps).
+
+    Parameters
+    ----------
+    basepath: str
+        Output path of the file sink.
+    removed: list of str
+        Paths (as written in the log) of the files to remove.
+    added: list of dict
+        Log entries of the new files.
+
+    Returns
+    ----------
+    batchid: int
+        Index of the compacted batch updated, or None if the log has
+        not been updated.
+    """
+    compactpath, later = _latest_compact_log(basepath)
+    if compactpath is None or len(later.intersection(removed)) > 0:
+        return None
+
+    _, fs = get_hadoop_path(compactpath.toString())
+    lines = _read_text(fs, compactpath).split("\n")
+
+    # Keep the version header, and the other entries untouched
+    removed = set(removed)
+    kept = [lines[0]]
+    for line in lines[1:]:
+        if line.strip() == "":
+            continue
+        if json.loads(line)["path"] in removed:
+            removed.discard(json.loads(line)["path"])
+            continue
+        kept.append(line)
+
+    # Some files are not in this compacted batch (concurrent compaction)
+    if len(removed) > 0:
+        return None
+
+    kept += [json.dumps(entry, separators=(",", ":")) for entry in added]
+    _write_text_atomically(fs, compactpath, "\n".join(kept))
+    return int(compactpath.getName().split(".")[0])
+
+def _pending_swaps(basepath: str) -> list:
+    """ (path, record) of the swaps waiting for a confirmation """
+    jpending, fs = get_hadoop_path(os.path.join(basepath, PENDING_DIR))
+    if not fs.exists(jpending):
+        return []
+    out = []
+    for status in fs.listStatus(jpending):
+        if status.getPath().getName().endswith(".json"):
+            record = json.loads(_read_text(fs, status.getPath()))
+            out.append((status.getPath(), record))
+    return out
+
+def confirm_pending_swaps(basepath: str) -> dict:
+    """ Finish the swaps of compacted files confirmed by the sink log.
+
+    A swap is confirmed once the sink has written a compacted batch after
+    the one updated by the swap, and this batch references the compacted
+    files instead of the original ones: the original files are deleted. If
+    the new batch references the original files instead, the sink did not
+    see the swap: the compacted files are deleted. Swaps are left pending
+    until the sink compacts its log again.
+
+    Parameters
+    ----------
+    basepath: str
+        Output path of the file sink.
+
+    Returns
+    ----------
+    report: dict
+        Number of swaps confirmed, reverted, and still pending.
+    """
+    sc = get_spark_context()
+    report = {"confirmed": 0, "reverted": 0, "pending": 0}
+
+    records = _pending_swaps(basepath)
+    if len(records) == 0:
+        return report
+
+    compactpath, _ = _latest_compact_log(basepath)
+    latest = -1
+    if compactpath is not None:
+        latest = int(compactpath.getName().split(".")[0])
+    current = set(entry["path"] for entry in read_file_sink_log(basepath))
+
+    for jrecord, record in records:
+        removed, added = set(record["removed"]), set(record["added"])
+        if latest <= record["batch"]:
+            report["pending"] += 1
+            continue
+
+        if added.issubset(current) and not removed.intersection(current):
+            todelete = removed
+            report["confirmed"] += 1
+        elif not added.intersection(current):
+            todelete = added
+            report["reverted"] += 1
+        else:
+            # Partially referenced: leave it for inspection
+            report["pending"] += 1
+            continue
+
+        _, fs = get_hadoop_path(jrecord.toString())
+        for path in todelete:
+            fs.delete(sc._jvm.org.apache.hadoop.fs.Path(path), False)
+        fs.delete(jrecord, False)
+
+    return report
+
+def _log_entry(fs, jpath) -> dict:
+    """ Entry of a file sink log for a file (same fields as Spark) """
+    status = fs.getFileStatus(jpath)
+    return {
+        "path": fs.makeQualified(jpath).toUri().toString(),
+        "size": status.getLen(),
+        "isDir": False,
+        "modificationTime": status.getModificationTime(),
+        "blockReplication": status.getReplication(),
+        "blockSize": status.getBlockSize(),
+        "action": "add"}
+
+def compact_partition(
+        basepath: str, folder: str, entries: list, target_size: int,
+        withlog: bool, dedupkey: str = None) -> dict:
+    """ Rewrite the files of a partition into files of about `target_size`
+    bytes, and swap them in.
+
+    The new files are written in a staging area, and moved into the
+    partition folder with the modification time of the newest original
+    file. If alerts have a sky index, files cover disjoint ranges of the
+    index and rows are sorted by sky index and objectId, such that
+    sky-region and object queries can skip files and row groups.
+
+    If the database has a sink log, the files are swapped in it atomically,
+    and the original files are kept until the swap is confirmed (see
+    confirm_pending_swaps). Otherwise the original files are simply
+    deleted.
+
+    Parameters
+    ----------
+    basepath: str
+        Base path of the database.
+    folder: str
+        Partition folder.
+    entries: list of dict
+        Entries (path, size, modificationTime) of the files of the partition.
+    target_size: int
+        Target size of the compacted files, in bytes.
+    withlog: bool
+        True if the database is written by a file sink with a log.
+    dedupkey: str, optional
+        If set, rows with the same `dedupkey` (e.g. candid) are
+        deduplicated. Default is None.
+
+    Returns
+    ----------
+    report: dict
+        Number of files, bytes and rows before and after. Empty if the
+        partition could not be swapped in the log.
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+    sc = get_spark_context()
+
+    paths = [entry["path"] for entry in entries]
+    nbytes = sum(entry["size"] for entry in entries)
+    mtime = max(entry["modificationTime"] for entry in entries)
+    nfiles = max(1, int(math.ceil(nbytes / target_size)))
+
+    # Write the compacted files in the staging area. The partition
+    # columns are not inferred from explicit file paths. Partitions of
+    # different topics can share the same hour: all levels are kept.
+    subpath = partition_subpath(folder)
+    staging = os.path.join(basepath, STAGING_DIR, subpath)
+    df = spark.read.parquet(*paths)
+    nrows = df.count()
+    if dedupkey is not None:
+        df = df.dropDuplicates([dedupkey])
+
+    if SKYINDEX_COLUMN in df.columns:
+        sortcols = [
+            c for c in [SKYINDEX_COLUMN, "objectId"] if c in df.columns]
+        df = df.repartitionByRange(nfiles, SKYINDEX_COLUMN)\
+            .sortWithinPartitions(*sortcols)
+    else:
+        df = df.coalesce(nfiles)
+
+    df.write\
+        .mode("overwrite")\
+        .option("parquet.block.size", ROWGROUP_SIZE)\
+        .parquet(staging)
+    nrows_after = spark.read.parquet(staging).count()
+
+    # Move them into the partition, with the original modification time
+    jstaging, fs = get_hadoop_path(staging)
+    jfolder = sc._jvm.org.apache.hadoop.fs.Path(folder)
+    newfiles = []
+    for status in fs.listStatus(jstaging):
+        name = status.getPath().getName()
+        if not name.endswith(".parquet"):
+            continue
+        target = sc._jvm.org.apache.hadoop.fs.Path(
+            jfolder, "compacted-{}".format(name))
+        fs.rename(status.getPath(), target)
+        fs.setTimes(target, mtime, -1)
+        newfiles.append(target)
+    fs.delete(jstaging, True)
+
+    # Swap them in
+    if withlog:
+        added = [_log_entry(fs, path) for path in newfiles]
+        batchid = swap_in_sink_log(basepath, paths, added)
+        if batchid is None:
+            for path in newfiles:
+                fs.delete(path, False)
+            return {}
+
+        # Keep the original files until the swap is confirmed
+        record = {
+            "batch": batchid, "removed": paths,
+            "added": [entry["path"] for entry in added]}
+        jrecord = sc._jvm.org.apache.hadoop.fs.Path(
+            os.path.join(basepath, PENDING_DIR),
+            "{}.json".format(subpath.replace("/", "-")))
+        _write_text_atomically(fs, jrecord, json.dumps(record))
+    else:
+        for path in paths:
+            fs.delete(sc._jvm.org.apache.hadoop.fs.Path(path), False)
+
+    return {
+        "files_before": len(paths),
+        "bytes_before": nbytes,
+        "files_after": len(newfiles),
+        "bytes_after": sum(
+            fs.getFileStatus(path).getLen() for path in newfiles),
+        "rows_before": nrows,
+        "rows_after": nrows_after}
+
+def dryrun_partition(entries: list, dedupkey: str = None) -> dict:
+    """ Report of compact_partition, without compacting: the number of files
+    and bytes are unchanged, and the number of rows after is the number of
+    distinct `dedupkey` if set.
+
+    Parameters
+    ----------
+    entries: list of dict
+        Entries (path, size, modificationTime) of the files of the partition.
+    dedupkey: str, optional
+        Key to deduplicate rows (e.g. candid). Default is None.
+
+    Returns
+    ----------
+    report: dict
+        Number of files, bytes and rows before and after.
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    df = spark.read.parquet(*[entry["path"] for entry in entries])
+    nrows = df.count()
+    if dedupkey is not None:
+        nrows_after = df.select(dedupkey).distinct().count()
+    else:
+        nrows_after = nrows
+
+    nbytes = sum(entry["size"] for entry in entries)
+    return {
+        "files_before": len(entries), "bytes_before": nbytes,
+        "files_after": len(entries), "bytes_after": nbytes,
+        "rows_before": nrows, "rows_after": nrows_after}
+
+def compact_database(
+        basepath: str, target_size: int = 128 * 1024**2,
+        minage: float = 169.0, now: float = None,
+        dryrun: bool = False, dedupkey: str = None) -> dict:
+    """ Compact the closed hourly partitions of a database, and optionally
+    drop the duplicated alerts they contain.
+
+    Streaming readers skip compacted files as long as `minage` is larger
+    than their maxFileAge (7 days by default). The swaps of previous calls
+    confirmed by the sink log are finished first (see
+    confirm_pending_swaps).
+
+    Parameters
+    ----------
+    basepath: str
+        Base path of the database (e.g. FINK_ALERT_PATH).
+    target_size: int, optional
+        Target size of the compacted files, in bytes. Default is 128 MB.
+    minage: float, optional
+        Minimum age of the files to compact, in hours.
+        Default is 169 (7 days and 1 hour).
+    now: float, optional
+        Current Unix time in seconds. Default is time.time().
+    dryrun: bool, optional
+        If True, only report the partitions to compact (and the number of
+        duplicates if `dedupkey` is set). Default is False.
+    dedupkey: str, optional
+        If set, rows with the same `dedupkey` (e.g. candid) in a partition
+        are deduplicated. Default is None.
+
+    Returns
+    ----------
+    report: dict
+        Number of partitions, files, bytes and rows before and after, and
+        number of previous swaps confirmed and reverted.
+
+    Examples
+    ----------
+    Small files in a partition of 2019, written by a file sink
+    >>> path = "archive/compaction_test"
+    >>> df = spark.range(100).selectExpr(
+    ...     "id % 90 as candid", "'2019' as year", "'11' as month",
+    ...     "'01' as day", "'03' as hour")
+    >>> df.repartition(4).write.mode("overwrite")\\
+    ...     .partitionBy("year", "month", "day", "hour").parquet(path)
+    >>> jpath, fs = get_hadoop_path(path)
+    >>> entries = list_database_files(path)
+    >>> len(entries)
+    4
+
+    >>> logdir = os.path.join(path, "_spark_metadata")
+    >>> os.makedirs(logdir, exist_ok=True)
+    >>> with open(os.path.join(logdir, "9.compact"), "w") as f:
+    ...     lines = ["v1"] + [json.dumps(e) for e in entries]
+    ...     _ = f.write("\\n".join(lines))
+
+    >>> report = compact_database(
+    ...     path, minage=0, dryrun=True, dedupkey="candid")
+    >>> report["partitions"], report["files_before"], report["files_after"]
+    (1, 4, 4)
+    >>> report["rows_before"], report["rows_after"]
+    (100, 90)
+
+    >>> report = compact_database(path, minage=0, dedupkey="candid")
+    >>> report["partitions"], report["files_before"], report["files_after"]
+    (1, 4, 1)
+    >>> len(read_file_sink_log(path))
+    1
+    >>> spark.read.parquet(path).count()
+    90
+
+    # The original files are kept until the sink compacts its log again
+    >>> import glob, shutil
+    >>> len(glob.glob(os.path.join(path, "year=2019/*/*/*/part-*")))
+    4
+    >>> compact_database(path, minage=0)["confirmed"]
+    0
+    >>> _ = shutil.copy(
+    ...     os.path.join(logdir, "9.compact"),
+    ...     os.path.join(logdir, "19.compact"))
+    >>> compact_database(path, minage=0)["confirmed"]
+    1
+    >>> len(glob.glob(os.path.join(path, "year=2019/*/*/*/part-*")))
+    0
+    >>> fs.delete(jpath, True)
+    True
+
+    Two topics in the same hour are compacted and confirmed separately
+    >>> df.withColumn("topic", (df["candid"] % 2).cast("string"))\\
+    ...     .repartition(4).write.mode("overwrite")\\
+    ...     .partitionBy("topic", "year", "month", "day", "hour")\\
+    ...     .parquet(path)
+    >>> entries = list_database_files(path)
+    >>> os.makedirs(logdir, exist_ok=True)
+    >>> with open(os.path.join(logdir, "9.compact"), "w") as f:
+    ...     lines = ["v1"] + [json.dumps(e) for e in entries]
+    ...     _ = f.write("\\n".join(lines))
+
+    >>> report = compact_database(path, minage=0)
+    >>> report["partitions"], report["files_after"]
+    (2, 2)
+    >>> pending = glob.glob(os.path.join(path, PENDING_DIR, "*.json"))
+    >>> sorted(os.path.basename(p) for p in pending)
+    ['topic=0-year=2019-month=11-day=01-hour=03.json', 'topic=1-year=2019-month=11-day=01-hour=03.json']
+    >>> _ = shutil.copy(
+    ...     os.path.join(logdir, "9.compact"),
+    ...     os.path.join(logdir, "19.compact"))
+    >>> compact_database(path, minage=0)["confirmed"]
+    2
+    >>> len(glob.glob(os.path.join(path, "topic=*/*/*/*/*/part-*")))
+    0
+    >>> spark.read.parquet(path).count()
+    100
+    >>> fs.delete(jpath, True)
+    True
+    """
+    if now is None:
+        now = time.time()
+
+    withlog = len(read_file_sink_log(basepath)) > 0
+    swaps = {"confirmed": 0, "reverted": 0}
+    if withlog and not dryrun:
+        swaps = confirm_pending_swaps(basepath)
+
+    partitions = group_files_by_partition(list_database_files(basepath))
+    folders = select_partitions(partitions, now, minage)
+
+    report = {
+        "partitions": 0, "skipped": 0,
+        "files_before": 0, "bytes_before": 0,
+        "files_after": 0, "bytes_after": 0,
+        "rows_before": 0, "rows_after": 0,
+        "confirmed": swaps["confirmed"], "reverted": swaps["reverted"]}
+    for folder in folders:
+        entries = partitions[folder]
+        if dryrun:
+            partreport = dryrun_partition(entries, dedupkey)
+        else:
+            partreport = compact_partition(
+                basepath, folder, entries, target_size, withlog, dedupkey)
+
+        if len(partreport) == 0:
+            report["skipped"] += 1
+            continue
+
+        report["partitions"] += 1
+        for key, value in partreport.items():
+            report[key] += value
+
+    # Remove the (empty) staging area
+    jstaging, fs = get_hadoop_path(os.path.join(basepath, STAGING_DIR))
+    if not dryrun and fs.exists(jstaging):
+        fs.delete(jstaging, True)
+
+    return report
+
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    # Run the Spark test suite
+    spark_unit_tests(globals())
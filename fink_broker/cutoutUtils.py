@@ -0,0 +1,156 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Utilities to store the cutouts of alerts separately from the alert data.
+
+Cutouts are by far the largest fields of alerts, but most of the filters and
+processors never read them. Optionally, stream2raw writes them in a side
+Parquet database (the cutout store) keyed by `candid`, with the same hourly
+partitioning as the raw database. Alerts keep `candid` (and their partition
+columns) as reference, and cutouts are fetched lazily for the alerts which
+need them.
+"""
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.functions import col, lit
+
+from functools import reduce
+
+from fink_broker.tester import spark_unit_tests
+
+# Fields of the alerts stored in the cutout store
+CUTOUT_COLUMNS = ["cutoutScience", "cutoutTemplate", "cutoutDifference"]
+
+# Key and partitioning of the cutout store
+CUTOUT_KEY = "candid"
+CUTOUT_PARTITIONS = ["year", "month", "day", "hour"]
+
+def has_cutouts(df: DataFrame) -> bool:
+    """ Check whether the cutouts are part of the alert data.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame of alerts.
+
+    Returns
+    ----------
+    out: bool
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([(1, "a")], ["candid", "cutoutScience"])
+    >>> has_cutouts(df)
+    False
+    """
+    return all(c in df.columns for c in CUTOUT_COLUMNS)
+
+def split_cutouts(df: DataFrame) -> (DataFrame, DataFrame):
+    """ Split alerts into alert data without cutouts, and cutouts keyed
+    by candid.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame of alerts, with hourly partitioning columns.
+
+    Returns
+    ----------
+    df_alerts: DataFrame
+        Alerts without cutouts.
+    df_cutouts: DataFrame
+        candid, cutouts, and partitioning columns.
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame(
+    ...     [(1, "a", "b", "c", "2019", "11", "01", "03")],
+    ...     ["candid"] + CUTOUT_COLUMNS + CUTOUT_PARTITIONS)
+    >>> df_alerts, df_cutouts = split_cutouts(df)
+    >>> df_alerts.columns
+    ['candid', 'year', 'month', 'day', 'hour']
+    >>> df_cutouts.columns
+    ['candid', 'cutoutScience', 'cutoutTemplate', 'cutoutDifference', 'year', 'month', 'day', 'hour']
+    """
+    df_cutouts = df.select([CUTOUT_KEY] + CUTOUT_COLUMNS + CUTOUT_PARTITIONS)
+    df_alerts = df.select([c for c in df.columns if c not in CUTOUT_COLUMNS])
+    return df_alerts, df_cutouts
+
+def fetch_cutouts(df: DataFrame, cutoutpath: str) -> DataFrame:
+    """ Re-attach cutouts from the cutout store to (static) alerts.
+
+    Only the partitions of the store containing the alerts are read, hence
+    `df` should be small (e.g. a micro-batch, or alerts selected by a
+    filter). Alerts whose cutouts are not found get null cutouts.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Static DataFrame of alerts, with `candid` and the hourly
+        partitioning columns.
+    cutoutpath: str
+        Path of the cutout store.
+
+    Returns
+    ----------
+    df: DataFrame
+        Alerts with the cutout columns.
+
+    Examples
+    ----------
+    >>> path = "archive/cutouts_test"
+    >>> df = spark.createDataFrame(
+    ...     [(i, "s", "t", "d", "2019", "11", "01", "0{}".format(i))
+    ...     for i in range(3)],
+    ...     ["candid"] + CUTOUT_COLUMNS + CUTOUT_PARTITIONS)
+    >>> df_alerts, df_cutouts = split_cutouts(df)
+    >>> df_cutouts.write.mode("overwrite")\\
+    ...     .partitionBy(*CUTOUT_PARTITIONS).parquet(path)
+
+    >>> df_fetched = fetch_cutouts(df_alerts.filter("candid > 0"), path)
+    >>> df_fetched.select(["candid"] + CUTOUT_COLUMNS)\\
+    ...     .orderBy("candid").collect()[0]
+    Row(candid=1, cutoutScience='s', cutoutTemplate='t', cutoutDifference='d')
+    >>> df_fetched.count()
+    2
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    # Partitions of the alerts, to prune the listing of the store
+    partitions = df.select(CUTOUT_PARTITIONS).distinct().collect()
+    condition = reduce(
+        lambda x, y: x | y,
+        [
+            reduce(
+                lambda x, y: x & y,
+                [col(k) == row[k] for k in CUTOUT_PARTITIONS])
+            for row in partitions
+        ],
+        lit(False))
+
+    df_cutouts = spark.read.parquet(cutoutpath)\
+        .filter(condition)\
+        .select([CUTOUT_KEY] + CUTOUT_COLUMNS + CUTOUT_PARTITIONS)\
+        .dropDuplicates([CUTOUT_KEY])
+
+    return df.join(
+        df_cutouts, on=[CUTOUT_KEY] + CUTOUT_PARTITIONS, how="left")
+
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    # Run the Spark test suite
+    spark_unit_tests(globals())
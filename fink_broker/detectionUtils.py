@@ -0,0 +1,302 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Utilities to store the history of the alerts (prv_candidates) once.
+
+Each ZTF alert carries the detections and upper limits of its object over
+the previous 30 days, hence the same detection is stored in many alerts.
+Optionally, stream2raw stores alerts without `prv_candidates` (but with the
+date of their first previous detection, PRV_START_COLUMN), and the previous
+detections in a separate Parquet database (the detection store) keyed by
+(objectId, jd, fid), partitioned by the date of the detection. The
+`prv_candidates` of an alert are reconstructed on demand from the detections
+of its object between PRV_START_COLUMN and the date of the alert.
+"""
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.column import Column
+from pyspark.sql.functions import col, lit, explode, array_min, date_format
+from pyspark.sql.functions import struct, collect_list, sort_array
+from pyspark.sql.functions import min as spark_min, max as spark_max
+
+import math
+from functools import reduce
+
+from fink_broker.sparkUtils import get_hadoop_path
+from fink_broker.tester import spark_unit_tests
+
+# Key and partitioning of the detection store
+DETECTION_KEY = ["objectId", "jd", "fid"]
+DETECTION_PARTITIONS = ["year", "month", "day"]
+
+# Column replacing prv_candidates in the alerts
+PRV_START_COLUMN = "prv_jdstart"
+
+# Julian Date of the Unix epoch
+JD_UNIX_EPOCH = 2440587.5
+
+def detection_partitions(jdcol: Column) -> list:
+    """ Partitioning columns (yyyy, MM, dd) of the detection store, from
+    the Julian Date of the detections (session time zone).
+
+    Parameters
+    ----------
+    jdcol: Column
+        Julian Date.
+
+    Returns
+    ----------
+    out: list of Column
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([(2458788.5,)], ["jd"])
+    >>> df.select(detection_partitions(col("jd"))).first()[0]
+    '2019'
+    """
+    timestamp = ((jdcol - JD_UNIX_EPOCH) * 86400).cast("timestamp")
+    return [
+        date_format(timestamp, fmt).alias(name)
+        for fmt, name in zip(["yyyy", "MM", "dd"], DETECTION_PARTITIONS)]
+
+def split_detections(df: DataFrame) -> (DataFrame, DataFrame):
+    """ Split alerts into alerts without prv_candidates, and previous
+    detections keyed by (objectId, jd, fid).
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame of alerts.
+
+    Returns
+    ----------
+    df_alerts: DataFrame
+        Alerts where prv_candidates is replaced by the Julian Date of the
+        first previous detection (PRV_START_COLUMN).
+    df_detections: DataFrame
+        objectId, fields of prv_candidates, and partitioning columns.
+        Detections can be duplicated.
+
+    Examples
+    ----------
+    >>> df_alerts, df_detections = split_detections(df_alerts_sample)
+    >>> df_alerts.columns
+    ['objectId', 'candid', 'candidate', 'prv_jdstart']
+    >>> df_detections.columns
+    ['objectId', 'jd', 'fid', 'magpsf', 'year', 'month', 'day']
+    >>> df_detections.count()
+    4
+    """
+    cnames = [
+        array_min(col("prv_candidates.jd")).alias(PRV_START_COLUMN)
+        if c == "prv_candidates" else col(c) for c in df.columns]
+    df_alerts = df.select(cnames)
+
+    df_detections = df\
+        .select("objectId", explode("prv_candidates").alias("prv"))\
+        .select("objectId", "prv.*")
+    df_detections = df_detections.select(
+        df_detections.columns + detection_partitions(col("jd")))
+
+    return df_alerts, df_detections
+
+def _partitions_condition(jdmin: float, jdmax: float) -> Column:
+    """ Condition on the partitioning columns selecting the detections
+    between jdmin and jdmax.
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    # Steps of 12 hours, such that no day is skipped with daylight saving
+    nsteps = int(math.ceil((jdmax - jdmin) * 2)) + 1
+    jds = spark.range(nsteps + 1)\
+        .select(
+            (
+                lit(jdmin) + (col("id") * 0.5).cast("double")
+            ).alias("jd"))\
+        .filter(col("jd") <= jdmax)\
+        .union(spark.range(1).select(lit(jdmax).alias("jd")))
+    partitions = jds.select(detection_partitions(col("jd")))\
+        .distinct().collect()
+
+    return reduce(
+        lambda x, y: x | y,
+        [
+            reduce(
+                lambda x, y: x & y,
+                [col(k) == row[k] for k in DETECTION_PARTITIONS])
+            for row in partitions
+        ],
+        lit(False))
+
+def read_detections(
+        detectionpath: str, jdmin: float, jdmax: float) -> DataFrame:
+    """ Read the detections of the store between jdmin and jdmax,
+    listing only the partitions containing them.
+
+    Parameters
+    ----------
+    detectionpath: str
+        Path of the detection store.
+    jdmin, jdmax: float
+        Range of Julian Dates (included).
+
+    Returns
+    ----------
+    df: DataFrame
+        Detections, without the partitioning columns.
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    return spark.read.parquet(detectionpath)\
+        .filter(_partitions_condition(jdmin, jdmax))\
+        .filter(col("jd").between(jdmin, jdmax))\
+        .drop(*DETECTION_PARTITIONS)
+
+def append_new_detections(df: DataFrame, detectionpath: str):
+    """ Append to the detection store the (static) detections not already
+    stored. Meant to be called on each micro-batch with foreachBatch.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Static DataFrame of detections (see split_detections).
+    detectionpath: str
+        Path of the detection store.
+
+    Examples
+    ----------
+    >>> path = "archive/detections_test"
+    >>> _, df_detections = split_detections(df_alerts_sample)
+    >>> append_new_detections(df_detections, path)
+    >>> append_new_detections(df_detections, path)
+    >>> spark.read.parquet(path).count()
+    3
+    """
+    df = df.dropDuplicates(DETECTION_KEY)
+
+    jpath, fs = get_hadoop_path(detectionpath)
+    bounds = df.select(spark_min("jd"), spark_max("jd")).first()
+    if bounds[0] is None:
+        return
+
+    # Only new detections are appended
+    if fs.exists(jpath):
+        stored = read_detections(detectionpath, bounds[0], bounds[1])\
+            .select(DETECTION_KEY)
+        df = df.join(stored, on=DETECTION_KEY, how="left_anti")
+
+    df.write\
+        .mode("append")\
+        .partitionBy(*DETECTION_PARTITIONS)\
+        .parquet(detectionpath)
+
+def fetch_prv_candidates(df: DataFrame, detectionpath: str) -> DataFrame:
+    """ Reconstruct the prv_candidates of (static) alerts from the
+    detection store.
+
+    Only the partitions of the store between the first previous detection
+    and the last alert are read, hence `df` should be small (e.g. a
+    micro-batch, or alerts selected by a filter).
+
+    Parameters
+    ----------
+    df: DataFrame
+        Static DataFrame of alerts, with PRV_START_COLUMN
+        (see split_detections).
+    detectionpath: str
+        Path of the detection store.
+
+    Returns
+    ----------
+    df: DataFrame
+        Alerts with prv_candidates (sorted by jd) instead of
+        PRV_START_COLUMN.
+
+    Examples
+    ----------
+    >>> path = "archive/detections_test"
+    >>> df_alerts, _ = split_detections(df_alerts_sample)
+    >>> df_rec = fetch_prv_candidates(df_alerts, path)
+    >>> df_rec.columns == df_alerts_sample.columns
+    True
+    >>> rec = df_rec.orderBy("candid").collect()
+    >>> ref = df_alerts_sample.orderBy("candid").collect()
+    >>> [i.prv_candidates for i in rec] == [i.prv_candidates for i in ref]
+    True
+    """
+    alertcandid = "_alert_candid"
+    alertjd = "_alert_jd"
+
+    bounds = df.select(
+        spark_min(PRV_START_COLUMN), spark_max("candidate.jd")).first()
+
+    # The previous detections of each alert
+    df_prv = df\
+        .filter(col(PRV_START_COLUMN).isNotNull())\
+        .select(
+            "objectId", PRV_START_COLUMN,
+            col("candid").alias(alertcandid),
+            col("candidate.jd").alias(alertjd))
+
+    if bounds[0] is not None:
+        df_detections = read_detections(detectionpath, bounds[0], bounds[1])
+        fields = [c for c in df_detections.columns if c != "objectId"]
+
+        # jd is the first field of prv_candidates, hence the sort by jd
+        df_prv = df_prv\
+            .join(df_detections, on="objectId")\
+            .filter(
+                (col("jd") >= col(PRV_START_COLUMN)) &
+                (col("jd") < col(alertjd)))\
+            .groupBy(alertcandid)\
+            .agg(
+                sort_array(
+                    collect_list(struct(*fields))).alias("prv_candidates"))
+    else:
+        df_prv = df_prv.select(
+            alertcandid, lit(None).alias("prv_candidates"))
+
+    cnames = [
+        "prv_candidates" if c == PRV_START_COLUMN else c for c in df.columns]
+    return df\
+        .join(
+            df_prv, on=df["candid"] == df_prv[alertcandid], how="left")\
+        .select(cnames)
+
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    globs = globals()
+    spark = SparkSession.builder.getOrCreate()
+
+    # Two alerts of the same object sharing a previous detection, and
+    # an alert without history
+    prv = "array<struct<jd:double,fid:int,magpsf:float>>"
+    globs["df_alerts_sample"] = spark.createDataFrame(
+        [
+            ("ZTF19a", 1, (2458790.5,), [(2458788.5, 1, 18.), ]),
+            ("ZTF19a", 2, (2458791.5,),
+                [(2458788.5, 1, 18.), (2458790.5, 1, 17.5)]),
+            ("ZTF19b", 3, (2458790.5,), [(2458789.5, 2, 19.)]),
+            ("ZTF19c", 4, (2458790.5,), None)
+        ],
+        "objectId string, candid long, candidate struct<jd:double>, "
+        "prv_candidates {}".format(prv))
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -13,21 +13,55 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import json
 import os
-import glob
-import shutil
 import time
-
-from fink_broker.avroUtils import readschemafromavrofile
-from fink_broker.sparkUtils import get_spark_context, to_avro, from_avro
-from pyspark.sql import DataFrame
-from pyspark.sql.functions import struct, col, lit
+import struct as pystruct
+
+from fink_broker.avroUtils import schemafingerprint
+from fink_broker.sparkUtils import to_avro, from_avro
+from fink_broker.schemaRegistry import AlertSchemaRegistry, FileSchemaRegistry
+from fink_broker.schemaRegistry import SINGLE_OBJECT_MARKER
+from fink_broker.schemaRegistry import PAYLOAD_COLUMN, PAYLOAD_VERSION_COLUMN
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.functions import struct, col, lit, expr, concat
+from pyspark.sql.types import DataType, StructType, ArrayType, MapType
+from pyspark.sql.types import BooleanType, ByteType, ShortType, IntegerType
+from pyspark.sql.types import LongType, FloatType, DoubleType, StringType
+from pyspark.sql.types import BinaryType, DateType, TimestampType, DecimalType
 from fink_broker.tester import spark_unit_tests
-from fink_broker.hbaseUtils import construct_hbase_catalog_from_flatten_schema
+from fink_broker.hbaseUtils import column_family
+
+# Number of commits between compactions of the offset store
+OFFSET_COMPACT_INTERVAL = 10
+
+# Offset store of the status updates, next to the distribution offset store
+# (see update_status_in_hbase)
+STATUS_OFFSET_SUFFIX = ".status"
+
+# Margin on the cell timestamps of the status updates, in ms
+STATUS_TIME_MARGIN = 10 * 60 * 1000
+
+# Avro types of the Spark atomic types, as used by to_avro
+AVRO_TYPES = [
+    (BooleanType, "boolean"),
+    ((ByteType, ShortType, IntegerType), "int"),
+    (LongType, "long"),
+    (DateType, {"type": "int", "logicalType": "date"}),
+    (TimestampType, {"type": "long", "logicalType": "timestamp-micros"}),
+    (FloatType, "float"),
+    (DoubleType, "double"),
+    (StringType, "string"),
+    (BinaryType, "bytes")]
+
+# Distribution schemas already derived, and saved (see distribution_schema)
+_DISTRIBUTION_SCHEMAS = {}
+_SAVED_SCHEMAS = set()
 
 def get_kafka_df(
-        df: DataFrame, schema_path: str, saveschema: bool = False) -> DataFrame:
+        df: DataFrame, schema_path: str, saveschema: bool = False,
+        registry: FileSchemaRegistry = None, subject: str = None) -> DataFrame:
     """Create and return a df to pubish to Kafka
 
     For a kafka output the dataframe should have the following columns:
@@ -51,8 +85,15 @@ def get_kafka_df(
         Path where to store the avro schema required for decoding the
         Kafka messages.
     saveschema: bool
-        If True, save the alert schema on disk. Work only in Spark local mode,
-        and for testing purposes. Default is False.
+        If True, save the distribution schema on disk (local file system,
+        see save_distribution_schema). The schema is derived from the
+        DataFrame schema, hence no data is processed. Default is False.
+    registry: FileSchemaRegistry, optional
+        If given, the distribution schema is registered under `subject`,
+        and messages are framed with its ID (Confluent wire format).
+        Default is None (messages are not framed).
+    subject: str, optional
+        Subject of the schema in the registry, typically `<topic>-value`.
 
     Returns
     ----------
@@ -70,25 +111,318 @@ def get_kafka_df(
     # The contents and schema of the df can change over time
     df_struct = df.select(struct(df.columns).alias("struct"))
 
-    # Convert into avro and save the schema
+    # Convert into avro
     df_kafka = df_struct.select(to_avro("struct").alias("value"))
 
+    if registry is not None:
+        schema_id = registry.register(
+            subject, distribution_schema(df_struct.schema["struct"].dataType))
+        df_kafka = df_kafka.select(
+            registry.frame(col("value"), schema_id).alias("value"))
+
     if saveschema:
-        # Harcoded path that corresponds to the schema used
-        # for alert redistribution.
-        schema_path = 'schemas/distribution_schema_new.avsc'
+        if schema_path == '':
+            # Default path of the schema used for alert redistribution.
+            schema_path = 'schemas/distribution_schema_new.avsc'
+        save_distribution_schema(
+            distribution_schema(df_struct.schema["struct"].dataType),
+            schema_path)
+
+    return df_kafka
 
-        # Do not work on a DFS like HDFS obviously.
-        # Only local mode & for testing purposes
-        toto = df.writeStream.foreachBatch(
-            lambda x, y: save_avro_schema_stream(x, y, schema_path)
-        ).start()
-        time.sleep(10)
+def avro_schema_from_spark(
+        datatype: DataType, recordname: str = "topLevelRecord",
+        namespace: str = "", nullable: bool = False) -> dict:
+    """ Return the Avro schema used by `to_avro` to encode a column of
+    Spark type `datatype`.
 
-        # Note that the entire Spark application will stop.
-        toto.stop()
+    The schema is derived in Python, with the rules of the Spark Avro
+    SchemaConverters: nullable types are unions with null, and nested
+    records are named after their field, in the namespace of their parent.
 
-    return df_kafka
+    Parameters
+    ----------
+    datatype: DataType
+        Spark type of the column (typically a StructType).
+    recordname: str, optional
+        Name of the top-level record. Default is topLevelRecord.
+    namespace: str, optional
+        Namespace of the top-level record. Default is empty.
+    nullable: bool, optional
+        Nullability of the column. Default is False.
+
+    Returns
+    ----------
+    schema: dict
+        Avro schema (JSON).
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([("Star",)], ["cdsxmatch"])
+    >>> schema = avro_schema_from_spark(df.schema, "fink", "fink")
+    >>> schema["name"], [f["name"] for f in schema["fields"]]
+    ('fink', ['cdsxmatch'])
+
+    >>> df = spark.createDataFrame(
+    ...     [("ZTF19", (1.5, [3, None]))],
+    ...     "objectId string, candidate struct<ra:double,fid:array<int>>")
+    >>> print(json.dumps(avro_schema_from_spark(df.schema)))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {"type": "record", "name": "topLevelRecord", "fields": [{"name":
+    "objectId", "type": ["string", "null"]}, {"name": "candidate", "type":
+    [{"type": "record", "name": "candidate", "namespace": "topLevelRecord",
+    "fields": [{"name": "ra", "type": ["double", "null"]}, {"name": "fid",
+    "type": [{"type": "array", "items": ["int", "null"]}, "null"]}]},
+    "null"]}]}
+
+    # Round trip of the data
+    >>> import io, fastavro
+    >>> buf = io.BytesIO()
+    >>> row = df.first().asDict(recursive=True)
+    >>> fastavro.schemaless_writer(buf, avro_schema_from_spark(df.schema), row)
+    >>> _ = buf.seek(0)
+    >>> fastavro.schemaless_reader(buf, avro_schema_from_spark(df.schema))
+    {'objectId': 'ZTF19', 'candidate': {'ra': 1.5, 'fid': [3, None]}}
+    """
+    for sparktype, avrotype in AVRO_TYPES:
+        if isinstance(datatype, sparktype):
+            schema = copy.deepcopy(avrotype)
+            break
+    else:
+        if isinstance(datatype, DecimalType):
+            # smallest size holding the precision
+            size = 1
+            while 2 ** (8 * size - 1) < 10 ** datatype.precision:
+                size += 1
+            schema = {
+                "type": "fixed", "name": "fixed",
+                "namespace": ".".join(
+                    [x for x in [namespace, recordname] if x != ""]),
+                "size": size, "logicalType": "decimal",
+                "precision": datatype.precision, "scale": datatype.scale}
+        elif isinstance(datatype, ArrayType):
+            schema = {
+                "type": "array",
+                "items": avro_schema_from_spark(
+                    datatype.elementType, recordname, namespace,
+                    datatype.containsNull)}
+        elif isinstance(datatype, MapType) and \
+                isinstance(datatype.keyType, StringType):
+            schema = {
+                "type": "map",
+                "values": avro_schema_from_spark(
+                    datatype.valueType, recordname, namespace,
+                    datatype.valueContainsNull)}
+        elif isinstance(datatype, StructType):
+            childnamespace = ".".join(
+                [x for x in [namespace, recordname] if x != ""])
+            schema = {"type": "record", "name": recordname}
+            if namespace != "":
+                schema["namespace"] = namespace
+            schema["fields"] = [
+                {
+                    "name": field.name,
+                    "type": avro_schema_from_spark(
+                        field.dataType, field.name, childnamespace,
+                        field.nullable)
+                } for field in datatype.fields]
+        else:
+            raise ValueError(
+                "Spark type {} cannot be converted to Avro".format(datatype))
+
+    if nullable:
+        return [schema, "null"]
+    return schema
+
+def distribution_schema(datatype: DataType) -> dict:
+    """ Versioned Avro schema of the distributed alerts (see get_kafka_df).
+
+    The schema is derived from the Spark type of the distributed struct
+    (avro_schema_from_spark), and cached. Its version is the hexadecimal
+    CRC-64-AVRO fingerprint of the schema.
+
+    Parameters
+    ----------
+    datatype: DataType
+        Spark type of the distributed struct (StructType).
+
+    Returns
+    ----------
+    schema: dict
+        Avro schema (JSON), with a `version` attribute.
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([("Star",)], ["cdsxmatch"])
+    >>> schema = distribution_schema(df.schema)
+    >>> schema["version"] == "{:016x}".format(schemafingerprint(schema))
+    True
+    >>> distribution_schema(df.schema) == schema
+    True
+    """
+    key = datatype.json()
+    if key not in _DISTRIBUTION_SCHEMAS:
+        schema = avro_schema_from_spark(datatype)
+        schema["version"] = "{:016x}".format(schemafingerprint(schema))
+        _DISTRIBUTION_SCHEMAS[key] = schema
+    return copy.deepcopy(_DISTRIBUTION_SCHEMAS[key])
+
+def save_distribution_schema(schema: dict, schema_path: str) -> str:
+    """ Save a distribution schema on disk (local file system).
+
+    The schema is saved under a name containing its version
+    (<root>_<version>.avsc), and at `schema_path` which holds the latest
+    schema. Saving the same schema again does nothing.
+
+    Parameters
+    ----------
+    schema: dict
+        Avro schema, with a `version` attribute (see distribution_schema).
+    schema_path: str
+        Path of the latest distribution schema.
+
+    Returns
+    ----------
+    fn: str
+        Path of the versioned schema.
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([("Star",)], ["cdsxmatch"])
+    >>> schema = distribution_schema(df.schema)
+    >>> fn = save_distribution_schema(schema, "dist_schema_test.avsc")
+    >>> fn == "dist_schema_test_{}.avsc".format(schema["version"])
+    True
+    >>> with open("dist_schema_test.avsc") as f:
+    ...     json.load(f) == schema
+    True
+    >>> os.remove(fn)
+    >>> os.remove("dist_schema_test.avsc")
+    """
+    root, ext = os.path.splitext(schema_path)
+    fn = "{}_{}{}".format(root, schema["version"], ext or ".avsc")
+    if (schema_path, fn) in _SAVED_SCHEMAS and os.path.isfile(fn):
+        return fn
+
+    for path in [fn, schema_path]:
+        tmp = "{}.tmp-{}".format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(schema, f, indent=2)
+        os.replace(tmp, path)
+
+    _SAVED_SCHEMAS.add((schema_path, fn))
+    return fn
+
+def compose_passthrough_schema(
+        alert_schema: dict, fink_schema: dict,
+        fieldname: str = "fink") -> dict:
+    """ Schema of the alerts distributed in pass-through mode: the fields
+    of the original alert, followed by a record with the Fink fields.
+
+    The Avro binary encoding of a record being the concatenation of the
+    encodings of its fields, messages are the original Avro data followed
+    by the encoded Fink record.
+
+    Parameters
+    ----------
+    alert_schema: dict
+        Avro schema of the original alerts.
+    fink_schema: dict
+        Avro schema (record) of the Fink fields.
+    fieldname: str, optional
+        Name of the field with the Fink record. Default is fink.
+
+    Returns
+    ----------
+    schema: dict
+        Composed Avro schema.
+
+    Examples
+    ----------
+    >>> alert_schema = {
+    ...     "type": "record", "name": "alert", "version": "3.3",
+    ...     "fields": [{"name": "objectId", "type": "string"}]}
+    >>> fink_schema = {
+    ...     "type": "record", "name": "fink",
+    ...     "fields": [{"name": "cdsxmatch", "type": ["string", "null"]}]}
+    >>> schema = compose_passthrough_schema(alert_schema, fink_schema)
+    >>> schema["version"]
+    '3.3+fink'
+
+    >>> import io, fastavro
+    >>> alert, fink = io.BytesIO(), io.BytesIO()
+    >>> fastavro.schemaless_writer(alert, alert_schema, {"objectId": "ZTF19"})
+    >>> fastavro.schemaless_writer(fink, fink_schema, {"cdsxmatch": "Star"})
+    >>> fastavro.schemaless_reader(
+    ...     io.BytesIO(alert.getvalue() + fink.getvalue()), schema)
+    {'objectId': 'ZTF19', 'fink': {'cdsxmatch': 'Star'}}
+    """
+    if fieldname in [field["name"] for field in alert_schema["fields"]]:
+        raise ValueError(
+            "The alert schema already has a field named {}".format(fieldname))
+
+    schema = dict(alert_schema)
+    schema["fields"] = list(alert_schema["fields"]) + [
+        {"name": fieldname, "type": fink_schema}]
+    if "version" in alert_schema:
+        schema["version"] = "{}+{}".format(alert_schema["version"], fieldname)
+    return schema
+
+def get_passthrough_kafka_df(
+        df: DataFrame, registry: AlertSchemaRegistry, finkcols: list,
+        fieldname: str = "fink") -> (DataFrame, dict):
+    """ Create a df to publish to Kafka, reusing the original Avro data of
+    the alerts instead of encoding them again (pass-through mode).
+
+    Messages are the original Avro data (PAYLOAD_COLUMN, kept by stream2raw)
+    followed by the encoded Fink fields, under a schema composed for each
+    version of the original schema (see compose_passthrough_schema). They
+    use the Avro single-object encoding, whose header carries the
+    fingerprint of the composed schema, such that consumers decode them
+    with a registry of the composed schemas.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Alerts with PAYLOAD_COLUMN and PAYLOAD_VERSION_COLUMN.
+    registry: AlertSchemaRegistry
+        Schemas of the original alerts.
+    finkcols: list of str or Column
+        Fink fields to distribute with the alerts.
+    fieldname: str, optional
+        Name of the field with the Fink fields. Default is fink.
+
+    Returns
+    ----------
+    df: DataFrame
+        A Spark DataFrame with an avro(binary) encoded Column named "value"
+    schemas: dict
+        Composed schema for each version of the original schema.
+    """
+    df_fink = df.select(
+        PAYLOAD_COLUMN, PAYLOAD_VERSION_COLUMN,
+        struct(*finkcols).alias(fieldname))
+    fink_schema = avro_schema_from_spark(
+        df_fink.schema[fieldname].dataType, fieldname, fieldname)
+
+    schemas = {}
+    headers = []
+    for version in registry.versions:
+        schemas[version] = compose_passthrough_schema(
+            registry.schema(version), fink_schema, fieldname)
+        header = SINGLE_OBJECT_MARKER + pystruct.pack(
+            "<Q", schemafingerprint(schemas[version]))
+        headers.append("WHEN '{}' THEN X'{}'".format(version, header.hex()))
+
+    header = expr("CASE {} {} END".format(
+        PAYLOAD_VERSION_COLUMN, " ".join(headers)))
+
+    df_kafka = df_fink.select(
+        concat(
+            header, col(PAYLOAD_COLUMN), to_avro(col(fieldname))
+        ).alias("value"))
+
+    return df_kafka, schemas
 
 def save_avro_schema_stream(df: DataFrame, epochid: int, schema_path=None):
     """ Extract schema from an alert of the stream, and save it on disk.
@@ -131,29 +465,21 @@ def save_avro_schema(df: DataFrame, schema_path: str):
 
     # Check if the file exists
     if not os.path.isfile(schema_path):
-        # Store the df as an avro file
-        path_for_avro = os.path.join(os.environ["PWD"], "flatten_hbase.avro")
-        if os.path.exists(path_for_avro):
-            shutil.rmtree(path_for_avro)
-        df.write.format("avro").save(path_for_avro)
-
-        # Read the avro schema from .avro file
-        avro_file = glob.glob(path_for_avro + "/part*")[0]
-        avro_schema = readschemafromavrofile(avro_file)
+        # Derive the avro schema from the DataFrame schema
+        avro_schema = distribution_schema(df.schema)
 
         # Write the schema to a file for decoding Kafka messages
         with open(schema_path, 'w') as f:
             json.dump(avro_schema, f, indent=2)
-
-        # Remove .avro files and directory
-        shutil.rmtree(path_for_avro)
     else:
         msg = """
             {} already exists - cannot write the new schema
         """.format(schema_path)
         print(msg)
 
-def decode_kafka_df(df_kafka: DataFrame, schema_path: str) -> DataFrame:
+def decode_kafka_df(
+        df_kafka: DataFrame, schema_path: str,
+        subject: str = None) -> DataFrame:
     """Decode the DataFrame read from Kafka
 
     The DataFrame read from Kafka contains the following columns:
@@ -169,12 +495,20 @@ def decode_kafka_df(df_kafka: DataFrame, schema_path: str) -> DataFrame:
     avro(binary). This routine creates a Spark DataFrame with a decoded
     StructType column using the avro schema at schema_path.
 
+    If schema_path is the directory of a FileSchemaRegistry, messages are
+    expected in the Confluent wire format: each message is decoded with
+    the schema of its ID, and projected into the latest schema of `subject`.
+
     Parameters
     ----------
     df_kafka: DataFrame
         A Spark DataFrame created after reading the Kafka Source
     schema_path: str
-        Path where the avro schema to decode the Kafka message is stored
+        Path where the avro schema to decode the Kafka message is stored,
+        or directory of a FileSchemaRegistry.
+    subject: str, optional
+        Subject of the schemas in the registry, typically `<topic>-value`.
+        Default is None, that is all the schemas of the registry.
 
     Returns
     ----------
@@ -200,11 +534,9 @@ def decode_kafka_df(df_kafka: DataFrame, schema_path: str) -> DataFrame:
     |ZTF18acsbjvw|697251921215010004|  20.4233877|  -27.0588511|                     Unknown|
     +------------+------------------+------------+-------------+----------------------------+
     <BLANKLINE>
-    >>> temp_schema = os.path.join(os.environ["PWD"], "temp_schema")
-    >>> save_avro_schema(df, temp_schema)
-
-    # Encode the data into avro
-    >>> df_kafka = get_kafka_df(df, '')
+    # Encode the data into avro, and save the schema
+    >>> temp_schema = os.path.join(os.environ["PWD"], "temp_schema.avsc")
+    >>> df_kafka = get_kafka_df(df, temp_schema, saveschema=True)
 
     # Decode the avro df
     >>> df_decoded = decode_kafka_df(df_kafka, temp_schema)
@@ -225,8 +557,25 @@ def decode_kafka_df(df_kafka: DataFrame, schema_path: str) -> DataFrame:
     |ZTF18acsbjvw|697251921215010004|  20.4233877|  -27.0588511|                     Unknown|
     +------------+------------------+------------+-------------+----------------------------+
     <BLANKLINE>
-    >>> os.remove(temp_schema)
+    >>> import glob
+    >>> for fn in glob.glob(os.path.join(os.environ["PWD"], "temp_schema*")):
+    ...     os.remove(fn)
+
+    # Messages framed with the ID of their schema (Confluent wire format)
+    >>> registry = FileSchemaRegistry("temp_registry")
+    >>> df_kafka = get_kafka_df(
+    ...     df, '', registry=registry, subject="test-value")
+    >>> df_decoded = decode_kafka_df(df_kafka, "temp_registry", "test-value")
+    >>> df_decoded.select("struct.objectId").count()
+    2
+    >>> import shutil
+    >>> shutil.rmtree("temp_registry")
     """
+    if os.path.isdir(schema_path):
+        registry = FileSchemaRegistry(schema_path)
+        return registry.decode_dataframe(
+            df_kafka.select("value"), subject, alias="struct")
+
     # Read the avro schema
     with open(schema_path) as f:
         avro_schema = json.dumps(json.load(f))
@@ -236,53 +585,377 @@ def decode_kafka_df(df_kafka: DataFrame, schema_path: str) -> DataFrame:
 
     return df
 
-def update_status_in_hbase(
-        df: DataFrame, database_name: str, rowkey: str,
-        offsetfile: str, timestamp: int):
-    """Update the status column in Hbase
+def _parse_legacy_offset(offsetfile: str) -> int:
+    """ Offset of a (legacy) text offset file, or None if empty """
+    with open(offsetfile, 'r') as f:
+        lines = f.readlines()
+    if len(lines) == 0:
+        return None
+    return int(lines[-1].split(", ")[-1])
+
+def _offset_log(path: str) -> list:
+    """ (batch, kind, filename) of the files of an offset store, sorted """
+    entries = []
+    for fn in os.listdir(path):
+        root, ext = os.path.splitext(fn)
+        if ext in [".json", ".compact"] and root.isdigit():
+            entries.append((int(root), ext[1:], fn))
+    return sorted(entries)
+
+def read_offsets(path: str) -> dict:
+    """ Read the offsets committed in an offset store (see commit_offsets).
+
+    Parameters
+    ----------
+    path: str
+        Directory of the offset store.
+
+    Returns
+    ----------
+    offsets: dict
+        Latest committed offset (timestamp in ms) of each topic.
+        Empty if nothing was committed. The offset common to all topics
+        of a legacy offset file (topic `all`) is dropped once offsets are
+        committed per topic.
+
+    Examples
+    ----------
+    >>> read_offsets("dist.offsets.none")
+    {}
+    """
+    if not os.path.isdir(path):
+        return {}
+
+    entries = _offset_log(path)
+    compacts = [e for e in entries if e[1] == "compact"]
+    if len(compacts) > 0:
+        # Older files are already merged in the last compact file
+        entries = [e for e in entries if e[0] >= compacts[-1][0]]
+
+    offsets = {}
+    for _, _, fn in entries:
+        with open(os.path.join(path, fn)) as f:
+            for topic, offset in json.load(f)["offsets"].items():
+                offsets[topic] = max(offset, offsets.get(topic, offset))
+
+    # The legacy offset is superseded by the offsets of the topics
+    if len(offsets) > 1:
+        offsets.pop("all", None)
+    return offsets
+
+def _write_exclusive(path: str, content: dict) -> bool:
+    """ Atomically create a file, unless it already exists """
+    tmp = "{}.tmp-{}".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(content, f)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        # Atomic, and fails if the file exists (concurrent commit)
+        os.link(tmp, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp)
+
+def commit_offsets(
+        path: str, offsets: dict,
+        compact_interval: int = OFFSET_COMPACT_INTERVAL) -> int:
+    """ Commit distributed offsets (per topic) in an offset store.
+
+    The store is an append-only log: each commit atomically adds a small
+    file <batch>.json, and every `compact_interval` commits the offsets are
+    merged into a file <batch>.compact and older files are deleted, such
+    that reading the store is cheap. A legacy offset file at `path` is
+    converted into an offset store (topic `all`), until the first commit
+    of a topic replaces it.
+
+    Parameters
+    ----------
+    path: str
+        Directory of the offset store (local file system).
+    offsets: dict
+        Distributed offset (timestamp in ms) of topics.
+    compact_interval: int, optional
+        Number of commits between compactions. Default is
+        OFFSET_COMPACT_INTERVAL.
+
+    Returns
+    ----------
+    batch: int
+        Index of the commit.
+
+    Examples
+    ----------
+    >>> path = "dist.offsets.test"
+    >>> for i in range(12):
+    ...     batch = commit_offsets(path, {"rrlyr": 1000 + i}, 5)
+    >>> batch
+    11
+    >>> _ = commit_offsets(path, {"other": 2000}, 5)
+    >>> read_offsets(path) == {"rrlyr": 1011, "other": 2000}
+    True
+    >>> len(os.listdir(path))
+    3
+    >>> import shutil
+    >>> shutil.rmtree(path)
+    """
+    if os.path.isfile(path):
+        legacy = _parse_legacy_offset(path)
+        os.remove(path)
+        if legacy is not None:
+            commit_offsets(path, {"all": legacy}, compact_interval)
+
+    os.makedirs(path, exist_ok=True)
+    while True:
+        entries = _offset_log(path)
+        batch = entries[-1][0] + 1 if len(entries) > 0 else 0
+        content = {"batch": batch, "offsets": offsets}
+        if _write_exclusive(
+                os.path.join(path, "{:08d}.json".format(batch)), content):
+            break
+
+    if batch > 0 and batch % compact_interval == 0:
+        merged = {"batch": batch, "offsets": read_offsets(path)}
+        fn = os.path.join(path, "{:08d}.compact".format(batch))
+        if _write_exclusive(fn, merged):
+            for index, _, name in _offset_log(path):
+                if index <= batch and name != os.path.basename(fn):
+                    os.remove(os.path.join(path, name))
+
+    return batch
+
+def read_hbase_time_range(
+        hbcatalog: str, starttime: int, stoptime: int) -> DataFrame:
+    """ Read the cells of a HBase table written in a time range, with a
+    time-range scan: the cost is proportional to the data in the range
+    rather than to the size of the table.
 
     Parameters
     ----------
+    hbcatalog: str
+        HBase catalog of the table.
+    starttime, stoptime: int
+        Range of cell timestamps (ms since epoch), start included, stop
+        excluded.
+
+    Returns
+    ----------
     df: DataFrame
-        A Spark DataFrame created after reading the database (HBase)
-    database_name: str
-        Name of the database
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    return spark.read\
+        .option("catalog", hbcatalog)\
+        .option("minStamp", str(starttime))\
+        .option("maxStamp", str(stoptime))\
+        .format("org.apache.spark.sql.execution.datasources.hbase")\
+        .load()
+
+def status_time_range(
+        offsetfile: str, topic: str = None, now: int = None,
+        margin: int = STATUS_TIME_MARGIN) -> (int, int):
+    """ Range of HBase cell timestamps of the next status update.
+
+    The science writers (HBase stream, bulk loads) set the cell timestamps
+    to the time of writing, after the alerts are published in Kafka: the
+    rows written before the distribution offset (the Kafka timestamp of the
+    last distributed alert) have been distributed. The range starts where
+    the previous status update stopped, kept in its own offset store
+    (`offsetfile` + STATUS_OFFSET_SUFFIX), and stops `margin` ms before
+    the distribution offset and `now`.
+
+    Parameters
+    ----------
+    offsetfile: str
+        Offset store of the distribution (see commit_offsets).
+    topic: str, optional
+        Topic of the distribution. Default is None, that is all topics.
+    now: int, optional
+        Current time in ms. Default is the current time.
+    margin: int, optional
+        Margin on the cell timestamps in ms, for the clock skew between
+        Kafka and HBase, and for HFiles bulk loaded after being written.
+        Default is STATUS_TIME_MARGIN.
+
+    Returns
+    ----------
+    starttime, stoptime: int
+        Range of cell timestamps, start included, stop excluded. Empty if
+        stop is not after start.
+
+    Examples
+    ----------
+    >>> path = "dist.offsets.status"
+    >>> _ = commit_offsets(path, {"rrlyr": 5000000, "other": 4000000})
+    >>> status_time_range(path, now=10000000, margin=1000)
+    (100, 3999000)
+    >>> status_time_range(path, "rrlyr", now=10000000, margin=1000)
+    (100, 4999000)
+
+    The range starts where the previous update stopped
+    >>> _ = commit_offsets(path + STATUS_OFFSET_SUFFIX, {"all": 3999000})
+    >>> status_time_range(path, now=10000000, margin=1000)
+    (3999000, 3999000)
+    >>> import shutil
+    >>> shutil.rmtree(path)
+    >>> shutil.rmtree(path + STATUS_OFFSET_SUFFIX)
+    """
+    if now is None:
+        now = int(time.time() * 1000)
+
+    starttime = get_distribution_offset(
+        offsetfile + STATUS_OFFSET_SUFFIX, "latest", topic or "all")
+    distributed = get_distribution_offset(offsetfile, "latest", topic)
+    stoptime = min(distributed, now) - margin
+    return starttime, max(starttime, stoptime)
+
+def status_catalog(hbcatalog: str, datacolumn: str = None) -> str:
+    """ Catalog of the status column of the science table.
+
+    Parameters
+    ----------
+    hbcatalog: str
+        HBase catalog of the science table.
+    datacolumn: str, optional
+        Column of the science table also read, such that the rows written
+        in a time range are read even if they have no status yet. Default
+        is None (status only, to write it).
+
+    Returns
+    ----------
+    catalog: str
+
+    Examples
+    ----------
+    >>> from fink_broker.hbaseUtils import (
+    ...     construct_hbase_catalog_from_flatten_schema)
+    >>> catalog = construct_hbase_catalog_from_flatten_schema(
+    ...     StructType.fromJson({"type": "struct", "fields": [
+    ...         {"name": n, "type": t, "nullable": True, "metadata": {}}
+    ...         for n, t in [("candid", "long"), ("objectId", "string")]]}),
+    ...     "science", "candid")
+    >>> columns = json.loads(status_catalog(catalog, "objectId"))["columns"]
+    >>> sorted(columns)
+    ['candid', 'objectId', 'status']
+    >>> columns["status"]
+    {'cf': 'i', 'col': 'status', 'type': 'string'}
+    """
+    catalog = json.loads(hbcatalog)
+    rowkey = catalog["rowkey"]
+    names = [rowkey] + ([datacolumn] if datacolumn is not None else [])
+    columns = {name: catalog["columns"][name] for name in names}
+    columns["status"] = {
+        "cf": column_family("status"), "col": "status", "type": "string"}
+    catalog["columns"] = columns
+    return json.dumps(catalog)
+
+def newly_distributed(df: DataFrame, rowkey: str, datacolumn: str):
+    """ Rows of a time-range scan (see status_catalog) to mark as
+    distributed: rows whose data was written in the range, and without a
+    status yet. The rows whose status only was written in the range (by a
+    previous update) are discarded.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Rows read with status_catalog(hbcatalog, datacolumn).
     rowkey: str
-        Name of the rowkey in the HBase catalog
+        Name of the rowkey column.
+    datacolumn: str
+        Data column read.
+
+    Returns
+    ----------
+    df: DataFrame
+        rowkey, and status set to distributed.
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame(
+    ...     [(1, "ZTF19a", None), (2, None, "distributed"),
+    ...     (3, "ZTF19b", "distributed")],
+    ...     "candid long, objectId string, status string")
+    >>> [tuple(r) for r in newly_distributed(df, "candid", "objectId").collect()]
+    [(1, 'distributed')]
+    """
+    return df\
+        .filter(col(datacolumn).isNotNull() & col("status").isNull())\
+        .select(rowkey)\
+        .withColumn("status", lit("distributed"))
+
+def update_status_in_hbase(
+        hbcatalog: str, offsetfile: str, topic: str = None,
+        now: int = None, datacolumn: str = "objectId",
+        margin: int = STATUS_TIME_MARGIN) -> int:
+    """Update the status column in Hbase for newly distributed alerts, and
+    commit the offset of the status update.
+
+    Only the rows written in the time range given by status_time_range are
+    read, with a time-range scan (read_hbase_time_range), such that the
+    cost is proportional to the new alerts rather than to the table size.
+
+    Parameters
+    ----------
+    hbcatalog: str
+        HBase catalog of the science table.
     offsetfile: str
-        the path of offset file for distribution
-    timestamp: int
-        timestamp till which science db has been scanned and distributed
+        Offset store of the distribution (see commit_offsets). The offsets
+        of the status updates are committed in `offsetfile` +
+        STATUS_OFFSET_SUFFIX.
+    topic: str, optional
+        Topic of the distribution. Default is None, that is the alerts
+        distributed by all topics.
+    now: int, optional
+        Current time in ms. Default is the current time.
+    datacolumn: str, optional
+        Column of the science table written with every alert.
+        Default is objectId.
+    margin: int, optional
+        See status_time_range. Default is STATUS_TIME_MARGIN.
+
+    Returns
     ----------
+    batch: int
+        Index of the commit in the offset store of the status updates, or
+        None if the time range is empty.
     """
-    df = df.select(rowkey, "status")
-    df = df.withColumn("status", lit("distributed"))
+    starttime, stoptime = status_time_range(offsetfile, topic, now, margin)
+    if stoptime <= starttime:
+        return None
 
-    update_catalog = construct_hbase_catalog_from_flatten_schema(
-        df.schema, database_name, rowkey)
+    rowkey = json.loads(hbcatalog)["rowkey"]
+    df = read_hbase_time_range(
+        status_catalog(hbcatalog, datacolumn), starttime, stoptime)
 
-    df.write\
-      .option("catalog", update_catalog)\
-      .format("org.apache.spark.sql.execution.datasources.hbase")\
-      .save()
+    newly_distributed(df, rowkey, datacolumn).write\
+        .option("catalog", status_catalog(hbcatalog))\
+        .format("org.apache.spark.sql.execution.datasources.hbase")\
+        .save()
 
-    # write offset(timestamp) to file
-    with open(offsetfile, 'w') as f:
-        string = "distributed till, {}".format(timestamp)
-        f.write(string)
+    return commit_offsets(
+        offsetfile + STATUS_OFFSET_SUFFIX, {topic or "all": stoptime})
 
 def get_distribution_offset(
-        offsetfile: str, startingoffset_dist: str = "latest") -> int:
-    """Read and return distribution offset from file
+        offsetfile: str, startingoffset_dist: str = "latest",
+        topic: str = None) -> int:
+    """Read and return distribution offset from the offset store (or a
+    legacy offset file)
 
     Parameters
     ----------
     offsetfile: str
-        the path of offset file for distribution
+        the path of the offset store (or file) for distribution
     startingoffset_dist: str, optional
         Offset(timestamp) from where to start the distribution. Options are
         latest (read timestamp from file), earliest (from the beginning of time),
         timestamp (custom timestamp input by user)
+    topic: str, optional
+        Topic of the distribution. Default is None, that is the smallest
+        offset of all topics.
 
     Returns
     ----------
@@ -327,40 +1000,141 @@ def get_distribution_offset(
     >>> min_timestamp == custom_t
     True
 
-    # Delete offset file
-    >>> os.remove('dist.offset.test')
+    # test 6 (offset store, converted from the legacy file and replaced
+    # by the offsets of the topics)
+    >>> _ = commit_offsets("dist.offset.test", {"rrlyr": test_t + 10})
+    >>> get_distribution_offset("dist.offset.test") - test_t
+    10
+    >>> get_distribution_offset("dist.offset.test", topic="rrlyr") - test_t
+    10
+    >>> _ = commit_offsets("dist.offset.test", {"other": test_t + 20})
+    >>> get_distribution_offset("dist.offset.test") - test_t
+    10
+
+    # Delete offset store
+    >>> import shutil
+    >>> shutil.rmtree('dist.offset.test')
 
     """
-    # if the offset file doesn't exist or is empty or
-    # one wants the earliest offset
-    fileexist = os.path.isfile(offsetfile)
-    if fileexist:
-        negatifoffset = os.path.getsize(offsetfile) <= 0
-    else:
-        negatifoffset = False
-    if not fileexist or negatifoffset or startingoffset_dist == "earliest":
-        # set a default
-        min_timestamp = 100
-    else:
-        if startingoffset_dist == "latest":
-            with open(offsetfile, 'r') as f:
-                line = f.readlines()[-1]
-                min_timestamp = int(line.split(", ")[-1])
-        else:
-            # user given timestamp
-            min_timestamp = int(startingoffset_dist)
+    if startingoffset_dist not in ["latest", "earliest"]:
+        # user given timestamp
+        return int(startingoffset_dist)
+
+    # default: from the beginning of time
+    min_timestamp = 100
+    if startingoffset_dist == "earliest":
+        return min_timestamp
+
+    if os.path.isdir(offsetfile):
+        offsets = read_offsets(offsetfile)
+        if topic is not None:
+            # the offset of the topic, or the one common to all topics
+            key = topic if topic in offsets else "all"
+            offsets = {k: v for k, v in offsets.items() if k == key}
+        if len(offsets) > 0:
+            min_timestamp = min(offsets.values())
+    elif os.path.isfile(offsetfile):
+        legacy = _parse_legacy_offset(offsetfile)
+        if legacy is not None:
+            min_timestamp = legacy
 
     return min_timestamp
 
+def group_df_into_structs(df: DataFrame, spec) -> DataFrame:
+    """Group columns of a df into struct columns, in a single projection
+
+    Columns are grouped according to a mapping spec {struct: prefix}: all
+    columns `prefix_*` go into the struct column `struct`, without the
+    prefix. Prefixes may be nested (e.g. `candidate` and `candidate_ps1`):
+    a column goes into the struct of its longest matching prefix. A struct
+    name with dots (e.g. `candidate.ps1`) is nested into its parent struct.
+    Other columns are left untouched, and the structs are added at the end.
+
+    Parameters
+    ----------
+    df: Spark DataFrame
+        a Spark dataframe with flat columns
+    spec: dict or list
+        mapping {struct name: column prefix}. A list of prefixes groups
+        each prefix into a struct of the same name.
+
+    Returns
+    ----------
+    df: Spark DataFrame
+        a Spark dataframe with columns grouped into structs
+
+    Examples
+    ----------
+    >>> df = spark.sparkContext.parallelize(zip(
+    ...     ["ZTF18aceatkx", "ZTF18acsbjvw"],
+    ...     [20.393772, 20.4233877],
+    ...     [0.5, 0.9],
+    ...     ["Star", "Unknown"],
+    ...     [1.0, 2.0])).toDF([
+    ...       "objectId", "candidate_ra", "candidate_ps1_sgscore",
+    ...       "cross_match_alerts_per_batch", "cross_match_score"])
+    >>> df = group_df_into_structs(
+    ...     df, {"candidate": "candidate", "candidate.ps1": "candidate_ps1",
+    ...          "xmatch": "cross_match"})
+    >>> df.printSchema()
+    root
+     |-- objectId: string (nullable = true)
+     |-- candidate: struct (nullable = false)
+     |    |-- ra: double (nullable = true)
+     |    |-- ps1: struct (nullable = false)
+     |    |    |-- sgscore: double (nullable = true)
+     |-- xmatch: struct (nullable = false)
+     |    |-- alerts_per_batch: string (nullable = true)
+     |    |-- score: double (nullable = true)
+    <BLANKLINE>
+    >>> df.select("candidate.ps1.sgscore").collect()[0][0]
+    0.5
+    """
+    if isinstance(spec, (list, tuple)):
+        spec = {prefix: prefix for prefix in spec}
+
+    # longest prefixes first, such that nested prefixes win
+    prefixes = sorted(spec.items(), key=lambda x: -len(x[1]))
+
+    # fields of each struct, in the order of the columns
+    fields = {name: [] for name in spec}
+    flat_cols = []
+    for colname in df.columns:
+        for name, prefix in prefixes:
+            if colname.startswith(prefix + "_"):
+                fields[name].append(
+                    col("`{}`".format(colname)).alias(
+                        colname[len(prefix) + 1:]))
+                break
+        else:
+            flat_cols.append(col("`{}`".format(colname)))
+
+    # nested structs, in the order of the spec (parents are created if
+    # they are not in the spec)
+    children = {}
+    for name in list(spec):
+        while "." in name:
+            parent = name.rsplit(".", 1)[0]
+            children.setdefault(parent, [])
+            if name not in children[parent]:
+                children[parent].append(name)
+            fields.setdefault(parent, [])
+            name = parent
+
+    def build(name):
+        nested = [build(child) for child in children.get(name, [])]
+        nested = [x for x in nested if x is not None]
+        if len(fields[name]) + len(nested) == 0:
+            # no columns for this struct
+            return None
+        return struct(*(fields[name] + nested)).alias(name.split(".")[-1])
+
+    structs = [build(name) for name in fields if "." not in name]
+    return df.select(flat_cols + [x for x in structs if x is not None])
+
 def group_df_into_struct(df: DataFrame, colfamily: str, key: str) -> DataFrame:
     """Group columns of a df into a struct column
 
-    *Note*
-    Currently, the dataframe is transformed by splitting it into
-    two dataframes, reshaping one of them and then using a join.
-    This might consume more resources than necessary and should be
-    optimized in the future if required.
-
     If we have a df with the following schema:
     root
      |-- objectId: string (nullable = true)
@@ -374,6 +1148,9 @@ def group_df_into_struct(df: DataFrame, colfamily: str, key: str) -> DataFrame:
      |    |-- ra: double (nullable = true)
      |    |-- dec: double (nullable = true)
 
+    This is a single projection (see group_df_into_structs): no join
+    is involved, and rows are kept as is whatever the values of `key`.
+
     Parameters
     ----------
     df: Spark DataFrame
@@ -381,7 +1158,7 @@ def group_df_into_struct(df: DataFrame, colfamily: str, key: str) -> DataFrame:
     colfamily: str
         prefix of columns to be grouped into a struct
     key: str
-        a column with unique values (used for join)
+        a column identifying the rows. Unused, kept for compatibility.
 
     Returns
     ----------
@@ -419,38 +1196,7 @@ def group_df_into_struct(df: DataFrame, colfamily: str, key: str) -> DataFrame:
     <BLANKLINE>
 
     """
-    struct_cols = []
-    flat_cols = []
-
-    pos = len(colfamily) + 1
-
-    for col in df.columns:
-        if col.startswith(colfamily + "_"):
-            struct_cols.append(col)
-        else:
-            flat_cols.append(col)
-
-    # dataframe with columns other than 'columnFamily_*'
-    df1 = df.select(flat_cols)
-
-    new_col_names = []
-    new_col_names.append(key)
-
-    # dataframe with key + 'columnFamily_*'
-    df2 = df.select(new_col_names + struct_cols)
-
-    struct_cols = [x[pos:] for x in struct_cols]
-
-    new_col_names.extend(struct_cols)
-    df2_renamed = df2.toDF(*new_col_names)
-
-    # Group 'columnFamily_*' into a struct
-    df2_struct = df2_renamed.select(key, struct(*struct_cols).alias(colfamily))
-
-    # join the two dataframes based on 'key'
-    df_new = df1.join(df2_struct, key)
-
-    return df_new
+    return group_df_into_structs(df, {colfamily: colfamily})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,598 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Client to fetch alerts from the HBase science table by objectId or
+candid, without Spark.
+
+Rows are fetched with batched multi-gets (rowkeys known) or prefix scans
+(e.g. all alerts of an object with salted rowkeys), with the rowkeys built
+as hbaseUtils.salted_rowkey does, through a bounded pool of connections, and
+decoded with the catalog of the table
+(see hbaseUtils.construct_hbase_catalog_from_flatten_schema). Decoded rows
+can be kept in a LRU cache.
+
+Two backends are available: HappyBaseBackend (HBase Thrift server, requires
+happybase), and InMemoryBackend, an in-process stand-in for tests and
+benchmarks.
+"""
+import io
+import json
+import queue
+import struct
+import bisect
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fastavro
+import pandas as pd
+
+from fink_broker.hbaseUtils import rowkey_from_values
+from fink_broker.tester import regular_unit_tests
+
+# struct formats of the HBase encoding (Bytes.toBytes) of primitive types
+HBASE_FORMATS = {
+    "long": ">q", "integer": ">i", "short": ">h", "double": ">d",
+    "float": ">f", "timestamp": ">q"
+}
+
+def encode_value(value, datatype: str) -> bytes:
+    """ Encode a value as HBase does (Bytes.toBytes).
+
+    Parameters
+    ----------
+    value: object
+        Value to encode.
+    datatype: str
+        Type of the column in the catalog.
+
+    Returns
+    ----------
+    out: bytes
+
+    Examples
+    ----------
+    >>> encode_value(1, "long")
+    b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01'
+    >>> encode_value(True, "boolean")
+    b'\\xff'
+    """
+    if datatype in HBASE_FORMATS:
+        return struct.pack(HBASE_FORMATS[datatype], value)
+    if datatype == "boolean":
+        return b"\xff" if value else b"\x00"
+    if datatype == "byte":
+        return struct.pack(">b", value)
+    if datatype == "binary":
+        return bytes(value)
+    return str(value).encode("utf-8")
+
+def decode_value(data: bytes, datatype: str):
+    """ Decode a value encoded by HBase (Bytes.toBytes).
+
+    Parameters
+    ----------
+    data: bytes
+        Encoded value.
+    datatype: str
+        Type of the column in the catalog.
+
+    Returns
+    ----------
+    out: object
+
+    Examples
+    ----------
+    >>> decode_value(encode_value(17.5, "double"), "double")
+    17.5
+    >>> decode_value(b"ZTF19acmdpyr", "string")
+    'ZTF19acmdpyr'
+    """
+    if datatype in HBASE_FORMATS:
+        return struct.unpack(HBASE_FORMATS[datatype], data)[0]
+    if datatype == "boolean":
+        return data != b"\x00"
+    if datatype == "byte":
+        return struct.unpack(">b", data)[0]
+    if datatype == "binary":
+        return data
+    return data.decode("utf-8")
+
+class CatalogCodec(object):
+    """ Encode and decode the rows of a HBase table, following its catalog.
+
+    Avro-encoded columns (arrays, see hbaseUtils.encode_arrays) are decoded
+    with their schema in the catalog.
+
+    Parameters
+    ----------
+    catalog: str
+        HBase catalog (JSON).
+
+    Examples
+    ----------
+    >>> codec = CatalogCodec(test_catalog)
+    >>> codec.tablename
+    'default:test_science'
+    >>> key, cells = codec.encode_row(test_rows[0])
+    >>> codec.decode_row(key, cells) == test_rows[0]
+    True
+    """
+    def __init__(self, catalog: str):
+        catalog = json.loads(catalog)
+        self.tablename = "{}:{}".format(
+            catalog["table"]["namespace"], catalog["table"]["name"])
+        self.rowkey = catalog["rowkey"]
+
+        self.columns = {}
+        self.keytype = "string"
+        self.schemas = {}
+        for name, column in catalog["columns"].items():
+            if column["cf"] == "rowkey":
+                self.keytype = column["type"]
+                continue
+            cell = "{}:{}".format(column["cf"], column["col"]).encode("utf-8")
+            self.columns[cell] = (name, column["type"])
+            if column.get("encoding") == "avro":
+                self.schemas[name] = fastavro.parse_schema(
+                    json.loads(column["avroSchema"]))
+
+    def encode_key(self, value) -> bytes:
+        """ Encoded rowkey """
+        return encode_value(value, self.keytype)
+
+    def encode_row(self, row: dict) -> (bytes, dict):
+        """ Encoded rowkey and cells of a row (null values are skipped) """
+        cells = {}
+        for cell, (name, datatype) in self.columns.items():
+            value = row.get(name)
+            if value is None:
+                continue
+            if name in self.schemas:
+                buffer = io.BytesIO()
+                fastavro.schemaless_writer(buffer, self.schemas[name], value)
+                cells[cell] = buffer.getvalue()
+            else:
+                cells[cell] = encode_value(value, datatype)
+        return self.encode_key(row[self.rowkey]), cells
+
+    def decode_row(self, key: bytes, cells: dict) -> dict:
+        """ Decoded row from its rowkey and cells """
+        row = {self.rowkey: decode_value(key, self.keytype)}
+        for cell, data in cells.items():
+            if cell not in self.columns:
+                continue
+            name, datatype = self.columns[cell]
+            if name in self.schemas:
+                row[name] = fastavro.schemaless_reader(
+                    io.BytesIO(data), self.schemas[name])
+            else:
+                row[name] = decode_value(data, datatype)
+        return row
+
+    def cells(self, names: list = None) -> list:
+        """ Cells (family:qualifier) of columns, all if names is None """
+        if names is None:
+            return None
+        return [
+            cell for cell, (name, _) in self.columns.items() if name in names]
+
+class LRUCache(object):
+    """ Bounded cache keeping the most recently used entries.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries.
+
+    Examples
+    ----------
+    >>> cache = LRUCache(2)
+    >>> cache.put("a", 1); cache.put("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.put("c", 3)
+    >>> cache.get("b") is None
+    True
+    >>> cache.hits, cache.misses
+    (1, 1)
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+class InMemoryTable(object):
+    """ In-memory HBase table, with the (subset of the) happybase Table
+    interface used by ScienceClient. Rows are kept sorted by rowkey.
+    """
+    def __init__(self):
+        self._keys = []
+        self._rows = {}
+        self.requests = 0
+
+    def put(self, key: bytes, cells: dict):
+        if key not in self._rows:
+            bisect.insort(self._keys, key)
+            self._rows[key] = {}
+        self._rows[key].update(cells)
+
+    def _select(self, key: bytes, columns: list) -> dict:
+        cells = self._rows[key]
+        if columns is None:
+            return dict(cells)
+        return {c: v for c, v in cells.items() if c in columns}
+
+    def rows(self, keys: list, columns: list = None) -> list:
+        """ Multi-get: (rowkey, cells) of the existing rows """
+        self.requests += 1
+        return [
+            (key, self._select(key, columns))
+            for key in keys if key in self._rows]
+
+    def scan(
+            self, row_prefix: bytes = None, columns: list = None,
+            batch_size: int = 1000):
+        """ (rowkey, cells) of the rows starting with row_prefix. One
+        request is counted per batch_size rows (scanner caching).
+        """
+        prefix = row_prefix or b""
+        start = bisect.bisect_left(self._keys, prefix)
+        self.requests += 1
+        count = 0
+        for key in self._keys[start:]:
+            if not key.startswith(prefix):
+                break
+            count += 1
+            if count % batch_size == 0:
+                self.requests += 1
+            yield key, self._select(key, columns)
+
+class InMemoryBackend(object):
+    """ In-process stand-in for HBase, with a bounded pool of connections.
+
+    Parameters
+    ----------
+    poolsize: int, optional
+        Maximum number of connections used at the same time. Default is 4.
+    """
+    def __init__(self, poolsize: int = 4):
+        self.tables = {}
+        self._pool = queue.Queue(poolsize)
+        for _ in range(poolsize):
+            self._pool.put(self)
+
+    def table(self, name: str) -> InMemoryTable:
+        if name not in self.tables:
+            self.tables[name] = InMemoryTable()
+        return self.tables[name]
+
+    @contextmanager
+    def connection(self):
+        """ Connection from the pool (blocks if all are in use) """
+        connection = self._pool.get()
+        try:
+            yield connection
+        finally:
+            self._pool.put(connection)
+
+class HappyBaseBackend(object):
+    """ HBase Thrift server, through a bounded pool of happybase
+    connections.
+
+    Parameters
+    ----------
+    host: str
+        Host of the HBase Thrift server.
+    port: int, optional
+        Port of the HBase Thrift server. Default is 9090.
+    poolsize: int, optional
+        Maximum number of connections. Default is 4.
+    """
+    def __init__(self, host: str, port: int = 9090, poolsize: int = 4):
+        import happybase
+        self._pool = happybase.ConnectionPool(poolsize, host=host, port=port)
+
+    def connection(self):
+        """ Connection from the pool (blocks if all are in use) """
+        return self._pool.connection()
+
+class ScienceClient(object):
+    """ Fetch alerts from the HBase science table by objectId or candid.
+
+    Parameters
+    ----------
+    backend: InMemoryBackend or HappyBaseBackend
+        Connections to HBase.
+    catalog: str
+        HBase catalog of the table.
+    keycolumns: list of str, optional
+        Columns of the rowkeys (SCIENCE_DB_ROWKEY, see
+        hbaseUtils.science_rowkey). Default is None, that is the rowkey
+        column of the catalog.
+    nbuckets: int, optional
+        Number of salt buckets of the rowkeys (SCIENCE_DB_SALT_BUCKETS, see
+        hbaseUtils.salted_rowkey). Default is 0 (no salt).
+    batchsize: int, optional
+        Number of rowkeys per multi-get, and rows per scanner request.
+        Default is 100.
+    cachesize: int, optional
+        Maximum number of decoded rows in the LRU cache. Default is 0
+        (no cache).
+
+    Examples
+    ----------
+    >>> backend = InMemoryBackend()
+    >>> client = ScienceClient(backend, test_catalog, cachesize=100)
+    >>> client.put(test_rows)
+
+    Alerts by candid (multi-get)
+    >>> df = client.get_by_candid([2, 1, 5])
+    >>> df["candid"].tolist(), df["objectId"].tolist()
+    ([2, 1], ['ZTF19a', 'ZTF19a'])
+
+    Second lookup from the cache
+    >>> requests = backend.table(client.codec.tablename).requests
+    >>> df = client.get_by_candid([1, 2], columns=["objectId"])
+    >>> backend.table(client.codec.tablename).requests == requests
+    True
+    >>> list(df.columns)
+    ['candid', 'objectId']
+
+    The rowkeys do not start with objectId
+    >>> client.get_by_objectid(["ZTF19a"])
+    Traceback (most recent call last):
+    ...
+    ValueError: Rows cannot be searched by objectId: the rowkeys start with candid
+
+    Salted rowkeys starting with objectId (prefix scan)
+    >>> client = ScienceClient(
+    ...     backend, test_catalog_salted, ["objectId", "candid"], nbuckets=4)
+    >>> client.put(test_rows)
+    >>> df = client.get_by_objectid(["ZTF19a"])
+    >>> df["candid"].tolist()
+    [1, 2]
+    >>> df["prv_candidates_magpsf"].values[1]
+    [18.0, None]
+
+    Salted candid rowkeys (multi-get)
+    >>> client = ScienceClient(
+    ...     InMemoryBackend(), test_catalog_salted, ["candid"], nbuckets=4)
+    >>> client.put(test_rows)
+    >>> client.get_by_candid([2, 1, 5])["candid"].tolist()
+    [2, 1]
+    """
+    def __init__(
+            self, backend, catalog: str, keycolumns: list = None,
+            nbuckets: int = 0, batchsize: int = 100, cachesize: int = 0):
+        self.backend = backend
+        self.codec = CatalogCodec(catalog)
+        self.keycolumns = [
+            c.replace(".", "_") for c in keycolumns or [self.codec.rowkey]]
+        self.nbuckets = nbuckets
+        self.batchsize = batchsize
+        self.cache = LRUCache(cachesize) if cachesize > 0 else None
+
+    def _to_dataframe(self, rows: list, columns: list = None):
+        """ pandas DataFrame of decoded rows """
+        df = pd.DataFrame(rows)
+        if columns is not None:
+            names = [self.codec.rowkey] + [
+                c for c in columns if c != self.codec.rowkey]
+            df = df.reindex(columns=names)
+        return df
+
+    def rowkey(self, values: list, complete: bool = True):
+        """ Rowkey of the rows whose first key columns have the given
+        values, or their prefix if `complete` is False (see
+        hbaseUtils.rowkey_from_values).
+        """
+        if self.keycolumns == [self.codec.rowkey] and self.nbuckets == 0:
+            return values[0]
+        return rowkey_from_values(values, self.nbuckets, complete)
+
+    def put(self, rows: list):
+        """ Write rows (dict) to the table, e.g. to fill a test backend.
+        Missing rowkeys are built from the key columns.
+        """
+        with self.backend.connection() as connection:
+            table = connection.table(self.codec.tablename)
+            for row in rows:
+                if self.codec.rowkey not in row:
+                    row = dict(row)
+                    row[self.codec.rowkey] = self.rowkey(
+                        [row[c] for c in self.keycolumns])
+                key, cells = self.codec.encode_row(row)
+                table.put(key, cells)
+
+    def get(self, keys: list, columns: list = None) -> pd.DataFrame:
+        """ Rows by rowkey, with batched multi-gets.
+
+        Parameters
+        ----------
+        keys: list
+            Values of the rowkey column.
+        columns: list of str, optional
+            Columns to fetch. Default is None (all columns).
+
+        Returns
+        ----------
+        df: pandas.DataFrame
+            Rows found, in the order of `keys`.
+        """
+        # Cached rows can be used if they have all the requested columns
+        found = {}
+        missing = []
+        for key in keys:
+            entry = self.cache.get(key) if self.cache else None
+            if entry is not None and (entry[1] or columns is not None and all(
+                    c in entry[0] for c in columns)):
+                found[key] = entry[0]
+            else:
+                missing.append(key)
+
+        cells = self.codec.cells(columns)
+        with self.backend.connection() as connection:
+            table = connection.table(self.codec.tablename)
+            for start in range(0, len(missing), self.batchsize):
+                batch = missing[start: start + self.batchsize]
+                encoded = [self.codec.encode_key(key) for key in batch]
+                for rowkey, data in table.rows(encoded, columns=cells):
+                    row = self.codec.decode_row(rowkey, data)
+                    key = row[self.codec.rowkey]
+                    found[key] = row
+                    if self.cache:
+                        self.cache.put(key, (row, columns is None))
+
+        rows = [found[key] for key in keys if key in found]
+        return self._to_dataframe(rows, columns)
+
+    def _lookup(self, name: str, values: list, columns: list = None):
+        """ Rows whose column `name` has one of the values, if it is the
+        first key column: with multi-gets if it is the only one, with a
+        scan of the prefix of each value otherwise.
+        """
+        if self.keycolumns[0] != name:
+            raise ValueError(
+                "Rows cannot be searched by {}: the rowkeys start with {}"
+                .format(name, self.keycolumns[0]))
+
+        if len(self.keycolumns) == 1:
+            keys = [self.rowkey([value]) for value in values]
+            return self.get(keys, columns)
+
+        prefixes = [self.rowkey([value], complete=False) for value in values]
+        return self.scan_prefix(prefixes, columns)
+
+    def get_by_candid(self, candids: list, columns: list = None):
+        """ Alerts by candid, if the rowkeys start with candid.
+
+        Parameters
+        ----------
+        candids: list of int
+            candid of the alerts.
+        columns: list of str, optional
+            Columns to fetch. Default is None (all columns).
+
+        Returns
+        ----------
+        df: pandas.DataFrame
+        """
+        return self._lookup("candid", candids, columns)
+
+    def scan_prefix(
+            self, prefixes: list, columns: list = None) -> pd.DataFrame:
+        """ Rows whose rowkeys start with one of the prefixes, with scanner
+        caching (batchsize rows per request).
+
+        Parameters
+        ----------
+        prefixes: list of str
+            Prefixes of the rowkeys.
+        columns: list of str, optional
+            Columns to fetch. Default is None (all columns).
+
+        Returns
+        ----------
+        df: pandas.DataFrame
+        """
+        cells = self.codec.cells(columns)
+        rows = []
+        with self.backend.connection() as connection:
+            table = connection.table(self.codec.tablename)
+            for prefix in prefixes:
+                scanner = table.scan(
+                    row_prefix=prefix.encode("utf-8"), columns=cells,
+                    batch_size=self.batchsize)
+                rows += [
+                    self.codec.decode_row(rowkey, data)
+                    for rowkey, data in scanner]
+        return self._to_dataframe(rows, columns)
+
+    def get_by_objectid(self, objectids: list, columns: list = None):
+        """ Alerts of objects, if the rowkeys start with objectId (e.g.
+        objectId_jd, salted or not, see hbaseUtils.salted_rowkey): the
+        alerts of each object are read with a scan of its prefix.
+
+        Parameters
+        ----------
+        objectids: list of str
+            objectId of the objects.
+        columns: list of str, optional
+            Columns to fetch. Default is None (all columns).
+
+        Returns
+        ----------
+        df: pandas.DataFrame
+        """
+        return self._lookup("objectId", objectids, columns)
+
+
+if __name__ == "__main__":
+    """ Execute the test suite """
+    globs = globals()
+
+    # Catalog of a test table keyed by candid, with an Avro-encoded array
+    schema = json.dumps([{
+        "type": "array", "items": ["double", "null"]}, "null"])
+    globs["test_catalog"] = json.dumps({
+        "table": {"namespace": "default", "name": "test_science"},
+        "rowkey": "candid",
+        "columns": {
+            "candid": {"cf": "rowkey", "col": "candid", "type": "long"},
+            "objectId": {"cf": "i", "col": "objectId", "type": "string"},
+            "candidate_jd": {"cf": "i", "col": "candidate_jd", "type": "double"},
+            "prv_candidates_magpsf": {
+                "cf": "h", "col": "prv_candidates_magpsf", "type": "binary",
+                "encoding": "avro", "avroSchema": schema}}})
+    # Same table with string rowkeys (e.g. salted, see salted_rowkey)
+    catalog = json.loads(globs["test_catalog"])
+    catalog["rowkey"] = "rowkey"
+    catalog["columns"]["rowkey"] = {
+        "cf": "rowkey", "col": "rowkey", "type": "string"}
+    catalog["columns"]["candid"] = {
+        "cf": "i", "col": "candid", "type": "long"}
+    globs["test_catalog_salted"] = json.dumps(catalog)
+
+    globs["test_rows"] = [
+        {
+            "candid": 1, "objectId": "ZTF19a", "candidate_jd": 2458790.5,
+            "prv_candidates_magpsf": [18.0]},
+        {
+            "candid": 2, "objectId": "ZTF19a", "candidate_jd": 2458791.5,
+            "prv_candidates_magpsf": [18.0, None]},
+        {
+            "candid": 3, "objectId": "ZTF19b", "candidate_jd": 2458790.5,
+            "prv_candidates_magpsf": None}]
+
+    # Run the regular test suite
+    regular_unit_tests(globs)
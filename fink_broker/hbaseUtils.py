@@ -13,14 +13,66 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from pyspark.sql import DataFrame
-from pyspark.mllib.common import _java2py
+from pyspark.sql.column import Column
+from pyspark.sql.functions import col, lit, when, concat_ws, format_string
+from pyspark.sql.functions import lpad
+from pyspark.sql.functions import crc32, pmod
+from pyspark.sql.types import DoubleType, FloatType, StringType
+from pyspark.sql.types import BooleanType, BinaryType
+from pyspark.sql.types import ArrayType, MapType, StructType, AtomicType
+from pyspark.sql.types import LongType, IntegerType, ShortType
+from pyspark.sql.streaming import DataStreamWriter
+
+from py4j.java_gateway import JavaPackage
 
 import os
+import json
+import time
+import zlib
+import numbers
+from functools import reduce
 
-from fink_broker.sparkUtils import get_spark_context
+from fink_broker.sparkUtils import get_spark_context, to_avro, from_avro
 from fink_broker.tester import spark_unit_tests
 
-def flatten_ztf_dataframe(df: DataFrame) -> DataFrame:
+# Batched HBase streaming sink of the fink_broker jar
+HBASE_SINK_FORMAT = "HBase.HBaseBatchedSinkProvider"
+
+# Column families of the alert data, by access pattern: (prefix, family).
+# Cutouts and histories are large and read on demand only.
+HBASE_DEFAULT_FAMILY = "i"
+HBASE_FAMILIES = [
+    ("cutout", "b"),
+    ("prv_candidates_", "h"),
+    ("lc_", "h")
+]
+
+# Avro types of the Spark primitive types (see avro_array_schema)
+AVRO_PRIMITIVES = {
+    "boolean": "boolean", "integer": "int", "long": "long",
+    "float": "float", "double": "double", "string": "string",
+    "binary": "bytes", "short": "int", "byte": "int"
+}
+
+# Layout of the rowkeys (see salted_rowkey)
+# Values replacing nulls in the flattened columns, by type. Other types
+# (except nested structs) have no resolver.
+FALLBACK_VALUES = {
+    StringType: "",
+    LongType: 0,
+    DoubleType: 0.,
+    FloatType: 0.,
+    IntegerType: 0,
+    BooleanType: True,
+    BinaryType: bytearray()
+}
+
+ROWKEY_SEPARATOR = "_"
+ROWKEY_FLOAT_WIDTH = 20
+ROWKEY_FLOAT_DECIMALS = 8
+ROWKEY_INT_WIDTH = 20
+
+def flatten_ztf_dataframe(df: DataFrame, typed: bool = False) -> DataFrame:
     """Flatten a nested DataFrame containing ZTF alert data.
 
     The input DataFrame is supposed to have the alert data (as was sent by
@@ -43,6 +95,11 @@ def flatten_ztf_dataframe(df: DataFrame) -> DataFrame:
     ----------
     df : DataFrame
         Input DataFrame containing ZTF alert data.
+    typed : bool, optional
+        If True, prv_candidates is split into one typed array per field
+        (see splitarrayofstruct), with one row per alert. Otherwise it is
+        exploded into string columns (see explodearrayofstruct).
+        Default is False.
 
     Returns
     -------
@@ -59,23 +116,87 @@ def flatten_ztf_dataframe(df: DataFrame) -> DataFrame:
 
     # Flatten the DataFrame
     >>> df_flat = flatten_ztf_dataframe(df_ok)
+
+    # One row per alert, with typed arrays
+    >>> df_typed = flatten_ztf_dataframe(df_ok, typed=True)
+    >>> df_typed.count() == df_ok.count()
+    True
     """
-    # Flatten the "struct" columns
+    # Flatten the "struct" columns, in a single projection
     struct_cols = [
         "candidate", "cutoutScience", "cutoutTemplate", "cutoutDifference"]
 
-    for column in struct_cols:
-        df = flattenstruct(df, column)
+    df = flattenstructs(df, struct_cols)
 
-    # Explode the "array" columns
+    # Explode (or split) the "array" columns
     array_cols = ["prv_candidates"]
     for column in array_cols:
-        df = explodearrayofstruct(df, column)
+        if typed:
+            df = splitarrayofstruct(df, column)
+        else:
+            df = explodearrayofstruct(df, column)
 
     return df
 
+def column_family(name: str, families: list = None) -> str:
+    """ Column family of a column, from the prefixes of its name.
+
+    Parameters
+    ----------
+    name : str
+        Name of the column.
+    families : list of (str, str), optional
+        (prefix, family) rules, the first matching prefix wins. Default is
+        None, that is all columns in HBASE_DEFAULT_FAMILY.
+
+    Returns
+    ----------
+    family : str
+
+    Examples
+    --------
+    >>> column_family("prv_candidates_magpsf", HBASE_FAMILIES)
+    'h'
+    >>> column_family("candidate_ra", HBASE_FAMILIES)
+    'i'
+    """
+    for prefix, family in families or []:
+        if name.startswith(prefix):
+            return family
+    return HBASE_DEFAULT_FAMILY
+
+def avro_array_schema(datatype: ArrayType, nullable: bool = True) -> str:
+    """ Avro schema of the encoding of an array column by to_avro
+    (following the type conversion of spark-avro).
+
+    Parameters
+    ----------
+    datatype : ArrayType
+        Array of primitive types.
+    nullable : bool, optional
+        Whether the column is nullable. Default is True.
+
+    Returns
+    ----------
+    schema : str
+        Avro schema (JSON).
+
+    Examples
+    --------
+    >>> avro_array_schema(ArrayType(DoubleType(), True))
+    '[{"type": "array", "items": ["double", "null"]}, "null"]'
+    """
+    element = AVRO_PRIMITIVES[datatype.elementType.typeName()]
+    if datatype.containsNull:
+        element = [element, "null"]
+    schema = {"type": "array", "items": element}
+    if nullable:
+        schema = [schema, "null"]
+    return json.dumps(schema)
+
 def construct_hbase_catalog_from_flatten_schema(
-        schema: dict, catalogname: str, rowkey: str) -> str:
+        schema: dict, catalogname: str, rowkey: str,
+        families: list = None, arrays: str = "string") -> str:
     """ Convert a flatten DataFrame schema into a HBase catalog.
     See flatten_ztf_dataframe for more information.
 
@@ -85,6 +206,8 @@ def construct_hbase_catalog_from_flatten_schema(
     To
     'schemavsn': {'cf': 'i', 'col': 'schemavsn', 'type': 'string'},
 
+    Primitive columns are stored with their native binary encoding.
+
     Parameters
     ----------
     schema : dict
@@ -93,6 +216,13 @@ def construct_hbase_catalog_from_flatten_schema(
         Name of the HBase catalog.
     rowkey : str
         Name of the rowkey in the HBase catalog.
+    families : list of (str, str), optional
+        (prefix, family) rules grouping the columns into column families,
+        e.g. HBASE_FAMILIES. Default is None, that is all columns in
+        HBASE_DEFAULT_FAMILY.
+    arrays : str, optional
+        Encoding of the array columns: string (text), or avro (compact
+        binary, see encode_arrays and decode_arrays). Default is string.
 
     Returns
     ----------
@@ -112,56 +242,486 @@ def construct_hbase_catalog_from_flatten_schema(
 
     >>> catalog = construct_hbase_catalog_from_flatten_schema(
     ...     df_flat.schema, "toto", "timestamp")
+
+    # Typed arrays, stored in Avro, in their own column family
+    >>> df_typed = flatten_ztf_dataframe(df_ok, typed=True)
+    >>> catalog = construct_hbase_catalog_from_flatten_schema(
+    ...     df_typed.schema, "toto", "candid", HBASE_FAMILIES, "avro")
+    >>> column = json.loads(catalog)["columns"]["prv_candidates_magpsf"]
+    >>> column["cf"], column["type"], column["encoding"]
+    ('h', 'binary', 'avro')
     """
-    schema_columns = schema.jsonValue()["fields"]
-
-    catalog = ''.join("""
-    {{
-        'table': {{
-            'namespace': 'default',
-            'name': '{}'
-        }},
-        'rowkey': '{}',
-        'columns': {{
-    """).format(catalogname, rowkey)
-
-    for column in schema_columns:
-        # Last entry should not have comma (malformed json)
-        if schema_columns.index(column) != len(schema_columns) - 1:
-            sep = ","
+    columns = {}
+    for field in schema.fields:
+        column = {"col": field.name, "type": field.dataType.typeName()}
+        if field.name == rowkey:
+            column["cf"] = "rowkey"
         else:
-            sep = ""
+            column["cf"] = column_family(field.name, families)
 
         # Deal with array
-        if type(column["type"]) == dict:
-            column["type"] = "string" # column["type"]["type"]
+        if isinstance(field.dataType, ArrayType) and arrays == "avro":
+            column["type"] = "binary"
+            column["encoding"] = "avro"
+            column["avroSchema"] = avro_array_schema(
+                field.dataType, field.nullable)
+        elif isinstance(field.dataType, (ArrayType, MapType, StructType)):
+            column["type"] = "string"
 
-        if type(column["type"]) == 'timestamp':
-            column["type"] = "string" # column["type"]["type"]
+        columns[field.name] = column
 
-        if column["name"] == rowkey:
-            catalog += """
-            '{}': {{'cf': 'rowkey', 'col': '{}', 'type': '{}'}}{}
-            """.format(column["name"], column["name"], column["type"], sep)
-        else:
-            catalog += """
-            '{}': {{'cf': 'i', 'col': '{}', 'type': '{}'}}{}
-            """.format(column["name"], column["name"], column["type"], sep)
-    catalog += """
-        }
+    catalog = {
+        "table": {"namespace": "default", "name": catalogname},
+        "rowkey": rowkey,
+        "columns": columns
     }
+
+    return json.dumps(catalog)
+
+def encode_arrays(df: DataFrame) -> DataFrame:
+    """ Encode the array columns of a DataFrame into Avro (binary), to be
+    stored in HBase with a catalog built with arrays="avro".
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with arrays of primitive types.
+
+    Returns
+    ----------
+    df : DataFrame
+        DataFrame with binary columns instead of arrays.
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame([(1, [18.5, None])], ["candid", "magpsf"])
+    >>> encode_arrays(df).schema["magpsf"].dataType.typeName()
+    'binary'
+    """
+    return df.select([
+        to_avro(col(field.name)).alias(field.name)
+        if isinstance(field.dataType, ArrayType) else col(field.name)
+        for field in df.schema.fields])
+
+def decode_arrays(df: DataFrame, hbcatalog: str) -> DataFrame:
+    """ Decode the Avro-encoded columns of a DataFrame read from HBase.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame read with the catalog.
+    hbcatalog : str
+        HBase catalog (see construct_hbase_catalog_from_flatten_schema).
+
+    Returns
+    ----------
+    df : DataFrame
+        DataFrame with arrays.
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame([(1, [18.5, None])], ["candid", "magpsf"])
+    >>> catalog = construct_hbase_catalog_from_flatten_schema(
+    ...     df.schema, "test", "candid", arrays="avro")
+    >>> decode_arrays(encode_arrays(df), catalog).first()["magpsf"]
+    [18.5, None]
+    """
+    columns = json.loads(hbcatalog)["columns"]
+    return df.select([
+        from_avro(col(name), columns[name]["avroSchema"]).alias(name)
+        if columns.get(name, {}).get("encoding") == "avro" else col(name)
+        for name in df.columns])
+
+def salt_bucket(value: str, nbuckets: int) -> str:
+    """ Salt bucket of a value, as computed by salted_rowkey.
+
+    Parameters
+    ----------
+    value : str
+        Value of the salted column (e.g. objectId).
+    nbuckets : int
+        Number of salt buckets.
+
+    Returns
+    ----------
+    bucket : str
+        Zero-padded bucket number.
+
+    Examples
+    --------
+    >>> salt_bucket("ZTF19acmdpyr", 16)
+    '06'
+    """
+    width = len(str(nbuckets - 1))
+    bucket = zlib.crc32(value.encode("utf-8")) % nbuckets
+    return str(bucket).zfill(width)
+
+def _key_part(column: str, datatype) -> Column:
+    """ Column formatted such that the lexicographic order of the rowkeys
+    follows the order of its (non-negative) values.
+    """
+    if isinstance(datatype, (DoubleType, FloatType)):
+        return format_string("%0{}.{}f".format(
+            ROWKEY_FLOAT_WIDTH, ROWKEY_FLOAT_DECIMALS), col(column))
+    if isinstance(datatype, (LongType, IntegerType, ShortType)):
+        return format_string(
+            "%0{}d".format(ROWKEY_INT_WIDTH), col(column))
+    return col(column).cast("string")
+
+def salted_rowkey(
+        df: DataFrame, keycolumns: list, nbuckets: int = 0,
+        name: str = "rowkey") -> DataFrame:
+    """ Add a (composite, optionally salted) rowkey column.
+
+    The rowkey is <bucket>_<key1>_<key2>..., where the bucket is computed
+    from the first key column (see salt_bucket). Rows with the same first
+    key (e.g. alerts of an object) are therefore in the same bucket, while
+    successive keys (e.g. ordered in time) are spread over all buckets,
+    hence over all regions of a pre-split table (see compute_split_keys).
+    Numerical key columns are zero-padded such that rowkeys sort as values.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Input DataFrame.
+    keycolumns : list of str
+        Columns of the key (e.g. ["objectId", "jd"]). Nested fields
+        (e.g. candidate.jd) are allowed.
+    nbuckets : int, optional
+        Number of salt buckets. Default is 0 (no salt).
+    name : str, optional
+        Name of the rowkey column. Default is rowkey.
+
+    Returns
+    ----------
+    df : DataFrame
+        DataFrame with the rowkey column.
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame(
+    ...     [("ZTF19acmdpyr", 2458788.5)], ["objectId", "jd"])
+    >>> df = salted_rowkey(df, ["objectId", "jd"], nbuckets=16)
+    >>> df.select("rowkey").first()[0]
+    '06_ZTF19acmdpyr_00002458788.50000000'
+    """
+    types = {c: df.select(c).schema.fields[0].dataType for c in keycolumns}
+    parts = [_key_part(c, types[c]) for c in keycolumns]
+
+    if nbuckets > 0:
+        width = len(str(nbuckets - 1))
+        bucket = pmod(
+            crc32(col(keycolumns[0]).cast("string").cast("binary")),
+            lit(nbuckets))
+        parts.insert(0, lpad(bucket.cast("string"), width, "0"))
+
+    return df.withColumn(name, concat_ws(ROWKEY_SEPARATOR, *parts))
+
+def science_rowkey(
+        df: DataFrame, keycolumns: list, nbuckets: int = 0,
+        name: str = "rowkey") -> (DataFrame, str):
+    """ Rowkey of the science table: a single unsalted key column is used
+    as is (e.g. candid), otherwise a composite and/or salted rowkey column
+    is added (see salted_rowkey).
+
+    Parameters
+    ----------
+    df : DataFrame
+        Input DataFrame.
+    keycolumns : list of str
+        Columns of the key (e.g. ["objectId", "candidate.jd"]).
+    nbuckets : int, optional
+        Number of salt buckets. Default is 0 (no salt).
+    name : str, optional
+        Name of the added rowkey column. Default is rowkey.
+
+    Returns
+    ----------
+    df : DataFrame
+        DataFrame with the rowkey column.
+    rowkey : str
+        Name of the rowkey column.
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame(
+    ...     [("ZTF19acmdpyr", 2458788.5)], ["objectId", "jd"])
+    >>> science_rowkey(df, ["objectId"])[1]
+    'objectId'
+    >>> df, rowkey = science_rowkey(df, ["objectId"], nbuckets=16)
+    >>> df.select(rowkey).first()[0]
+    '06_ZTF19acmdpyr'
+    """
+    if len(keycolumns) == 1 and nbuckets == 0 and \
+            "." not in keycolumns[0]:
+        return df, keycolumns[0]
+    return salted_rowkey(df, keycolumns, nbuckets, name), name
+
+def compute_split_keys(
+        df: DataFrame, nregions: int, nbuckets: int = 0,
+        rowkey: str = "rowkey", fraction: float = 0.01) -> list:
+    """ Split keys to pre-split a table in `nregions` regions of similar
+    sizes, from the observed distribution of the rowkeys.
+
+    With salted rowkeys, the regions are distributed evenly over the
+    buckets, such that each bucket has its own regions. The distribution of
+    the rowkeys within the buckets is estimated from a sample.
+
+    Parameters
+    ----------
+    df : DataFrame
+        DataFrame with the rowkey column (e.g. a sample of the data).
+    nregions : int
+        Number of regions.
+    nbuckets : int, optional
+        Number of salt buckets of the rowkeys. Default is 0 (no salt).
+    rowkey : str, optional
+        Name of the rowkey column. Default is rowkey.
+    fraction : float, optional
+        Fraction of the rows sampled. Default is 0.01.
+
+    Returns
+    ----------
+    splitkeys : list of str
+        nregions - 1 sorted split keys.
+
+    Examples
+    --------
+    >>> df = spark.range(1000).selectExpr(
+    ...     "concat('ZTF', lpad(id, 4, '0')) as objectId")
+    >>> df = salted_rowkey(df, ["objectId"], nbuckets=4)
+
+    # Regions of the buckets
+    >>> compute_split_keys(df, 4, nbuckets=4)
+    ['1', '2', '3']
+
+    # Buckets split in two regions
+    >>> keys = compute_split_keys(df, 8, nbuckets=4, fraction=1.0)
+    >>> len(keys), keys[0][:2], keys[1]
+    (7, '0_', '1')
+    """
+    if nregions <= 1:
+        return []
+
+    if nbuckets > 0:
+        width = len(str(nbuckets - 1))
+        buckets = [str(i).zfill(width) for i in range(nbuckets)]
+    else:
+        buckets = [""]
+
+    # Regions per bucket (the first buckets take the remainder)
+    nper = [
+        nregions // len(buckets) + (i < nregions % len(buckets))
+        for i in range(len(buckets))]
+
+    # Buckets without regions are merged with the previous one
+    splits = [
+        bucket for bucket, n in zip(buckets, nper) if n > 0][1:]
+
+    if any(n > 1 for n in nper):
+        sample = sorted(
+            row[0] for row in df.select(rowkey)
+            .sample(fraction=fraction, seed=0).collect())
+        for bucket, n in zip(buckets, nper):
+            keys = [k for k in sample if k.startswith(bucket)]
+            if n <= 1 or len(keys) == 0:
+                continue
+            quantiles = sorted(set(
+                keys[len(keys) * i // n] for i in range(1, n)))
+            splits += [k for k in quantiles if k not in splits]
+
+    return sorted(splits)
+
+def _hfile_utils(sc):
+    """ Scala object hfileUtils, or a RuntimeError if the fink_broker jar in
+    the classpath does not have it (e.g. built before it was added).
+    """
+    obj = sc._jvm.com.astrolabsoftware.fink_broker.hfileUtils
+    if isinstance(obj, JavaPackage):
+        raise RuntimeError(
+            "hfileUtils is not in the fink_broker jar of the classpath: "
+            "build it from the sources with sbt ++2.11.8 package")
+    return obj
+
+def create_presplit_table(
+        hbcatalog: str, splitkeys: list):
+    """ Create the HBase table of a catalog, with regions starting at
+    `splitkeys` (see compute_split_keys). Nothing is done if the table
+    exists.
+
+    The routine accesses the JVM under the hood, and calls the
+    Scala routine hfileUtils.createTable. Make sure you have the fink_broker
+    jar in your classpath.
+
+    Parameters
+    ----------
+    hbcatalog : str
+        HBase catalog describing the data.
+    splitkeys : list of str
+        Split keys of the regions.
+    """
+    sc = get_spark_context()
+    keys = sc._gateway.new_array(sc._gateway.jvm.byte, len(splitkeys), 0)
+    for index, key in enumerate(splitkeys):
+        keys[index] = bytearray(key.encode("utf-8"))
+    _hfile_utils(sc).createTable(hbcatalog, keys)
+
+def salted_scan_condition(
+        nbuckets: int = 0, prefix: str = None, start: str = None,
+        stop: str = None, rowkey: str = "rowkey") -> Column:
+    """ Condition on salted rowkeys selecting a key prefix, or a range of
+    keys, in all buckets. Applied on a DataFrame read from HBase, it is
+    pushed down as one scan per bucket.
+
+    Parameters
+    ----------
+    nbuckets : int, optional
+        Number of salt buckets of the rowkeys. Default is 0 (no salt).
+    prefix : str, optional
+        Prefix of the (unsalted) keys. If the prefix contains the whole
+        first key column (e.g. objectId), prefer salted_prefix which scans a
+        single bucket.
+    start, stop : str, optional
+        Range of the (unsalted) keys, start included, stop excluded.
+    rowkey : str, optional
+        Name of the rowkey column. Default is rowkey.
+
+    Returns
+    ----------
+    condition : Column
+
+    Examples
+    --------
+    >>> df = spark.range(10).selectExpr(
+    ...     "concat('ZTF', id) as objectId", "id as jd")
+    >>> df = salted_rowkey(df, ["jd", "objectId"], nbuckets=4)
+    >>> cond = salted_scan_condition(
+    ...     nbuckets=4, start="00000000000000000003",
+    ...     stop="00000000000000000006")
+    >>> sorted(r.objectId for r in df.filter(cond).collect())
+    ['ZTF3', 'ZTF4', 'ZTF5']
     """
+    if nbuckets > 0:
+        width = len(str(nbuckets - 1))
+        salts = [
+            str(i).zfill(width) + ROWKEY_SEPARATOR for i in range(nbuckets)]
+    else:
+        salts = [""]
+
+    conditions = []
+    for salt in salts:
+        if prefix is not None:
+            conditions.append(col(rowkey).startswith(salt + prefix))
+            continue
+        condition = col(rowkey).startswith(salt)
+        if start is not None:
+            condition &= col(rowkey) >= salt + start
+        if stop is not None:
+            condition &= col(rowkey) < salt + stop
+        conditions.append(condition)
+
+    return reduce(lambda x, y: x | y, conditions)
 
-    return catalog.replace("\'", "\"")
+def salted_prefix(value: str, nbuckets: int = 0) -> str:
+    """ Rowkey prefix of the rows whose first key column is `value`
+    (e.g. all alerts of an object), to scan a single bucket.
+
+    Parameters
+    ----------
+    value : str
+        Value of the first key column.
+    nbuckets : int, optional
+        Number of salt buckets of the rowkeys. Default is 0 (no salt).
+
+    Returns
+    ----------
+    prefix : str
+
+    Examples
+    --------
+    >>> salted_prefix("ZTF19acmdpyr", 16)
+    '06_ZTF19acmdpyr_'
+    """
+    salt = salt_bucket(value, nbuckets) + ROWKEY_SEPARATOR \
+        if nbuckets > 0 else ""
+    return salt + value + ROWKEY_SEPARATOR
+
+def rowkey_from_values(
+        values: list, nbuckets: int = 0, complete: bool = True) -> str:
+    """ Rowkey built by salted_rowkey from the values of its key columns,
+    without Spark (e.g. to fetch rows from a client).
+
+    Parameters
+    ----------
+    values : list
+        Values of the key columns, in order. If `complete` is False, only
+        the first key columns can be given.
+    nbuckets : int, optional
+        Number of salt buckets of the rowkeys. Default is 0 (no salt).
+    complete : bool, optional
+        If False, return the prefix of the rowkeys starting with these
+        values (e.g. all alerts of an object). Default is True.
+
+    Returns
+    ----------
+    rowkey : str
+
+    Examples
+    --------
+    >>> rowkey_from_values(["ZTF19acmdpyr", 2458788.5], 16)
+    '06_ZTF19acmdpyr_00002458788.50000000'
+    >>> rowkey_from_values(["ZTF19acmdpyr"], 16, complete=False)
+    '06_ZTF19acmdpyr_'
+    >>> df = spark.createDataFrame([(1067374165015015007,)], ["candid"])
+    >>> key = salted_rowkey(df, ["candid"], 4).select("rowkey").first()[0]
+    >>> rowkey_from_values([1067374165015015007], 4) == key
+    True
+    """
+    parts = []
+    for value in values:
+        if isinstance(value, numbers.Integral):
+            parts.append("%0{}d".format(ROWKEY_INT_WIDTH) % value)
+        elif isinstance(value, numbers.Real):
+            parts.append("%0{}.{}f".format(
+                ROWKEY_FLOAT_WIDTH, ROWKEY_FLOAT_DECIMALS) % value)
+        else:
+            parts.append(str(value))
+
+    if nbuckets > 0:
+        parts.insert(0, salt_bucket(str(values[0]), nbuckets))
+
+    rowkey = ROWKEY_SEPARATOR.join(parts)
+    return rowkey if complete else rowkey + ROWKEY_SEPARATOR
+
+def _flattened_columns(datatype: StructType, columnname: str) -> list:
+    """ Flattened columns of a nested column (struct), at any depth of
+    nesting, named <path with _>_<field>. Null values are replaced by
+    FALLBACK_VALUES.
+    """
+    columns = []
+    for field in datatype.fields:
+        colname = "{}.`{}`".format(columnname, field.name)
+        flattenedname = "{}_{}".format(
+            columnname.replace("`", "").replace(".", "_"), field.name)
+        if type(field.dataType) in FALLBACK_VALUES:
+            fallback = lit(FALLBACK_VALUES[type(field.dataType)])\
+                .cast(field.dataType)
+            columns.append(
+                when(col(colname).isNull(), fallback)
+                .otherwise(col(colname)).alias(flattenedname))
+        elif isinstance(field.dataType, StructType):
+            # recursive descent
+            columns += _flattened_columns(field.dataType, colname)
+        else:
+            raise ValueError(
+                "Missing resolver for {} of type {}".format(
+                    colname, field.dataType.simpleString()))
+    return columns
 
 def flattenstruct(df: DataFrame, columnname: str) -> DataFrame:
     """ From a nested column (struct of primitives),
     create one column per struct element.
 
-    The routine accesses the JVM under the hood, and calls the
-    Scala routine flattenStruct. Make sure you have the fink_broker jar
-    in your classpath.
-
     Example:
     |-- candidate: struct (nullable = true)
     |    |-- jd: double (nullable = true)
@@ -204,20 +764,117 @@ def flattenstruct(df: DataFrame, columnname: str) -> DataFrame:
     >>> typeOf['candidate_ra'] == 'double'
     True
     """
-    sc = get_spark_context()
-    obj = sc._jvm.com.astrolabsoftware.fink_broker.catalogUtils
-    _df = obj.flattenStruct(df._jdf, columnname)
-    df_flatten = _java2py(sc, _df)
-    return df_flatten
+    return flattenstructs(df, [columnname])
+
+def flattenstructs(df: DataFrame, columnnames: list) -> DataFrame:
+    """ Flatten several nested columns (struct, at any depth of nesting)
+    in a single projection, instead of one projection per field. See
+    flattenstruct.
+
+    Null values of primitive types are replaced by FALLBACK_VALUES. Fields
+    of other types raise a ValueError.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Nested Spark DataFrame
+    columnnames : list of str
+        The names of the columns to flatten.
+
+    Returns
+    -------
+    DataFrame
+        Spark DataFrame with new columns from the input columns, after the
+        other columns.
+
+    Examples
+    -------
+    >>> df = spark.createDataFrame(
+    ...     [(1, (2458788.5, None, ("a", 3)))],
+    ...     "candid long, "
+    ...     "candidate struct<jd:double,fid:int,"
+    ...     "sub:struct<name:string,n:int>>")
+    >>> df_flat = flattenstructs(df, ["candidate"])
+    >>> df_flat.columns
+    ['candid', 'candidate_jd', 'candidate_fid', 'candidate_sub_name', 'candidate_sub_n']
+    >>> df_flat.first()
+    Row(candid=1, candidate_jd=2458788.5, candidate_fid=0, candidate_sub_name='a', candidate_sub_n=3)
+
+    >>> df = spark.createDataFrame([(1, ([1.5],))], "candid long, s struct<a:array<double>>")
+    >>> flattenstructs(df, ["s"])
+    Traceback (most recent call last):
+     ...
+    ValueError: Missing resolver for s.`a` of type array<double>
+    """
+    flattened = []
+    for columnname in columnnames:
+        datatype = df.schema[columnname].dataType
+        if not isinstance(datatype, StructType):
+            raise ValueError("{} is not a struct: {}".format(
+                columnname, datatype.simpleString()))
+        flattened += _flattened_columns(datatype, columnname)
+
+    others = [
+        col("`{}`".format(c)) for c in df.columns if c not in columnnames]
+    return df.select(others + flattened)
+
+def splitarrayofstruct(df: DataFrame, columnname: str) -> DataFrame:
+    """ From a nested column (array of struct), create one typed array
+    column per struct field, keeping one row per input row.
+
+    Example:
+    |    |-- prv_candidates: array (nullable = true)
+    |    |    |-- element: struct (containsNull = true)
+    |    |    |    |-- jd: double (nullable = true)
+    |    |    |    |-- fid: integer (nullable = true)
+
+    Would become:
+    |-- prv_candidates_jd: array (nullable = true)
+    |    |-- element: double (containsNull = true)
+    |-- prv_candidates_fid: array (nullable = true)
+    |    |-- element: integer (containsNull = true)
 
-def explodearrayofstruct(df: DataFrame, columnname: str) -> DataFrame:
+    Parameters
+    ----------
+    df : DataFrame
+        Input nested Spark DataFrame
+    columnname : str
+        The name of the column to split
+
+    Returns
+    -------
+    DataFrame
+        Spark DataFrame with new columns from the input column.
+
+    Examples
+    -------
+    >>> df = spark.createDataFrame(
+    ...     [(1, [(2458788.5, 1), (2458789.5, 2)])],
+    ...     "candid long, prv array<struct<jd:double,fid:int>>")
+    >>> df_split = splitarrayofstruct(df, "prv")
+    >>> df_split.columns
+    ['candid', 'prv_jd', 'prv_fid']
+    >>> df_split.first()["prv_fid"]
+    [1, 2]
+    """
+    fields = df.select(columnname).schema.fields[0]\
+        .dataType.elementType.fieldNames()
+    cnames = []
+    for name in df.columns:
+        if name == columnname:
+            cnames += [
+                col("{}.{}".format(columnname, field))
+                .alias("{}_{}".format(columnname, field))
+                for field in fields]
+        else:
+            cnames.append(col(name))
+    return df.select(cnames)
+
+def explodearrayofstruct(
+        df: DataFrame, columnname: str, keeptypes: bool = False) -> DataFrame:
     """From a nested column (array of struct),
     create one column per array element.
 
-    The routine accesses the JVM under the hood, and calls the
-    Scala routine explodeArrayOfStruct. Make sure you have the fink_broker jar
-    in your classpath.
-
     Example:
     |    |-- prv_candidates: array (nullable = true)
     |    |    |-- element: struct (containsNull = true)
@@ -236,6 +893,10 @@ def explodearrayofstruct(df: DataFrame, columnname: str) -> DataFrame:
         Input nested Spark DataFrame
     columnname : str
         The name of the column to explode
+    keeptypes : bool, optional
+        If True, the new columns keep the types of the struct fields
+        (e.g. array<double>). Otherwise they are cast to string.
+        Default is False.
 
     Returns
     -------
@@ -262,15 +923,167 @@ def explodearrayofstruct(df: DataFrame, columnname: str) -> DataFrame:
     >>> typeOf = {i.name: i.dataType.typeName() for  i in s_flat.fields}
     >>> typeOf['prv_candidates_ra'] == 'string'
     True
+
+    # Keep the types
+    >>> df_flat = explodearrayofstruct(df, "prv_candidates", keeptypes=True)
+    >>> df_flat.schema["prv_candidates_ra"].dataType.simpleString()
+    'array<double>'
     """
-    sc = get_spark_context()
-    obj = sc._jvm.com.astrolabsoftware.fink_broker.catalogUtils
-    _df = obj.explodeArrayOfStruct(df._jdf, columnname)
-    df_flatten = _java2py(sc, _df)
-    return df_flatten
+    datatype = df.schema[columnname].dataType
+    if not isinstance(datatype, ArrayType) or \
+            not isinstance(datatype.elementType, StructType):
+        raise ValueError("{} is not an array of struct: {}".format(
+            columnname, datatype.simpleString()))
+
+    cnames = []
+    for name in datatype.elementType.fieldNames():
+        column = col("{}.{}".format(columnname, name))
+        if not keeptypes:
+            column = column.cast("string")
+        cnames.append(column.alias("{}_{}".format(columnname, name)))
+
+    return df.select(
+        [col("`{}`".format(c)) for c in df.columns if c != columnname] +
+        cnames)
+
+def science_table_df(
+        df: DataFrame, keycolumns: list = ["candid"],
+        nbuckets: int = 0) -> (DataFrame, str):
+    """ Alerts of the science database, flattened for the HBase science
+    table: rowkey (see science_rowkey), flattened candidate and cutouts,
+    one typed array per field of the history (see splitarrayofstruct), and
+    other nested columns as strings.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Alerts of the science database.
+    keycolumns : list of str, optional
+        Columns of the rowkey. Default is ["candid"].
+    nbuckets : int, optional
+        Number of salt buckets of the rowkey. Default is 0 (no salt).
+
+    Returns
+    ----------
+    df : DataFrame
+        Flattened alerts.
+    rowkey : str
+        Name of the rowkey column.
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame(
+    ...     [("ZTF19a", 1, (2458788.5, 1), [(2458787.5, 2)], {"a": 1})],
+    ...     "objectId string, candid long, "
+    ...     "candidate struct<jd:double,fid:int>, "
+    ...     "prv_candidates array<struct<jd:double,fid:int>>, "
+    ...     "other map<string,int>")
+    >>> df_flat, rowkey = science_table_df(
+    ...     df, ["objectId", "candidate.jd"], nbuckets=4)
+    >>> rowkey
+    'rowkey'
+    >>> df_flat.columns
+    ['objectId', 'candid', 'prv_candidates_jd', 'prv_candidates_fid', 'other', 'rowkey', 'candidate_jd', 'candidate_fid']
+    >>> df_flat.schema["other"].dataType.typeName()
+    'string'
+    """
+    df, rowkey = science_rowkey(df, keycolumns, nbuckets)
+
+    structs = [
+        c for c in [
+            "candidate", "cutoutScience", "cutoutTemplate",
+            "cutoutDifference"] if c in df.columns]
+    df = flattenstructs(df, structs)
+    if "prv_candidates" in df.columns:
+        df = splitarrayofstruct(df, "prv_candidates")
+
+    # Other nested columns are stored as strings
+    nested = (MapType, StructType)
+    df = df.select([
+        col(field.name).cast("string")
+        if isinstance(field.dataType, nested) or (
+            isinstance(field.dataType, ArrayType) and
+            not isinstance(field.dataType.elementType, AtomicType))
+        else col(field.name)
+        for field in df.schema.fields])
+
+    return df, rowkey
+
+def science_table_catalog(
+        df: DataFrame, catalogpath: str, tablename: str,
+        rowkey: str) -> str:
+    """ HBase catalog of the science table, read from `catalogpath` if the
+    file exists. Otherwise it is built from the schema of the flattened
+    alerts (see science_table_df), with the history and the cutouts in
+    their own column families and arrays encoded in Avro, and saved there.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Flattened alerts.
+    catalogpath : str
+        Path of the catalog (local file system).
+    tablename : str
+        Name of the HBase table.
+    rowkey : str
+        Name of the rowkey column.
+
+    Returns
+    ----------
+    catalog : str
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame([(1, [1.5])], "candid long, prv_jd array<double>")
+    >>> catalog = science_table_catalog(df, "catalog_test.json", "test", "candid")
+    >>> science_table_catalog(df, "catalog_test.json", "other", "candid") == catalog
+    True
+    >>> os.remove("catalog_test.json")
+    """
+    if os.path.exists(catalogpath):
+        with open(catalogpath) as f:
+            return f.read()
+
+    catalog = construct_hbase_catalog_from_flatten_schema(
+        df.schema, tablename, rowkey, families=HBASE_FAMILIES, arrays="avro")
+    with open(catalogpath, "w") as f:
+        f.write(catalog)
+    return catalog
+
+def encode_for_catalog(df: DataFrame, hbcatalog: str) -> DataFrame:
+    """ Encode the arrays of flattened alerts as the catalog stores them:
+    in Avro, or as strings with older catalogs.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Flattened alerts.
+    hbcatalog : str
+        HBase catalog.
+
+    Returns
+    ----------
+    df : DataFrame
+
+    Examples
+    --------
+    >>> df = spark.createDataFrame([(1, [1.5])], "candid long, prv_jd array<double>")
+    >>> catalog = construct_hbase_catalog_from_flatten_schema(
+    ...     df.schema, "test", "candid")
+    >>> encode_for_catalog(df, catalog).schema["prv_jd"].dataType.typeName()
+    'string'
+    """
+    columns = json.loads(hbcatalog)["columns"].values()
+    if any(c.get("encoding") == "avro" for c in columns):
+        return encode_arrays(df)
+    return df.select([
+        col(field.name).cast("string")
+        if isinstance(field.dataType, ArrayType) else col(field.name)
+        for field in df.schema.fields])
 
 def write_to_hbase_and_monitor(
-        df: DataFrame, epochid: int, hbcatalog: str):
+        df: DataFrame, epochid: int, hbcatalog: str,
+        keycolumns: list = None, nbuckets: int = 0, newtable: int = 0):
     """Write data into HBase.
 
     The purpose of this function is to write data to HBase using
@@ -284,17 +1097,186 @@ def write_to_hbase_and_monitor(
         ID of the micro-batch
     hbcatalog : str
         HBase catalog describing the data
+    keycolumns : list of str, optional
+        Columns of the rowkey, added with science_rowkey (the rowkey of the
+        catalog must match). Default is None, that is the rowkey column is
+        already in `df`.
+    nbuckets : int, optional
+        Number of salt buckets of the rowkey. Default is 0 (no salt).
+    newtable : int, optional
+        Number of regions of the table if it does not exist (must be
+        greater than 3). The regions are split uniformly between aaaaaaa
+        and zzzzzzz, which does not suit salted rowkeys. Default is 0, that
+        is the table must exist, e.g. created with create_presplit_table.
 
     """
-    # If the table does not exist, one needs to specify
-    # the number of zones to use (must be greater than 3).
-    # TODO: remove this harcoded parameter.
+    if keycolumns is not None:
+        df, _ = science_rowkey(df, keycolumns, nbuckets)
+
+    options = {"catalog": hbcatalog}
+    if newtable > 3:
+        options["newtable"] = newtable
     df.write\
-        .options(catalog=hbcatalog, newtable=5)\
+        .options(**options)\
         .format("org.apache.spark.sql.execution.datasources.hbase")\
         .save()
 
 
+def hbase_stream_writer(
+        df: DataFrame, hbcatalog: str, checkpointpath: str,
+        buffersize: int = 8 * 1024**2, batchsize: int = 1000,
+        maxthreads: int = 8, partitionbyregion: bool = True,
+        target: str = "hbase") -> DataStreamWriter:
+    """ Streaming writer of a DataFrame to HBase, with batched Puts encoded
+    directly from the rows of each micro-batch (see the Scala
+    HBaseBatchedSinkProvider). Micro-batches already committed are skipped
+    on restart.
+
+    Make sure you have the fink_broker jar in your classpath.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Streaming DataFrame. Columns of the catalog must be of primitive
+        types (string, binary, numerical, boolean, timestamp).
+    hbcatalog : str
+        HBase catalog describing the data
+        (see construct_hbase_catalog_from_flatten_schema).
+    checkpointpath : str
+        Checkpoint location of the query.
+    buffersize : int, optional
+        Size of the mutation buffer of each task, in bytes. Default is 8MB.
+    batchsize : int, optional
+        Number of Puts handed over to the buffer at once. Default is 1000.
+    maxthreads : int, optional
+        Number of threads sending the mutations of each task to the region
+        servers. Default is 8.
+    partitionbyregion : bool, optional
+        If True, the rows are redistributed such that each task writes to a
+        single region. Default is True.
+    target : str, optional
+        hbase, or memory to write to an in-process stand-in (local master
+        only, for tests). Default is hbase.
+
+    Returns
+    -------
+    writer : DataStreamWriter
+        Writer to start.
+
+    Examples
+    -------
+    >>> df = spark.readStream.format("rate").load()
+    >>> catalog = construct_hbase_catalog_from_flatten_schema(
+    ...     df.schema, "rate", "timestamp")
+    >>> writer = hbase_stream_writer(df, catalog, "/tmp/hbase_checkpoint")
+    """
+    return df.writeStream\
+        .format(HBASE_SINK_FORMAT)\
+        .option("checkpointLocation", checkpointpath)\
+        .option("hbase.catalog", hbcatalog)\
+        .option("hbase.bufferSize", buffersize)\
+        .option("hbase.batchSize", batchsize)\
+        .option("hbase.maxThreads", maxthreads)\
+        .option("hbase.partitionByRegion", str(partitionbyregion).lower())\
+        .option("hbase.target", target)
+
+def write_hfiles(
+        df: DataFrame, hbcatalog: str, outputpath: str,
+        startkeys: list = None, timestamp: int = None) -> int:
+    """ Write a (static) DataFrame into HFiles ready for bulk load into a
+    HBase table (see bulk_load_hfiles), instead of writing Puts to the
+    region servers. Cells are sorted, and partitioned by region such that
+    each HFile belongs to a single region.
+
+    The routine accesses the JVM under the hood, and calls the
+    Scala routine hfileUtils.writeHFiles. Make sure you have the fink_broker
+    jar in your classpath.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Columns of the catalog, of primitive types.
+    hbcatalog : str
+        HBase catalog describing the data.
+    outputpath : str
+        Directory of the HFiles. It must not exist.
+    startkeys : list of bytes, optional
+        Start keys of the regions of the table (the first one is empty).
+        Default is None, that is the regions of the table of the catalog.
+    timestamp : int, optional
+        Timestamp of the cells, in milliseconds. Default is now.
+
+    Returns
+    -------
+    ncells : int
+        Number of cells written.
+
+    Examples
+    -------
+    >>> df = spark.createDataFrame([("ZTF19a", 1.5)], ["objectId", "magpsf"])
+    >>> catalog = construct_hbase_catalog_from_flatten_schema(
+    ...     df.schema, "test", "objectId")
+    >>> ncells = write_hfiles(df, catalog, "hfiles_test", startkeys=[b""])
+    >>> ncells
+    1
+    >>> [i[1:4] for i in read_hfiles("hfiles_test")]
+    [('ZTF19a', 'i', 'magpsf')]
+    """
+    sc = get_spark_context()
+    obj = _hfile_utils(sc)
+
+    if startkeys is None:
+        catalog = json.loads(hbcatalog)
+        tablename = "{}:{}".format(
+            catalog["table"]["namespace"], catalog["table"]["name"])
+        jstartkeys = obj.regionStartKeys(tablename)
+    else:
+        # byte[][] of the start keys
+        jstartkeys = sc._gateway.new_array(
+            sc._gateway.jvm.byte, len(startkeys), 0)
+        for index, key in enumerate(startkeys):
+            jstartkeys[index] = bytearray(key)
+
+    if timestamp is None:
+        timestamp = int(time.time() * 1000)
+
+    return obj.writeHFiles(
+        df._jdf, hbcatalog, outputpath, jstartkeys, timestamp)
+
+def bulk_load_hfiles(outputpath: str, tablename: str):
+    """ Move the HFiles written by write_hfiles into a HBase table.
+
+    Parameters
+    ----------
+    outputpath : str
+        Directory of the HFiles.
+    tablename : str
+        Name of the table (namespace:name).
+    """
+    sc = get_spark_context()
+    _hfile_utils(sc).bulkLoad(outputpath, tablename)
+
+def read_hfiles(outputpath: str) -> list:
+    """ Read back the cells of HFiles written by write_hfiles (small
+    outputs only, e.g. for tests).
+
+    Parameters
+    ----------
+    outputpath : str
+        Directory of the HFiles.
+
+    Returns
+    -------
+    cells : list of tuple
+        (file, rowkey, family, qualifier, value) of each cell, in the order
+        of the HFiles. Binary values are escaped (Bytes.toStringBinary).
+    """
+    sc = get_spark_context()
+    cells = _hfile_utils(sc).readHFiles(outputpath)
+    return [
+        tuple(cell.productElement(i) for i in range(5)) for cell in cells]
+
+
 if __name__ == "__main__":
     """ Execute the test suite with SparkSession initialised """
 
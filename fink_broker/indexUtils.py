@@ -0,0 +1,415 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Secondary index of the Parquet databases, for point lookups of alerts
+by objectId or candid.
+
+The index maps (objectId, candid) to the (file, row group) containing the
+alert. It is stored under `<basepath>/_index` (ignored by Spark readers of
+the database), as one Parquet copy per lookup key (`_index/objectId` and
+`_index/candid`), each sorted by its key in small row groups such that the
+min/max statistics of the index select a few of them. The key range of
+each file of a copy is kept in a small summary (`_bounds.json`), such that
+lookups only open the footers of the files which may contain the keys.
+
+The index is updated incrementally with the files committed in the sink
+log: new files are indexed in new segments, which are merged (and the
+entries of files removed by the compaction dropped) when the index is
+compacted.
+
+Lookups run on the driver with pyarrow: only the matching row groups of the
+index, and of the database, are read.
+"""
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col
+from pyspark.sql.types import StructType, StructField
+from pyspark.sql.types import StringType, LongType, IntegerType
+
+import os
+import json
+import bisect
+from urllib.parse import urlparse
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from fink_broker.sparkUtils import get_hadoop_path, get_spark_context
+from fink_broker.compactionUtils import list_database_files
+from fink_broker.tester import spark_unit_tests
+
+# Location of the index, relative to the database
+INDEX_DIR = "_index"
+
+# Lookup keys: the index has one copy sorted by each of them
+INDEX_KEYS = ["objectId", "candid"]
+
+# Key range of the files of a copy of the index
+BOUNDS_FILE = "_bounds.json"
+
+# Size of the row groups of the index
+INDEX_ROWGROUP_SIZE = 1024**2
+
+INDEX_SCHEMA = StructType([
+    StructField("objectId", StringType(), True),
+    StructField("candid", LongType(), True),
+    StructField("file", StringType(), True),
+    StructField("rowgroup", IntegerType(), True)])
+
+def open_parquet(path: str) -> pq.ParquetFile:
+    """ Open a Parquet file from the local FS or HDFS with pyarrow.
+
+    Parameters
+    ----------
+    path: str
+        Path or URI (file:/..., hdfs://host:port/...) of the file.
+
+    Returns
+    ----------
+    pf: pyarrow.parquet.ParquetFile
+    """
+    uri = urlparse(path)
+    if uri.scheme == "hdfs":
+        import pyarrow
+        fs = pyarrow.hdfs.connect(uri.hostname, uri.port or 0)
+        return pq.ParquetFile(fs.open(uri.path, "rb"))
+    return pq.ParquetFile(uri.path if uri.scheme == "file" else path)
+
+def index_file(path: str) -> list:
+    """ Index entries of a Parquet file of the database.
+
+    Parameters
+    ----------
+    path: str
+        Path or URI of the file.
+
+    Returns
+    ----------
+    entries: list of tuple
+        (objectId, candid, path, row group) for each alert.
+
+    Examples
+    ----------
+    >>> path = list_database_files("archive/alerts_store")[0]["path"]
+    >>> entries = index_file(path)
+    >>> entries[0][2] == path, entries[0][3]
+    (True, 0)
+    """
+    pf = open_parquet(path)
+    entries = []
+    for rowgroup in range(pf.num_row_groups):
+        table = pf.read_row_group(rowgroup, columns=["objectId", "candid"])
+        columns = table.to_pydict()
+        for objectid, candid in zip(columns["objectId"], columns["candid"]):
+            entries.append((objectid, candid, path, rowgroup))
+    return entries
+
+def _index_files(fs, jpath) -> list:
+    """ Parquet files of a copy of the index """
+    if not fs.exists(jpath):
+        return []
+    return [
+        status.getPath() for status in fs.listStatus(jpath)
+        if status.getPath().getName().endswith(".parquet")]
+
+def _write_bounds(copypath: str, key: str):
+    """ Write the key range of each file of a copy of the index """
+    jpath, fs = get_hadoop_path(copypath)
+    bounds = {}
+    for jfile in _index_files(fs, jpath):
+        pf = open_parquet(jfile.toString())
+        position = pf.schema.names.index(key)
+        mins, maxs = [], []
+        for rowgroup in range(pf.num_row_groups):
+            stats = pf.metadata.row_group(rowgroup).column(
+                position).statistics
+            if stats is None or not stats.has_min_max:
+                # Unknown range: the file is always read
+                mins, maxs = [None], [None]
+                break
+            mins.append(stats.min)
+            maxs.append(stats.max)
+        if pf.num_row_groups == 0:
+            continue
+        known = None not in mins
+        bounds[jfile.getName()] = [
+            min(mins) if known else None, max(maxs) if known else None]
+
+    stream = fs.create(
+        get_spark_context()._jvm.org.apache.hadoop.fs.Path(
+            jpath, BOUNDS_FILE), True)
+    try:
+        stream.write(bytearray(json.dumps(bounds).encode("utf-8")))
+    finally:
+        stream.close()
+
+def _read_bounds(fs, jpath) -> dict:
+    """ Key range of the files of a copy of the index, or None """
+    jbounds = get_spark_context()._jvm.org.apache.hadoop.fs.Path(
+        jpath, BOUNDS_FILE)
+    if not fs.exists(jbounds):
+        return None
+    stream = fs.open(jbounds)
+    try:
+        return json.loads(
+            get_spark_context()._jvm.org.apache.commons.io.IOUtils.toString(
+                stream, "UTF-8"))
+    finally:
+        stream.close()
+
+def _write_copies(df, indexpath: str, npartitions: int, mode: str):
+    """ Write the copies of the index sorted by each key """
+    for key in INDEX_KEYS:
+        copypath = os.path.join(indexpath, key)
+        others = [k for k in INDEX_KEYS if k != key]
+        df.repartitionByRange(npartitions, key)\
+            .sortWithinPartitions(key, *others)\
+            .write\
+            .mode(mode)\
+            .option("parquet.block.size", INDEX_ROWGROUP_SIZE)\
+            .parquet(copypath)
+        _write_bounds(copypath, key)
+
+def _indexed_files(indexpath: str) -> set:
+    """ Files of the database referenced in the index """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    copypath = os.path.join(indexpath, INDEX_KEYS[0])
+    jpath, fs = get_hadoop_path(copypath)
+    if len(_index_files(fs, jpath)) == 0:
+        return set()
+
+    rows = spark.read.parquet(copypath).select("file").distinct().collect()
+    return set(row["file"] for row in rows)
+
+def update_index(
+        basepath: str, npartitions: int = 0, merge: bool = False) -> dict:
+    """ Index the files committed in the database since the last update,
+    and drop the entries of files which do not exist anymore (e.g. files
+    replaced by the compaction).
+
+    New files are indexed in new segments (npartitions files per copy of
+    the index). The index is rewritten in one segment if `merge` is True,
+    or if files have been removed from the database.
+
+    Parameters
+    ----------
+    basepath: str
+        Base path of the database.
+    npartitions: int, optional
+        Number of files of the new index segment. Default is 0, that is
+        one per core.
+    merge: bool, optional
+        If True, merge the segments of the index. Default is False.
+
+    Returns
+    ----------
+    report: dict
+        Number of files added and removed.
+
+    Examples
+    ----------
+    >>> jindex, fs = get_hadoop_path("archive/alerts_store/_index")
+    >>> _ = fs.delete(jindex, True)
+    >>> report = update_index("archive/alerts_store", npartitions=2)
+    >>> report["added"] > 0
+    True
+    >>> update_index("archive/alerts_store")["added"]
+    0
+
+    # Segments are merged
+    >>> jpath, _ = get_hadoop_path("archive/alerts_store/_index/candid")
+    >>> _ = update_index("archive/alerts_store", npartitions=2, merge=True)
+    >>> len(_index_files(fs, jpath))
+    2
+    >>> fs.delete(jindex, True)
+    True
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+    sc = spark.sparkContext
+
+    indexpath = os.path.join(basepath, INDEX_DIR)
+    jindex, fs = get_hadoop_path(indexpath)
+
+    # Index of a previous layout (a single copy): it is rebuilt
+    if len(_index_files(fs, jindex)) > 0:
+        fs.delete(jindex, True)
+
+    current = set(f["path"] for f in list_database_files(basepath))
+    indexed = _indexed_files(indexpath)
+
+    added = sorted(current - indexed)
+    removed = indexed - current
+    npartitions = npartitions or sc.defaultParallelism
+
+    new = None
+    if len(added) > 0:
+        entries = sc.parallelize(added, min(len(added), npartitions))\
+            .flatMap(index_file)
+        new = spark.createDataFrame(entries, INDEX_SCHEMA)
+
+    if (merge or len(removed) > 0) and len(indexed) > 0:
+        # Rewrite the index: merged segments, without removed files
+        old = spark.read.parquet(os.path.join(indexpath, INDEX_KEYS[0]))\
+            .filter(~col("file").isin(*removed))
+        df = old if new is None else old.unionByName(new)
+        tmppath = indexpath.rstrip("/") + ".tmp"
+        df = df.persist()
+        _write_copies(df, tmppath, npartitions, "overwrite")
+        df.unpersist()
+        jtmp, _ = get_hadoop_path(tmppath)
+        fs.delete(jindex, True)
+        fs.rename(jtmp, jindex)
+    elif new is not None:
+        # New files are indexed in a new segment
+        new = new.persist()
+        _write_copies(new, indexpath, npartitions, "append")
+        new.unpersist()
+
+    return {"added": len(added), "removed": len(removed)}
+
+def _select(table, column: str, values: set):
+    """ Rows of a pyarrow Table whose `column` is in `values` """
+    df = table.to_pandas()
+    return df[df[column].isin(values)]
+
+def _contains(low, high, values: list) -> bool:
+    """ True if one of the sorted `values` is in [low, high] """
+    if low is None or high is None:
+        return True
+    position = bisect.bisect_left(values, low)
+    return position < len(values) and values[position] <= high
+
+def lookup_index(basepath: str, objectids=None, candids=None):
+    """ Return the index entries of alerts.
+
+    The copy of the index sorted by the lookup key is used: only the
+    files and row groups whose key range contains one of the values are
+    read.
+
+    Parameters
+    ----------
+    basepath: str
+        Base path of the database.
+    objectids: list of str, optional
+        objectId of the alerts.
+    candids: list of int, optional
+        candid of the alerts.
+
+    Returns
+    ----------
+    entries: pandas.DataFrame
+        objectId, candid, file, rowgroup
+    """
+    key, values = ("objectId", objectids) \
+        if objectids is not None else ("candid", candids)
+    values = sorted(set(values))
+
+    copypath = os.path.join(basepath, INDEX_DIR, key)
+    jpath, fs = get_hadoop_path(copypath)
+    if not fs.exists(jpath):
+        return pd.DataFrame(columns=INDEX_SCHEMA.fieldNames())
+
+    bounds = _read_bounds(fs, jpath)
+    chunks = []
+    for jfile in _index_files(fs, jpath):
+        if bounds is not None and jfile.getName() in bounds:
+            if not _contains(*bounds[jfile.getName()], values):
+                continue
+        pf = open_parquet(jfile.toString())
+        position = pf.schema.names.index(key)
+        for rowgroup in range(pf.num_row_groups):
+            stats = pf.metadata.row_group(rowgroup).column(position).statistics
+            # Skip row groups whose range does not contain any value
+            if stats is not None and stats.has_min_max:
+                if not _contains(stats.min, stats.max, values):
+                    continue
+            table = pf.read_row_group(rowgroup)
+            chunks.append(_select(table, key, set(values)))
+
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=INDEX_SCHEMA.fieldNames())
+    return pd.concat(chunks, ignore_index=True)
+
+def lookup_alerts(
+        basepath: str, objectids=None, candids=None,
+        columns: list = None):
+    """ Return the alerts with given objectId or candid, reading only the
+    row groups of the database which contain them (see update_index).
+
+    Parameters
+    ----------
+    basepath: str
+        Base path of the database.
+    objectids: list of str, optional
+        objectId of the alerts.
+    candids: list of int, optional
+        candid of the alerts.
+    columns: list of str, optional
+        Columns to read. Default is None (all columns).
+
+    Returns
+    ----------
+    alerts: pandas.DataFrame
+
+    Examples
+    ----------
+    >>> _ = update_index("archive/alerts_store")
+    >>> df = spark.read.parquet("archive/alerts_store")
+    >>> objectid = df.select("objectId").first()["objectId"]
+    >>> nalerts = df.filter(df["objectId"] == objectid).count()
+
+    >>> alerts = lookup_alerts(
+    ...     "archive/alerts_store", objectids=[objectid],
+    ...     columns=["objectId", "candid"])
+    >>> len(alerts) == nalerts
+    True
+
+    >>> candid = alerts["candid"].values[0]
+    >>> alerts = lookup_alerts("archive/alerts_store", candids=[candid])
+    >>> len(alerts)
+    1
+
+    >>> jindex, fs = get_hadoop_path("archive/alerts_store/_index")
+    >>> fs.delete(jindex, True)
+    True
+    """
+    key, values = ("objectId", objectids) \
+        if objectids is not None else ("candid", candids)
+    values = set(values)
+
+    entries = lookup_index(basepath, objectids=objectids, candids=candids)
+    if columns is not None and key not in columns:
+        columns = columns + [key]
+
+    chunks = []
+    for path, group in entries.groupby("file"):
+        pf = open_parquet(path)
+        for rowgroup in sorted(set(group["rowgroup"])):
+            table = pf.read_row_group(int(rowgroup), columns=columns)
+            chunks.append(_select(table, key, values))
+
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    # Run the Spark test suite
+    spark_unit_tests(globals())
@@ -0,0 +1,606 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-object light-curve store, to give processors the full history of
+objects and not only the 30 days of prv_candidates.
+
+The store is a Parquet dataset with one row per object and segment:
+objectId, and one array per field of the detections (lc_jd, lc_fid, ...)
+sorted by jd. Objects are spread over LIGHTCURVE_BUCKETS partitions
+(`bucket=<n>`) by a hash of their objectId, and rows are sorted by objectId
+in small row groups. Each micro-batch of raw2science appends a new segment
+with the detections of its alerts, and the compaction service merges the
+segments of each bucket (see compact_lightcurves).
+
+Reads run with pyarrow (on the driver, or in the executors for processors),
+and only the matching row groups of the bucket of each object are read.
+Memory is bounded by the size of the micro-batches: the store is on disk,
+and merges are regular Spark jobs.
+"""
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.column import Column
+from pyspark.sql.functions import col, lit, struct, explode, posexplode
+from pyspark.sql.functions import collect_list, sort_array, element_at
+from pyspark.sql.functions import md5, substring, conv, pmod
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import ArrayType
+
+import os
+import bisect
+import hashlib
+import importlib
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from fink_broker.sparkUtils import get_hadoop_path
+from fink_broker.tester import spark_unit_tests
+
+# Fields of the detections stored. jd must be the first one.
+LIGHTCURVE_FIELDS = ["jd", "fid", "magpsf", "sigmapsf"]
+
+# Prefix of the light-curve columns, and of the arguments of processors
+# requesting them
+LIGHTCURVE_PREFIX = "lc_"
+
+# Partitioning of the store
+LIGHTCURVE_BUCKETS = 64
+BUCKET_COLUMN = "bucket"
+
+# Size of the row groups of the store
+LIGHTCURVE_ROWGROUP_SIZE = 1024**2
+
+# Staging area of the compaction, relative to the store
+STAGING_DIR = "_compaction"
+
+# Maximum number of light curves cached by each Python worker
+LIGHTCURVE_CACHE_SIZE = 100000
+
+def bucket_of(objectid: str, nbuckets: int = LIGHTCURVE_BUCKETS) -> int:
+    """ Bucket of an object in the store.
+
+    Parameters
+    ----------
+    objectid: str
+        objectId of the object.
+    nbuckets: int, optional
+        Number of buckets. Default is LIGHTCURVE_BUCKETS.
+
+    Returns
+    ----------
+    bucket: int
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([("ZTF19acmbyav",)], ["objectId"])
+    >>> df.select(bucket_column()).first()[0] == bucket_of("ZTF19acmbyav")
+    True
+    """
+    digest = hashlib.md5(objectid.encode("utf-8")).hexdigest()
+    return int(digest[:4], 16) % nbuckets
+
+def bucket_column(
+        colname: str = "objectId",
+        nbuckets: int = LIGHTCURVE_BUCKETS) -> Column:
+    """ Column with the bucket of objects (same as bucket_of) """
+    return pmod(
+        conv(substring(md5(col(colname)), 1, 4), 16, 10).cast("int"),
+        lit(nbuckets)).alias(BUCKET_COLUMN)
+
+def lightcurve_points(
+        df: DataFrame, fields: list = LIGHTCURVE_FIELDS) -> DataFrame:
+    """ Detections carried by alerts (candidate and prv_candidates), one
+    row per detection. Upper limits are discarded.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame of alerts.
+    fields: list of str, optional
+        Fields of the detections. Default is LIGHTCURVE_FIELDS.
+
+    Returns
+    ----------
+    df: DataFrame
+        objectId and fields. Detections can be duplicated.
+
+    Examples
+    ----------
+    >>> lightcurve_points(df_alerts_sample).count()
+    8
+    """
+    candidate = df.schema["candidate"].dataType
+    points = df\
+        .filter(col("candidate.magpsf").isNotNull())\
+        .select(
+            ["objectId"] + [col("candidate." + f).alias(f) for f in fields])
+
+    if "prv_candidates" in df.columns:
+        # Types of prv_candidates and candidate fields can differ
+        prv = df\
+            .select("objectId", explode("prv_candidates").alias("prv"))\
+            .filter(col("prv.magpsf").isNotNull())\
+            .select(
+                ["objectId"] + [
+                    col("prv." + f).cast(candidate[f].dataType).alias(f)
+                    for f in fields])
+        points = points.union(prv)
+
+    return points
+
+def _group_points(
+        points: DataFrame, fields: list, nbuckets: int) -> DataFrame:
+    """ One row per object, with the arrays of its detections """
+    # jd is the first field, hence the sort by jd
+    return points\
+        .groupBy("objectId")\
+        .agg(sort_array(collect_list(struct(*fields))).alias("points"))\
+        .select(
+            ["objectId"] + [
+                col("points." + f).alias(LIGHTCURVE_PREFIX + f)
+                for f in fields] + [bucket_column("objectId", nbuckets)])
+
+def _write_segments(df: DataFrame, path: str, mode: str = "append"):
+    """ Write light curves in the store, one file per bucket """
+    df.repartition(BUCKET_COLUMN)\
+        .sortWithinPartitions(BUCKET_COLUMN, "objectId")\
+        .write\
+        .mode(mode)\
+        .option("parquet.block.size", LIGHTCURVE_ROWGROUP_SIZE)\
+        .partitionBy(BUCKET_COLUMN)\
+        .parquet(path)
+
+def append_lightcurves(
+        df: DataFrame, path: str, fields: list = LIGHTCURVE_FIELDS,
+        nbuckets: int = LIGHTCURVE_BUCKETS):
+    """ Append the detections of (static) alerts to the store.
+    Meant to be called on each micro-batch with foreachBatch.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Static DataFrame of alerts.
+    path: str
+        Path of the store.
+    fields: list of str, optional
+        Fields of the detections. Default is LIGHTCURVE_FIELDS.
+    nbuckets: int, optional
+        Number of buckets. Default is LIGHTCURVE_BUCKETS.
+
+    Examples
+    ----------
+    >>> path = "archive/lightcurves_test"
+    >>> append_lightcurves(df_alerts_sample, path)
+    >>> spark.read.parquet(path).columns
+    ['objectId', 'lc_jd', 'lc_fid', 'lc_magpsf', 'lc_sigmapsf', 'bucket']
+    """
+    points = lightcurve_points(df, fields)\
+        .dropDuplicates(["objectId", "jd", "fid"])
+    _write_segments(_group_points(points, fields, nbuckets), path)
+
+def compact_lightcurves(
+        path: str, nbuckets: int = LIGHTCURVE_BUCKETS) -> dict:
+    """ Merge the segments of the store into one row per object, and
+    one file per bucket.
+
+    Only the files present at the start are merged, such that segments
+    appended meanwhile are kept. Readers merge the segments of objects,
+    hence they are not affected by the swap of files.
+
+    Parameters
+    ----------
+    path: str
+        Path of the store.
+    nbuckets: int, optional
+        Number of buckets. Default is LIGHTCURVE_BUCKETS.
+
+    Returns
+    ----------
+    report: dict
+        Number of files before and after.
+
+    Examples
+    ----------
+    >>> path = "archive/lightcurves_test"
+    >>> append_lightcurves(df_alerts_sample, path)
+    >>> report = compact_lightcurves(path)
+    >>> report["files_after"] <= report["files_before"]
+    True
+    >>> read_lightcurves(path, ["ZTF19a"])["ZTF19a"]["jd"]
+    array([ 2458788.5,  2458790.5,  2458791.5])
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    jpath, fs = get_hadoop_path(path)
+    if not fs.exists(jpath):
+        return {"files_before": 0, "files_after": 0}
+
+    files = []
+    for bucket in fs.listStatus(jpath):
+        if not bucket.getPath().getName().startswith(BUCKET_COLUMN + "="):
+            continue
+        files += [
+            status.getPath() for status in fs.listStatus(bucket.getPath())
+            if status.getPath().getName().endswith(".parquet")]
+    if len(files) == 0:
+        return {"files_before": 0, "files_after": 0}
+
+    df = spark.read\
+        .option("basePath", path)\
+        .parquet(*[f.toString() for f in files])
+    fields = [
+        c[len(LIGHTCURVE_PREFIX):] for c in df.columns
+        if c.startswith(LIGHTCURVE_PREFIX)]
+
+    # One row per detection, and merge again
+    points = df\
+        .select(
+            ["objectId"] + [
+                posexplode(LIGHTCURVE_PREFIX + fields[0])
+                .alias("pos", fields[0])] +
+            [col(LIGHTCURVE_PREFIX + f) for f in fields[1:]])\
+        .select(
+            ["objectId", fields[0]] + [
+                element_at(col(LIGHTCURVE_PREFIX + f), col("pos") + 1)
+                .alias(f) for f in fields[1:]])\
+        .dropDuplicates(["objectId", "jd", "fid"])
+
+    staging = os.path.join(path, STAGING_DIR)
+    _write_segments(
+        _group_points(points, fields, nbuckets), staging, mode="overwrite")
+
+    # Move the merged files in the buckets, then remove the old ones
+    jstaging, _ = get_hadoop_path(staging)
+    nfiles = 0
+    for bucket in fs.listStatus(jstaging):
+        name = bucket.getPath().getName()
+        if not name.startswith(BUCKET_COLUMN + "="):
+            continue
+        target = jpath.suffix("/" + name)
+        fs.mkdirs(target)
+        for status in fs.listStatus(bucket.getPath()):
+            if status.getPath().getName().endswith(".parquet"):
+                fs.rename(
+                    status.getPath(),
+                    target.suffix("/" + status.getPath().getName()))
+                nfiles += 1
+    for f in files:
+        fs.delete(f, False)
+    fs.delete(jstaging, True)
+
+    return {"files_before": len(files), "files_after": nfiles}
+
+def _list_parquet_files(dirpath: str) -> list:
+    """ Parquet files of a directory of the local FS or HDFS, listed
+    with pyarrow (usable in the executors).
+    """
+    uri = urlparse(dirpath)
+    if uri.scheme == "hdfs":
+        import pyarrow
+        fs = pyarrow.hdfs.connect(uri.hostname, uri.port or 0)
+        return [
+            (fs, p) for p in fs.ls(uri.path) if p.endswith(".parquet")]
+    local = uri.path if uri.scheme == "file" else dirpath
+    if not os.path.isdir(local):
+        return []
+    return [
+        (None, os.path.join(local, p)) for p in sorted(os.listdir(local))
+        if p.endswith(".parquet")]
+
+def _read_bucket(files: list, values: list) -> list:
+    """ Rows of the objects `values` (sorted) in the files of a bucket.
+
+    Rows are sorted by objectId in each file: row groups whose range does
+    not contain any object are skipped, and the objectId column of the
+    others is searched before reading the rows of the objects found.
+    """
+    chunks = []
+    for fs, fn in files:
+        pf = pq.ParquetFile(fs.open(fn, "rb") if fs is not None else fn)
+        position = pf.schema.names.index("objectId")
+        for rowgroup in range(pf.num_row_groups):
+            stats = pf.metadata.row_group(rowgroup)\
+                .column(position).statistics
+            if stats is not None and stats.has_min_max:
+                low = bisect.bisect_left(values, stats.min)
+                high = bisect.bisect_right(values, stats.max)
+                if low == high:
+                    continue
+                candidates = values[low:high]
+            else:
+                candidates = values
+
+            keys = pf.read_row_group(rowgroup, columns=["objectId"])\
+                .to_pandas()["objectId"].values
+            found = np.flatnonzero(np.isin(keys, candidates))
+            if len(found) == 0:
+                continue
+            chunks.append(pf.read_row_group(rowgroup).to_pandas().iloc[found])
+    return chunks
+
+def _merge_segments(chunks: list) -> dict:
+    """ Light curves of objects, merging their segments """
+    lightcurves = {}
+    if len(chunks) == 0:
+        return lightcurves
+
+    for objectid, group in pd.concat(chunks).groupby("objectId"):
+        fields = [
+            c[len(LIGHTCURVE_PREFIX):] for c in group.columns
+            if c.startswith(LIGHTCURVE_PREFIX)]
+        points = pd.DataFrame({
+            f: np.concatenate(group[LIGHTCURVE_PREFIX + f].values)
+            for f in fields})
+        points = points\
+            .drop_duplicates(subset=["jd", "fid"])\
+            .sort_values("jd")
+        lightcurves[objectid] = {f: points[f].values for f in fields}
+    return lightcurves
+
+def _bucket_dir(path: str, bucket: int) -> str:
+    """ Directory of a bucket of the store """
+    return os.path.join(path, "{}={}".format(BUCKET_COLUMN, bucket))
+
+def read_lightcurves(
+        path: str, objectids: list,
+        nbuckets: int = LIGHTCURVE_BUCKETS) -> dict:
+    """ Return the full light curves of objects.
+
+    Only the bucket of each object is read, and in each file only the
+    row groups containing one of the objects (see _read_bucket).
+
+    Parameters
+    ----------
+    path: str
+        Path of the store.
+    objectids: list of str
+        objectId of the objects.
+    nbuckets: int, optional
+        Number of buckets. Default is LIGHTCURVE_BUCKETS.
+
+    Returns
+    ----------
+    lightcurves: dict
+        For each object found, a dictionary with one numpy array per field,
+        sorted by jd.
+
+    Examples
+    ----------
+    >>> path = "archive/lightcurves_test"
+    >>> append_lightcurves(df_alerts_sample, path)
+    >>> lcs = read_lightcurves(path, ["ZTF19a", "ZTF19b", "unknown"])
+    >>> sorted(lcs.keys())
+    ['ZTF19a', 'ZTF19b']
+    >>> lcs["ZTF19a"]["magpsf"]
+    array([ 18. ,  17.5,  17. ], dtype=float32)
+    """
+    buckets = {}
+    for objectid in set(objectids):
+        buckets.setdefault(bucket_of(objectid, nbuckets), set()).add(objectid)
+
+    chunks = []
+    for bucket, values in buckets.items():
+        files = _list_parquet_files(_bucket_dir(path, bucket))
+        chunks += _read_bucket(files, sorted(values))
+    return _merge_segments(chunks)
+
+class LightcurveCache():
+    """ Light curves read from the store, per bucket, such that the
+    light-curve columns of a batch of alerts read the store once.
+
+    Entries of a bucket are dropped as soon as its files change (new
+    segments, compaction), hence the cache never returns outdated light
+    curves.
+
+    Parameters
+    ----------
+    path: str
+        Path of the store.
+    maxsize: int, optional
+        Maximum number of objects kept. Default is LIGHTCURVE_CACHE_SIZE.
+
+    Examples
+    ----------
+    >>> path = "archive/lightcurves_test"
+    >>> append_lightcurves(df_alerts_sample, path)
+    >>> cache = LightcurveCache(path)
+    >>> lcs = cache.get(["ZTF19a", "ZTF19b", "unknown"])
+    >>> sorted(lcs.keys()), cache.reads
+    (['ZTF19a', 'ZTF19b'], 3)
+    >>> _ = cache.get(["ZTF19a", "unknown"])
+    >>> cache.reads
+    3
+    """
+    def __init__(self, path: str, maxsize: int = None):
+        self.path = path
+        self.maxsize = maxsize or LIGHTCURVE_CACHE_SIZE
+        self._files = {}
+        self._lightcurves = {}
+        # Number of objects read from the store
+        self.reads = 0
+
+    def get(self, objectids: list, nbuckets: int = LIGHTCURVE_BUCKETS):
+        """ Light curves of objects (see read_lightcurves) """
+        buckets = {}
+        for objectid in set(objectids):
+            buckets.setdefault(
+                bucket_of(objectid, nbuckets), set()).add(objectid)
+
+        for bucket, values in buckets.items():
+            files = _list_parquet_files(_bucket_dir(self.path, bucket))
+            signature = [fn for _, fn in files]
+            if self._files.get(bucket) != signature:
+                self._files[bucket] = signature
+                self._lightcurves[bucket] = {}
+            cached = self._lightcurves[bucket]
+
+            missing = sorted(values - set(cached))
+            if len(missing) > 0:
+                self.reads += len(missing)
+                found = _merge_segments(_read_bucket(files, missing))
+                for objectid in missing:
+                    cached[objectid] = found.get(objectid)
+
+        if sum(len(v) for v in self._lightcurves.values()) > self.maxsize:
+            self._files, self._lightcurves = {}, {}
+            return read_lightcurves(self.path, objectids, nbuckets)
+
+        out = {}
+        for bucket, values in buckets.items():
+            for objectid in values:
+                lightcurve = self._lightcurves[bucket][objectid]
+                if lightcurve is not None:
+                    out[objectid] = lightcurve
+        return out
+
+# Caches of the Python workers, per store (see lightcurve_column)
+_CACHES = {}
+
+def lightcurve_column(
+        path: str, field: str, dtype, colname: str = "objectId") -> Column:
+    """ Column with the full history of a field of the detections of the
+    objects, read from the store (Arrow-based UDF).
+
+    Light curves are kept in a cache of the Python worker (see
+    LightcurveCache), such that the columns of the different fields of a
+    batch read the store once.
+
+    Parameters
+    ----------
+    path: str
+        Path of the store. It must be accessible from the executors.
+    field: str
+        Field of the detections.
+    dtype: DataType
+        Spark type of the field.
+    colname: str, optional
+        Column with the objectId. Default is objectId.
+
+    Returns
+    ----------
+    out: Column
+        Array of values sorted by jd, or null if the object is not found.
+    """
+    @pandas_udf(ArrayType(dtype), PandasUDFType.SCALAR)
+    def history(objectid: pd.Series) -> pd.Series:
+        if path not in _CACHES:
+            _CACHES[path] = LightcurveCache(path)
+        lightcurves = _CACHES[path].get(list(objectid.values))
+        return pd.Series([
+            lightcurves[i][field].tolist() if i in lightcurves else None
+            for i in objectid.values])
+
+    return history(col(colname)).alias(LIGHTCURVE_PREFIX + field)
+
+def add_lightcurve_columns(
+        df: DataFrame, path: str, fields: list) -> DataFrame:
+    """ Add the light-curve columns `lc_<field>` to alerts, with the full
+    history of their object in the store.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame of alerts.
+    path: str
+        Path of the store.
+    fields: list of str
+        Fields of the detections.
+
+    Returns
+    ----------
+    df: DataFrame
+
+    Examples
+    ----------
+    >>> path = "archive/lightcurves_test"
+    >>> append_lightcurves(df_alerts_sample, path)
+    >>> df = add_lightcurve_columns(df_alerts_sample, path, ["jd", "fid"])
+    >>> row = df.filter("objectId = 'ZTF19b'").select("lc_fid").first()
+    >>> row.lc_fid
+    [2, 1]
+    """
+    # All the columns in one projection, evaluated on the same batches
+    candidate = df.schema["candidate"].dataType
+    names = [LIGHTCURVE_PREFIX + field for field in fields]
+    return df.select(
+        [col("`{}`".format(c)) for c in df.columns if c not in names] + [
+            lightcurve_column(path, field, candidate[field].dataType)
+            for field in fields])
+
+def requested_lightcurve_fields(processor_names: list) -> list:
+    """ Fields of the light curves requested by processors, that is
+    arguments of the processors named `lc_<field>`.
+
+    Parameters
+    ----------
+    processor_names: list of str
+        Processors (module.function).
+
+    Returns
+    ----------
+    fields: list of str
+
+    Examples
+    ----------
+    >>> requested_lightcurve_fields(
+    ...     ['fink_science.xmatch.processor.cdsxmatch'])
+    []
+    """
+    fields = []
+    for processor_func_name in processor_names:
+        proc_name = processor_func_name.split('.')[-1]
+        module_name = processor_func_name.split('.' + proc_name)[0]
+        module = importlib.import_module(module_name)
+        func = getattr(module, proc_name).func
+        argnames = func.__code__.co_varnames[:func.__code__.co_argcount]
+        fields += [
+            i[len(LIGHTCURVE_PREFIX):] for i in argnames
+            if i.startswith(LIGHTCURVE_PREFIX)]
+
+    unknown = [i for i in fields if i not in LIGHTCURVE_FIELDS]
+    if len(unknown) > 0:
+        raise ValueError(
+            "Fields {} are not in the light-curve store".format(unknown))
+
+    return [i for i in LIGHTCURVE_FIELDS if i in fields]
+
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    globs = globals()
+    spark = SparkSession.builder.getOrCreate()
+
+    # Two alerts of the same object sharing a previous detection, an upper
+    # limit, and an alert without history
+    candidate = "struct<jd:double,fid:int,magpsf:float,sigmapsf:float>"
+    prv = "array<struct<jd:double,fid:int,magpsf:float,sigmapsf:float>>"
+    globs["df_alerts_sample"] = spark.createDataFrame(
+        [
+            ("ZTF19a", (2458790.5, 1, 17.5, .1), [(2458788.5, 1, 18., .1)]),
+            ("ZTF19a", (2458791.5, 1, 17., .1),
+                [(2458788.5, 1, 18., .1), (2458790.5, 1, 17.5, .1),
+                    (2458789.5, 2, None, None)]),
+            ("ZTF19b", (2458790.5, 1, 19., .1), [(2458789.5, 2, 19., .1)]),
+            ("ZTF19c", (2458790.5, 2, 20., .1), None)
+        ],
+        "objectId string, candidate {}, prv_candidates {}".format(
+            candidate, prv))
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
@@ -17,6 +17,7 @@ from pyspark.sql import SparkSession
 import logging
 from logging import Logger
 
+from fink_broker.sparkUtils import PROFILE_KEYS
 from fink_broker.tester import spark_unit_tests
 
 def get_fink_logger(name: str = "test", log_level: str = "INFO") -> Logger:
@@ -61,7 +62,9 @@ def get_fink_logger(name: str = "test", log_level: str = "INFO") -> Logger:
 
 def inspect_application(logger):
     """Print INFO and DEBUG statements about the current application such
-    as the Spark configuration, the Spark & Python versions.
+    as the Spark configuration, the Spark & Python versions. The effective
+    values of the options set by the performance profiles are printed
+    at the INFO level.
 
     Parameters
     ----------
@@ -79,6 +82,12 @@ def inspect_application(logger):
     logger.debug('Python version: {}'.format(spark.sparkContext.pythonVer))
     logger.debug('Spark version: {}'.format(spark.sparkContext.version))
 
+    # Effective values of the performance options
+    sparkconf = spark.sparkContext.getConf()
+    for key in PROFILE_KEYS:
+        value = spark.conf.get(key, None) or sparkconf.get(key, "default")
+        logger.info('{}: {}'.format(key, value))
+
     # Debug statements
     conf = "\n".join([str(i) for i in spark.sparkContext.getConf().getAll()])
     logger.debug(conf)
@@ -15,6 +15,7 @@
 from pyspark.sql.streaming import StreamingQuery
 
 import os
+import json
 import threading
 import pandas as pd
 
@@ -232,6 +233,246 @@ def monitor_progress_webui(
     if test:
         t.cancel()
 
+def duplicates_from_progress(progress: dict) -> (int, int, int):
+    """ Number of input rows, and numbers of rows dropped by the
+    deduplication (see sparkUtils.deduplicate_alerts) in a micro-batch:
+    duplicates, and alerts arriving later than the watermark.
+
+    Late drops are read from `numRowsDroppedByWatermark` (Spark 3.1+).
+    Otherwise there is none if no input row is older than the watermark
+    (`eventTime` of the progress), and they are unknown if some are.
+
+    Parameters
+    ----------
+    progress: dict
+        Progress of the streaming query (for one micro-batch).
+
+    Returns
+    ----------
+    numrows: int
+        Number of input rows.
+    duplicates: int
+        Number of duplicates dropped: input rows which did not update
+        the state of the deduplication, and were not late. If the late
+        drops are unknown, this is the number of rows dropped.
+    late: int
+        Number of late alerts dropped, or None if unknown.
+
+    Examples
+    ----------
+    >>> progress = {
+    ...     "numInputRows": 1000,
+    ...     "eventTime": {
+    ...         "min": "2019-11-01T10:00:00.000Z",
+    ...         "watermark": "2019-11-01T09:00:00.000Z"},
+    ...     "stateOperators": [{"numRowsTotal": 5000, "numRowsUpdated": 990}]}
+    >>> duplicates_from_progress(progress)
+    (1000, 10, 0)
+
+    Some alerts are older than the watermark
+    >>> progress["eventTime"]["min"] = "2019-11-01T08:00:00.000Z"
+    >>> duplicates_from_progress(progress)
+    (1000, 10, None)
+    >>> progress["stateOperators"][0]["numRowsDroppedByWatermark"] = 4
+    >>> duplicates_from_progress(progress)
+    (1000, 6, 4)
+
+    >>> duplicates_from_progress({"numInputRows": 10, "stateOperators": []})
+    (10, 0, 0)
+    """
+    numrows = progress.get("numInputRows", 0)
+    operators = progress.get("stateOperators", [])
+    if len(operators) == 0:
+        return numrows, 0, 0
+    dropped = max(numrows - operators[0].get("numRowsUpdated", 0), 0)
+
+    late = operators[0].get("numRowsDroppedByWatermark")
+    if late is None:
+        # ISO-8601 timestamps of the same format compare as strings
+        eventtime = progress.get("eventTime", {})
+        if "min" not in eventtime or "watermark" not in eventtime or \
+                eventtime["min"] >= eventtime["watermark"]:
+            late = 0
+    if late is None:
+        return numrows, dropped, None
+    return numrows, max(dropped - late, 0), late
+
+class IngestionRateController():
+    """ Feedback loop on the number of Kafka offsets read per micro-batch.
+
+    Spark cannot change `maxOffsetsPerTrigger` for a running query, so the
+    controller computes the cap for the next (re)start of the query from the
+    measured processing rate and a target duration of micro-batches:
+
+    - micro-batches slower than the target shrink the cap to what can be
+      processed in the target duration;
+    - saturated micro-batches (the cap was reached) faster than the target
+      grow the cap, up to `max_offsets`.
+
+    A large target duration gives a catch-up mode (large batches, high
+    throughput), while a small one gives a low-latency mode.
+
+    Parameters
+    ----------
+    target_duration: float
+        Target duration of micro-batches, in seconds.
+    initial_offsets: int, optional
+        Initial cap. Default is 10000.
+    min_offsets: int, optional
+        Minimum cap. Default is 100.
+    max_offsets: int, optional
+        Maximum cap. Default is None (no maximum).
+    smoothing: float, optional
+        Weight of the past in the exponential moving average
+        of the processing rate, between 0 and 1. Default is 0.5.
+    statefile: str, optional
+        Local JSON file where the cap and the rate are stored, to be
+        used across restarts of the service. Default is None.
+
+    Examples
+    ----------
+    >>> controller = IngestionRateController(
+    ...     target_duration=10, initial_offsets=50000, smoothing=0.)
+
+    # 50000 alerts processed in 25 seconds: too slow, shrink the cap
+    >>> controller.update(50000, 25000)
+    20000
+
+    # Saturated batch processed in 5 seconds: grow the cap
+    >>> controller.update(20000, 5000)
+    40000
+
+    # Non-saturated batch (backlog drained): keep the cap
+    >>> controller.update(100, 1000)
+    40000
+
+    # Restart the query only if the cap changed significantly
+    >>> controller.needs_restart(35000)
+    False
+    >>> controller.needs_restart(10000)
+    True
+    """
+    def __init__(
+            self, target_duration: float, initial_offsets: int = 10000,
+            min_offsets: int = 100, max_offsets: int = None,
+            smoothing: float = 0.5, statefile: str = None):
+        self.target_duration = target_duration
+        self.min_offsets = min_offsets
+        self.max_offsets = max_offsets
+        self.smoothing = smoothing
+        self.statefile = statefile
+        self.maxoffsets = initial_offsets
+        self.rate = None
+
+        if statefile is not None and os.path.isfile(statefile):
+            with open(statefile) as f:
+                state = json.load(f)
+            self.maxoffsets = state["maxoffsets"]
+            self.rate = state["rate"]
+
+    def _clamp(self, value: float) -> int:
+        """ Keep the cap within [min_offsets, max_offsets] """
+        value = max(self.min_offsets, int(value))
+        if self.max_offsets is not None:
+            value = min(self.max_offsets, value)
+        return value
+
+    def update(self, numrows: int, duration_ms: float) -> int:
+        """ Update the cap from the measurement of one micro-batch.
+
+        Parameters
+        ----------
+        numrows: int
+            Number of rows (alerts) in the micro-batch.
+        duration_ms: float
+            Processing time of the micro-batch, in milliseconds.
+
+        Returns
+        ----------
+        maxoffsets: int
+            New cap for the number of offsets per trigger.
+        """
+        if numrows <= 0 or duration_ms <= 0:
+            return self.maxoffsets
+
+        duration = duration_ms / 1000.
+        saturated = numrows >= self.maxoffsets
+        if duration <= self.target_duration and not saturated:
+            # The cap was not limiting (backlog drained), and small batches
+            # are dominated by fixed overheads: nothing to learn here.
+            return self.maxoffsets
+
+        rate = numrows / duration
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = self.smoothing * self.rate + \
+                (1 - self.smoothing) * rate
+
+        self.maxoffsets = self._clamp(self.rate * self.target_duration)
+
+        self.save()
+        return self.maxoffsets
+
+    def update_from_progress(self, progress: dict) -> int:
+        """ Update the cap from `StreamingQuery.lastProgress`.
+
+        Parameters
+        ----------
+        progress: dict
+            Last progress of the streaming query.
+
+        Returns
+        ----------
+        maxoffsets: int
+            New cap for the number of offsets per trigger.
+
+        Examples
+        ----------
+        >>> controller = IngestionRateController(
+        ...     target_duration=10, initial_offsets=1000, smoothing=0.)
+        >>> progress = {
+        ...     "numInputRows": 1000, "durationMs": {"triggerExecution": 2000}}
+        >>> controller.update_from_progress(progress)
+        5000
+        >>> controller.update_from_progress(None)
+        5000
+        """
+        if not progress:
+            return self.maxoffsets
+        try:
+            numrows = progress["numInputRows"]
+            duration_ms = progress["durationMs"]["triggerExecution"]
+        except (TypeError, KeyError):
+            # This can happen if the stream has not begun
+            return self.maxoffsets
+        return self.update(numrows, duration_ms)
+
+    def needs_restart(self, current: int, tolerance: float = 0.5) -> bool:
+        """ Whether the running query should be restarted with the new cap.
+
+        Parameters
+        ----------
+        current: int
+            Cap of the running query.
+        tolerance: float, optional
+            Relative change of the cap triggering a restart. Default is 0.5.
+
+        Returns
+        ----------
+        out: bool
+        """
+        return abs(self.maxoffsets - current) > tolerance * current
+
+    def save(self):
+        """ Store the cap and the rate on disk, if `statefile` is set """
+        if self.statefile is None:
+            return
+        tmp = self.statefile + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"maxoffsets": self.maxoffsets, "rate": self.rate}, f)
+        os.replace(tmp, self.statefile)
+
 
 if __name__ == "__main__":
     """ Execute the test suite with SparkSession initialised """
@@ -51,14 +51,105 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
     parser.add_argument(
         '-schema', type=str, default='',
         help="""
-        Schema to decode the alert. Should be avro file.
+        Schema(s) to decode the alert. Should be avro file(s),
+        comma-separated. The first one defines the schema of the
+        raw database, and alerts encoded with the others are projected into it.
         [FINK_ALERT_SCHEMA]""")
+    parser.add_argument(
+        '-schema_topics', type=str, default='',
+        help="""
+        Comma-separated list of topic:version rules to route alerts to
+        their schema. Alerts from other topics are routed using the
+        fingerprint of the Avro single-object encoding if present, or
+        decoded with the first schema otherwise.
+        [FINK_ALERT_SCHEMA_TOPICS]""")
     parser.add_argument(
         '-startingoffsets_stream', type=str, default='',
         help="""From which stream offset you want to start pulling data when
         building the raw database: latest, earliest, or custom.
         [KAFKA_STARTING_OFFSET]
         """)
+    parser.add_argument(
+        '-ingestion_mode', type=str, default='fixed',
+        help="""
+        Rate control of the ingestion from Kafka: fixed (the cap on the
+        number of alerts per micro-batch is maxoffsetspertrigger) or
+        adaptive (the cap follows the measured processing rate, to
+        match target_batch_duration).
+        [FINK_INGESTION_MODE]
+        """)
+    parser.add_argument(
+        '-maxoffsetspertrigger', type=int, default=0,
+        help="""
+        Maximum number of alerts per micro-batch (initial value in
+        adaptive mode). 0 means no limit.
+        [FINK_MAX_OFFSETS_PER_TRIGGER]
+        """)
+    parser.add_argument(
+        '-alertdropdir', type=str, default='',
+        help="""
+        If set, stream2raw ingests the Avro files (.avro) dropped in this
+        directory instead of reading Kafka (e.g. to replay archived
+        alerts). Each file is ingested once.
+        [FINK_ALERT_DROP_DIR]
+        """)
+    parser.add_argument(
+        '-maxfilespertrigger', type=int, default=0,
+        help="""
+        Maximum number of Avro files per micro-batch when ingesting from
+        alertdropdir. 0 means no limit.
+        [FINK_MAX_FILES_PER_TRIGGER]
+        """)
+    parser.add_argument(
+        '-minpartitions', type=int, default=0,
+        help="""
+        Minimum number of Spark partitions to read from Kafka. Use it to
+        use more cores than Kafka partitions. 0 means one Spark partition
+        per Kafka partition.
+        [FINK_MIN_PARTITIONS]
+        """)
+    parser.add_argument(
+        '-target_batch_duration', type=float, default=0.0,
+        help="""
+        Target duration of micro-batches in adaptive ingestion mode, in
+        seconds. Small values favour latency, large values favour
+        throughput (catch-up). 0 means tinterval.
+        [FINK_TARGET_BATCH_DURATION]
+        """)
+    parser.add_argument(
+        '-spark_profile', type=str, default='default',
+        help="""
+        Performance profile of the Spark session, scaled with the cores and
+        memory of the machine: default, laptop, single-node or cluster.
+        [FINK_SPARK_PROFILE]
+        """)
+    parser.add_argument(
+        '-input_rate', type=float, default=0.0,
+        help="""
+        Observed input rate in alerts per second. If positive, the number
+        of shuffle partitions is derived from it. 0 means the value of the
+        profile.
+        [FINK_INPUT_RATE]
+        """)
+    parser.add_argument(
+        '-dedup_delay', type=str, default='',
+        help="""
+        If set, alerts with the same candid received within this delay (e.g.
+        "24 hours", relative to their observation date) are deduplicated
+        before being written in the raw database. Alerts arriving later than
+        this are dropped. Empty means no deduplication. Alerts read from
+        alertdropdir are not deduplicated.
+        [FINK_DEDUP_DELAY]
+        """)
+    parser.add_argument(
+        '-keep_avro_payload', type=str, default='false',
+        help="""
+        If true, stream2raw keeps the original Avro data of the alerts, and
+        the distribution publishes it as is followed by the Fink fields
+        (pass-through mode), instead of encoding the alerts again. Note that
+        the original Avro data contains the cutouts.
+        [FINK_KEEP_AVRO_PAYLOAD]
+        """)
     parser.add_argument(
         '-rawdatapath', type=str, default='',
         help="""
@@ -71,6 +162,90 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
         Directory on disk for tmp scientific alerts.
         [FINK_ALERT_PATH_SCI_TMP]
         """)
+    parser.add_argument(
+        '-resume_window', type=float, default=0.0,
+        help="""
+        Consumers of the raw and science databases (raw2science,
+        distribution) only read the hourly partitions of the last
+        `resume_window` hours: the other partitions are pruned before
+        their files are read.
+        0 means no window.
+        [FINK_RESUME_WINDOW]
+        """)
+    parser.add_argument(
+        '-maxfileage', type=float, default=0.0,
+        help="""
+        Files older than `maxfileage` hours are not considered as new by the
+        consumers of the raw and science databases, and closed partitions
+        older than this are compacted by the compaction service.
+        0 means 7 days (Spark default).
+        [FINK_MAX_FILE_AGE]
+        """)
+    parser.add_argument(
+        '-compaction_target_size', type=int, default=128,
+        help="""
+        Target size of the files written by the compaction service, in MB.
+        [FINK_COMPACTION_TARGET_SIZE]
+        """)
+    parser.add_argument(
+        '-compaction_dedup', type=str, default='false',
+        help="""
+        If true, the compaction service also drops the alerts with the same
+        candid in compacted partitions.
+        [FINK_COMPACTION_DEDUP]
+        """)
+    parser.add_argument(
+        '-archive_index', type=str, default='false',
+        help="""
+        If true, the compaction service also maintains the objectId/candid
+        index of the raw and science databases, used for point lookups.
+        [FINK_ARCHIVE_INDEX]
+        """)
+    parser.add_argument(
+        '-compaction_interval', type=int, default=3600,
+        help="""
+        Time interval between two passes of the compaction service,
+        in seconds.
+        [FINK_COMPACTION_INTERVAL]
+        """)
+    parser.add_argument(
+        '-cutoutdatapath', type=str, default='',
+        help="""
+        Directory on disk for saving the cutouts of alerts, separately from
+        the raw database (keyed by candid). It is written by the query of
+        the raw database. Empty means that cutouts are kept in the raw
+        database.
+        [FINK_ALERT_PATH_CUTOUTS]
+        """)
+    parser.add_argument(
+        '-detectiondatapath', type=str, default='',
+        help="""
+        Directory on disk for saving the previous detections of alerts
+        (prv_candidates) once, keyed by (objectId, jd, fid), instead of
+        in each alert of the raw database. Empty means that prv_candidates
+        are kept in the raw database.
+        [FINK_ALERT_PATH_DETECTIONS]
+        """)
+    parser.add_argument(
+        '-lightcurvedatapath', type=str, default='',
+        help="""
+        Directory on disk for the light-curve store, with the full history
+        of the detections of each object. It is updated by raw2science, and
+        read by processors having arguments named lc_<field>. It must be
+        accessible from the executors. Empty means no light-curve store.
+        [FINK_ALERT_PATH_LIGHTCURVES]
+        """)
+    parser.add_argument(
+        '-objectsummarypath', type=str, default='',
+        help="""
+        Directory on disk for the summary of objects (first/last seen,
+        number of alerts, last class and magnitudes) and the Bloom filter
+        of known objectIds, updated by raw2science. Alerts are then flagged
+        with a `new_object` column, which lags behind the summary: all
+        alerts of an object until the summary includes it are new. It must
+        be accessible from the executors. Empty means no summary.
+        [FINK_ALERT_PATH_OBJECTS]
+        """)
     parser.add_argument(
         '-checkpointpath_raw', type=str, default='',
         help="""
@@ -81,6 +256,22 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
         structured-streaming-programming-guide.html#starting-streaming-queries
         [FINK_ALERT_CHECKPOINT_RAW]
         """)
+    parser.add_argument(
+        '-checkpointpath_lightcurves', type=str, default='',
+        help="""
+        The location where the system will write all the checkpoint information
+        for the light-curve store. This should be a directory in an
+        HDFS-compatible fault-tolerant file system.
+        [FINK_ALERT_CHECKPOINT_LIGHTCURVES]
+        """)
+    parser.add_argument(
+        '-checkpointpath_objects', type=str, default='',
+        help="""
+        The location where the system will write all the checkpoint information
+        for the summary of objects. This should be a directory in an
+        HDFS-compatible fault-tolerant file system.
+        [FINK_ALERT_CHECKPOINT_OBJECTS]
+        """)
     parser.add_argument(
         '-checkpointpath_sci_tmp', type=str, default='',
         help="""
@@ -123,6 +314,56 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
         The path of HBase catalog
         [SCIENCE_DB_CATALOG]
         """)
+    parser.add_argument(
+        '-science_db_rowkey', type=str, default='candid',
+        help="""
+        Comma-separated columns of the rowkey of the HBase table, e.g.
+        objectId,candidate.jd to keep the alerts of an object together.
+        A single column is used as is, otherwise a composite rowkey column
+        is added.
+        [SCIENCE_DB_ROWKEY]
+        """)
+    parser.add_argument(
+        '-science_db_salt_buckets', type=int, default=0,
+        help="""
+        Number of salt buckets prefixing the rowkey of the HBase table,
+        computed from its first column, such that successive alerts are
+        spread over the regions. 0 means no salt.
+        [SCIENCE_DB_SALT_BUCKETS]
+        """)
+    parser.add_argument(
+        '-science_db_regions', type=int, default=0,
+        help="""
+        Number of regions of the HBase table, pre-split from the
+        distribution of the rowkeys if the table does not exist. 0 means
+        the table must exist.
+        [SCIENCE_DB_REGIONS]
+        """)
+    parser.add_argument(
+        '-hbase_stream', type=str, default='false',
+        help="""
+        If true, raw2science also writes the alerts of the tmp science
+        database into the HBase science table (science_db_name,
+        science_db_catalog) with batched Puts, with its checkpoints in
+        checkpointpath_sci. distribute then marks the distributed alerts
+        in the table, from the offsets in checkpointpath_dist.
+        [FINK_HBASE_STREAM]
+        """)
+    parser.add_argument(
+        '-hfilepath', type=str, default='',
+        help="""
+        Directory of the HFiles written by the HBase backfill, before
+        their bulk load into the science table.
+        [FINK_HFILE_PATH]
+        """)
+    parser.add_argument(
+        '-bulkload', type=str, default='true',
+        help="""
+        If true, the HBase backfill loads the HFiles into the science table.
+        Otherwise they are only written (e.g. to be loaded later with
+        completebulkload).
+        [FINK_HBASE_BULKLOAD]
+        """)
     parser.add_argument(
         '-log_level', type=str, default='',
         help="""
@@ -186,6 +427,15 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
         The path where the avro schema for alert distribution is stored
         [DISTRIBUTION_SCHEMA]
         """)
+    parser.add_argument(
+        '-distribution_registry', type=str, default='',
+        help="""
+        Directory of the (file-backed) schema registry for alert
+        distribution. If set, distribution schemas are registered under
+        the subjects <topic>-value, and each Kafka message is framed with
+        the ID of its schema (Confluent wire format).
+        [DISTRIBUTION_REGISTRY]
+        """)
     parser.add_argument(
         '-startingOffset_dist', type=str, default='',
         help="""From which offset(timestamp) you want to start the
@@ -196,8 +446,9 @@ def getargs(parser: argparse.ArgumentParser) -> argparse.Namespace:
     parser.add_argument(
         '-checkpointpath_dist', type=str, default='',
         help="""
-        The path of file in which to store the offset for distribution service.
-        This file will store the timestamp up-till which the science db is
+        The path of the offset store for distribution service (a directory;
+        a legacy offset file is converted on the first commit).
+        It stores, per topic, the timestamp up-till which the science db is
         scanned and alerts have been distributed.
         [DISTRIBUTION_OFFSET_FILE]
         """)
@@ -0,0 +1,1148 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Registry of alert schemas, to decode streams mixing several
+schema versions (or surveys) without restarting the services.
+"""
+from pyspark.sql import DataFrame
+from pyspark.sql.column import Column
+from pyspark.sql.functions import expr, when, lit, concat
+
+import io
+import os
+import json
+import struct
+import fastavro
+
+from fink_broker.avroUtils import readschemafromavrofile
+from fink_broker.avroUtils import canonicalschema, schemafingerprint
+from fink_broker.sparkUtils import from_avro
+from fink_broker.tester import spark_unit_tests
+
+# Header of the Avro single-object encoding: 2 marker bytes followed
+# by the 8-byte (little-endian) CRC-64-AVRO fingerprint of the writer schema.
+SINGLE_OBJECT_MARKER = b"\xc3\x01"
+SINGLE_OBJECT_HEADER_SIZE = 10
+
+# Header of the Confluent wire format: a zero magic byte followed by the
+# 4-byte (big-endian) ID of the writer schema in the schema registry.
+CONFLUENT_MAGIC_BYTE = b"\x00"
+CONFLUENT_HEADER_SIZE = 5
+
+# Columns keeping the original Avro data of the alerts, and the version of
+# their writer schema (see payload and version_column)
+PAYLOAD_COLUMN = "avro_payload"
+PAYLOAD_VERSION_COLUMN = "avro_version"
+
+# Avro primitive types and their Spark SQL counterparts
+AVRO_TO_DDL = {
+    "boolean": "boolean",
+    "int": "int",
+    "long": "bigint",
+    "float": "float",
+    "double": "double",
+    "bytes": "binary",
+    "string": "string",
+    "enum": "string",
+    "fixed": "binary"
+}
+
+# All Avro types, primitives and complex
+AVRO_TYPES = list(AVRO_TO_DDL.keys()) + [
+    "null", "record", "error", "array", "map"]
+
+def _nonnull(avrotype):
+    """ Strip the null branch of an optional Avro type ([T, null] -> T).
+
+    Parameters
+    ----------
+    avrotype: str, list or dict
+        Avro type
+
+    Returns
+    ----------
+    out: str or dict
+        Avro type without the null branch.
+
+    Examples
+    ----------
+    >>> _nonnull(["null", "double"])
+    'double'
+    >>> _nonnull(["string", "int", "null"])
+    Traceback (most recent call last):
+     ...
+    ValueError: Unsupported union ['string', 'int', 'null']: only [T, null] unions are supported
+    """
+    if isinstance(avrotype, list):
+        branches = [i for i in avrotype if i != "null"]
+        if len(branches) != 1:
+            raise ValueError(
+                "Unsupported union {}: only [T, null] unions are "
+                "supported".format(avrotype))
+        return branches[0]
+    return avrotype
+
+def expand_named_types(schema, namespace: str = "", names: dict = None):
+    """ Replace references to named types (records, enums, fixed) by
+    their definition, such that each sub-schema is self-contained.
+
+    Parameters
+    ----------
+    schema: str, list or dict
+        Avro schema
+    namespace: str, optional
+        Enclosing namespace.
+    names: dict, optional
+        Named types already defined, keyed by full name.
+
+    Returns
+    ----------
+    out: str, list or dict
+        Avro schema without references.
+
+    Examples
+    ----------
+    >>> schema = {"type": "record", "name": "alert", "fields": [
+    ...     {"name": "science", "type": {
+    ...         "type": "record", "name": "cutout",
+    ...         "fields": [{"name": "stampData", "type": "bytes"}]}},
+    ...     {"name": "template", "type": "cutout"}]}
+    >>> expand_named_types(schema)["fields"][1]["type"]["fields"]
+    [{'name': 'stampData', 'type': 'bytes'}]
+    """
+    if names is None:
+        names = {}
+
+    if isinstance(schema, list):
+        return [expand_named_types(i, namespace, names) for i in schema]
+
+    if isinstance(schema, str):
+        fullname = schema
+        if "." not in schema and namespace != "":
+            fullname = "{}.{}".format(namespace, schema)
+        return names.get(fullname, names.get(schema, schema))
+
+    out = dict(schema)
+    kind = out["type"]
+    if not isinstance(kind, str) or kind not in AVRO_TYPES:
+        return expand_named_types(kind, namespace, names)
+
+    if kind in ["record", "error", "enum", "fixed"]:
+        name = out["name"]
+        space = out.get("namespace", namespace)
+        if "." not in name and space:
+            name = "{}.{}".format(space, name)
+        names[name] = out
+        namespace = name.rsplit(".", 1)[0] if "." in name else ""
+
+    if kind in ["record", "error"]:
+        out["fields"] = [
+            dict(field, type=expand_named_types(
+                field["type"], namespace, names))
+            for field in out["fields"]]
+    elif kind == "array":
+        out["items"] = expand_named_types(out["items"], namespace, names)
+    elif kind == "map":
+        out["values"] = expand_named_types(out["values"], namespace, names)
+
+    return out
+
+def _kind(avrotype) -> str:
+    """ Return the name of the (non-null) Avro type """
+    avrotype = _nonnull(avrotype)
+    if isinstance(avrotype, dict):
+        return avrotype["type"]
+    return avrotype
+
+def avro_to_ddl(avrotype) -> str:
+    """ Convert an Avro type into a Spark SQL (DDL) type,
+    following the conversion rules of `from_avro`.
+
+    Parameters
+    ----------
+    avrotype: str, list or dict
+        Avro type
+
+    Returns
+    ----------
+    ddl: str
+        Spark SQL type
+
+    Examples
+    ----------
+    >>> avro_to_ddl(["null", "long"])
+    'bigint'
+
+    >>> avro_to_ddl({"type": "array", "items": {
+    ...     "type": "record", "name": "prv", "fields": [
+    ...         {"name": "jd", "type": "double"},
+    ...         {"name": "fid", "type": ["int", "null"]}]}})
+    'array<struct<`jd`:double,`fid`:int>>'
+    """
+    avrotype = _nonnull(avrotype)
+    kind = _kind(avrotype)
+
+    if isinstance(avrotype, dict):
+        logical = avrotype.get("logicalType", "")
+        if logical.startswith("timestamp"):
+            return "timestamp"
+        if logical == "date":
+            return "date"
+
+    if kind == "record":
+        fields = [
+            "`{}`:{}".format(i["name"], avro_to_ddl(i["type"]))
+            for i in avrotype["fields"]]
+        return "struct<{}>".format(",".join(fields))
+    if kind == "array":
+        return "array<{}>".format(avro_to_ddl(avrotype["items"]))
+    if kind == "map":
+        return "map<string,{}>".format(avro_to_ddl(avrotype["values"]))
+    return AVRO_TO_DDL[kind]
+
+def projection_expr(colname: str, writer, reader, depth: int = 0) -> str:
+    """ Build the Spark SQL expression projecting data decoded with a
+    writer schema into a reader schema.
+
+    Fields missing in the writer are filled with nulls, fields missing
+    in the reader are dropped, and primitive types are promoted (e.g. int
+    to long) following the Avro schema resolution rules.
+
+    Parameters
+    ----------
+    colname: str
+        SQL expression of the data decoded with the writer schema.
+    writer: str, list or dict
+        Writer Avro type
+    reader: str, list or dict
+        Reader Avro type
+    depth: int, optional
+        Nesting level of arrays, used to name lambda variables.
+
+    Returns
+    ----------
+    out: str
+        Spark SQL expression.
+
+    Examples
+    ----------
+    >>> writer = {"type": "record", "name": "c", "fields": [
+    ...     {"name": "jd", "type": "double"},
+    ...     {"name": "fid", "type": "int"}]}
+    >>> reader = {"type": "record", "name": "c", "fields": [
+    ...     {"name": "jd", "type": "double"},
+    ...     {"name": "fid", "type": "long"},
+    ...     {"name": "drb", "type": ["null", "float"]}]}
+    >>> print(projection_expr("decoded", writer, reader))
+    if(decoded IS NULL, NULL, named_struct('jd', decoded.`jd`, 'fid', CAST(decoded.`fid` AS bigint), 'drb', CAST(NULL AS float)))
+    """
+    wtype, rtype = _nonnull(writer), _nonnull(reader)
+
+    # Nothing to do if the two types are identical
+    if json.dumps(wtype, sort_keys=True) == json.dumps(rtype, sort_keys=True):
+        return colname
+
+    wkind, rkind = _kind(wtype), _kind(rtype)
+    if rkind == "record" and wkind == "record":
+        wfields = {i["name"]: i["type"] for i in wtype["fields"]}
+        args = []
+        for field in rtype["fields"]:
+            name = field["name"]
+            if name in wfields:
+                sub = projection_expr(
+                    "{}.`{}`".format(colname, name),
+                    wfields[name], field["type"], depth)
+            else:
+                sub = "CAST(NULL AS {})".format(avro_to_ddl(field["type"]))
+            args.append("'{}', {}".format(name, sub))
+        return "if({} IS NULL, NULL, named_struct({}))".format(
+            colname, ", ".join(args))
+
+    if rkind == "array" and wkind == "array":
+        var = "x{}".format(depth)
+        sub = projection_expr(
+            var, wtype["items"], rtype["items"], depth + 1)
+        return "transform({}, {} -> {})".format(colname, var, sub)
+
+    # Promotion of primitive types (maps are cast as a whole)
+    return "CAST({} AS {})".format(colname, avro_to_ddl(rtype))
+
+def project_datum(datum, writer, reader):
+    """ Project data decoded with a writer schema into a reader schema.
+    This is the Python counterpart of `projection_expr`: fields
+    missing in the writer are set to None, and extra fields are dropped.
+
+    Parameters
+    ----------
+    datum: Any
+        Data decoded with the writer schema.
+    writer: str, list or dict
+        Writer Avro type
+    reader: str, list or dict
+        Reader Avro type
+
+    Returns
+    ----------
+    out: Any
+        Data following the reader schema.
+
+    Examples
+    ----------
+    >>> writer = {"type": "record", "name": "c", "fields": [
+    ...     {"name": "jd", "type": "double"},
+    ...     {"name": "fid", "type": "int"}]}
+    >>> reader = {"type": "record", "name": "c", "fields": [
+    ...     {"name": "jd", "type": "double"},
+    ...     {"name": "drb", "type": ["null", "float"]}]}
+    >>> project_datum({"jd": 2458451.75, "fid": 1}, writer, reader)
+    {'jd': 2458451.75, 'drb': None}
+    """
+    if datum is None:
+        return None
+
+    wtype, rtype = _nonnull(writer), _nonnull(reader)
+    wkind, rkind = _kind(wtype), _kind(rtype)
+    if rkind == "record" and wkind == "record":
+        wfields = {i["name"]: i["type"] for i in wtype["fields"]}
+        return {
+            field["name"]: project_datum(
+                datum.get(field["name"]), wfields[field["name"]],
+                field["type"]) if field["name"] in wfields else None
+            for field in rtype["fields"]}
+
+    if rkind == "array" and wkind == "array":
+        return [
+            project_datum(i, wtype["items"], rtype["items"]) for i in datum]
+
+    return datum
+
+class AlertSchemaRegistry():
+    """ Hold several writer schemas of alerts, keyed by version.
+
+    Each message is routed to the writer schema used to encode it, either
+    by its Kafka topic or by the schema fingerprint contained in the
+    Avro single-object encoding header. Decoded data is then projected into
+    one unified reader schema, such that downstream services always see
+    the same DataFrame schema.
+
+    Parameters
+    ----------
+    reader_version: str, optional
+        Version of the reader schema. If None (default), the first
+        registered schema is used as the reader schema.
+
+    Examples
+    ----------
+    >>> registry = AlertSchemaRegistry()
+    >>> registry.register_from_avro(ztf_alert_sample)
+    '3.3'
+    >>> registry.register_from_avro(ztf_alert_sample_3p1, topics=["ztf_old"])
+    '3.1'
+    >>> registry.versions
+    ['3.3', '3.1']
+    >>> registry.reader_version
+    '3.3'
+
+    # Route by topic or by fingerprint
+    >>> registry.route(topic="ztf_old")
+    '3.1'
+    >>> registry.route(fingerprint=registry.fingerprint("3.1"))
+    '3.1'
+    >>> registry.route(topic="unknown_topic")
+    '3.3'
+    """
+    def __init__(self, reader_version: str = None):
+        self._schemas = {}
+        self._fingerprints = {}
+        self._topics = {}
+        self._parsed = {}
+        self._expanded = {}
+        self._reader_version = reader_version
+
+    @property
+    def versions(self) -> list:
+        """ Registered versions, in registration order """
+        return list(self._schemas.keys())
+
+    @property
+    def reader_version(self) -> str:
+        """ Version of the unified reader schema """
+        if self._reader_version is None and self._schemas:
+            return self.versions[0]
+        return self._reader_version
+
+    @property
+    def reader_schema(self) -> dict:
+        """ Unified reader schema """
+        return self.schema(self.reader_version)
+
+    def register(
+            self, schema: dict, version: str = None,
+            topics: list = None) -> str:
+        """ Register a writer schema.
+
+        Parameters
+        ----------
+        schema: dict
+            Avro schema
+        version: str, optional
+            Key of the schema. Default is the `version` attribute of the
+            schema if present, otherwise its fingerprint in hexadecimal.
+        topics: list of str, optional
+            Kafka topics whose messages are encoded with this schema.
+
+        Returns
+        ----------
+        version: str
+            Key of the registered schema.
+        """
+        fingerprint = schemafingerprint(schema)
+        if version is None:
+            version = str(schema.get("version", "{:016x}".format(fingerprint)))
+
+        if version in self._schemas and \
+                canonicalschema(self._schemas[version]) != \
+                canonicalschema(schema):
+            raise ValueError(
+                "Version {} is already registered with a different schema"
+                .format(version))
+
+        self._schemas[version] = schema
+        self._expanded[version] = expand_named_types(schema)
+        self._fingerprints[fingerprint] = version
+        for topic in (topics or []):
+            self._topics[topic] = version
+
+        return version
+
+    def register_from_avro(
+            self, fn: str, version: str = None, topics: list = None) -> str:
+        """ Register the schema embedded in an Avro file.
+        See `register` for the parameters.
+        """
+        return self.register(readschemafromavrofile(fn), version, topics)
+
+    def schema(self, version: str) -> dict:
+        """ Return the writer schema registered under `version` """
+        return self._schemas[version]
+
+    def fingerprint(self, version: str) -> int:
+        """ Return the CRC-64-AVRO fingerprint of a registered schema """
+        return schemafingerprint(self._schemas[version])
+
+    def expanded(self, version: str) -> dict:
+        """ Return the schema without named type references """
+        return self._expanded[version]
+
+    def parsed(self, version: str) -> dict:
+        """ Return the parsed schema (cached) for fastavro """
+        if version not in self._parsed:
+            self._parsed[version] = fastavro.parse_schema(
+                self._schemas[version])
+        return self._parsed[version]
+
+    def route(self, topic: str = None, fingerprint: int = None) -> str:
+        """ Return the version of the writer schema for a message.
+
+        The fingerprint has precedence over the topic. Messages that
+        cannot be routed are decoded with the reader schema.
+
+        Parameters
+        ----------
+        topic: str, optional
+            Kafka topic of the message.
+        fingerprint: int, optional
+            Fingerprint found in the single-object encoding header.
+
+        Returns
+        ----------
+        version: str
+            Version of the writer schema.
+        """
+        if fingerprint is not None:
+            if fingerprint not in self._fingerprints:
+                raise KeyError(
+                    "Unknown schema fingerprint {:016x}".format(fingerprint))
+            return self._fingerprints[fingerprint]
+        return self._topics.get(topic, self.reader_version)
+
+    def encode(self, record: dict, version: str) -> bytes:
+        """ Encode a record using the Avro single-object encoding.
+
+        Parameters
+        ----------
+        record: dict
+            Alert data
+        version: str
+            Version of the writer schema.
+
+        Returns
+        ----------
+        message: bytes
+            Header followed by the Avro binary data.
+        """
+        bytes_io = io.BytesIO()
+        bytes_io.write(SINGLE_OBJECT_MARKER)
+        bytes_io.write(struct.pack("<Q", self.fingerprint(version)))
+        fastavro.schemaless_writer(bytes_io, self.parsed(version), record)
+        return bytes_io.getvalue()
+
+    def decode(self, message: bytes, topic: str = None) -> dict:
+        """ Decode one message into the reader schema.
+
+        Parameters
+        ----------
+        message: bytes
+            Avro binary data, with or without single-object header.
+        topic: str, optional
+            Kafka topic of the message.
+
+        Returns
+        ----------
+        record: dict
+            Alert data, following the reader schema.
+
+        Examples
+        ----------
+        >>> registry = AlertSchemaRegistry()
+        >>> _ = registry.register_from_avro(ztf_alert_sample)
+        >>> _ = registry.register_from_avro(ztf_alert_sample_3p1)
+
+        >>> with open(ztf_alert_sample_3p1, mode='rb') as file_data:
+        ...     alert = next(fastavro.reader(file_data))
+        >>> "drb" in alert["candidate"]
+        False
+
+        # Old alerts are projected into the 3.3 schema
+        >>> record = registry.decode(registry.encode(alert, "3.1"))
+        >>> record["candid"] == alert["candid"]
+        True
+        >>> print(record["candidate"]["drb"])
+        None
+        """
+        fingerprint = None
+        if message[:2] == SINGLE_OBJECT_MARKER:
+            fingerprint = struct.unpack(
+                "<Q", message[2:SINGLE_OBJECT_HEADER_SIZE])[0]
+            message = message[SINGLE_OBJECT_HEADER_SIZE:]
+
+        version = self.route(topic=topic, fingerprint=fingerprint)
+        datum = fastavro.schemaless_reader(
+            io.BytesIO(message), self.parsed(version))
+        if version == self.reader_version:
+            return datum
+        return project_datum(
+            datum, self.expanded(version), self.expanded(self.reader_version))
+
+    def reader_ddl(self) -> str:
+        """ Reader schema as a Spark DDL string (one column per field),
+        following the conversion rules of `from_avro`.
+
+        Examples
+        ----------
+        >>> registry = AlertSchemaRegistry()
+        >>> version = registry.register({
+        ...     "type": "record", "name": "test", "version": "1",
+        ...     "fields": [
+        ...         {"name": "objectId", "type": "string"},
+        ...         {"name": "jd", "type": ["null", "double"]}]})
+        >>> registry.reader_ddl()
+        '`objectId` string, `jd` double'
+        """
+        reader = self.expanded(self.reader_version)
+        return ", ".join(
+            "`{}` {}".format(field["name"], avro_to_ddl(field["type"]))
+            for field in reader["fields"])
+
+    def _condition(self, version: str, valuecol: str, topiccol: str) -> str:
+        """ SQL condition selecting the messages encoded with `version` """
+        header = SINGLE_OBJECT_MARKER + struct.pack(
+            "<Q", self.fingerprint(version))
+        conditions = ["substring({}, 1, {}) = X'{}'".format(
+            valuecol, SINGLE_OBJECT_HEADER_SIZE, header.hex())]
+
+        topics = [k for k, v in self._topics.items() if v == version]
+        if topics:
+            conditions.append(
+                "(substring({}, 1, 2) != X'{}' AND {} IN ({}))".format(
+                    valuecol, SINGLE_OBJECT_MARKER.hex(), topiccol,
+                    ", ".join(["'{}'".format(i) for i in topics])))
+
+        return " OR ".join(conditions)
+
+    def _conditions(self, valuecol: str, topiccol: str) -> dict:
+        """ SQL conditions routing the messages to their writer schema.
+        Messages that cannot be routed go to the reader schema.
+        """
+        conditions = {
+            version: self._condition(version, valuecol, topiccol)
+            for version in self.versions}
+        others_conditions = [
+            "({})".format(v) for k, v in conditions.items()
+            if k != self.reader_version]
+        if others_conditions:
+            conditions[self.reader_version] = "({}) OR NOT ({})".format(
+                conditions[self.reader_version],
+                " OR ".join(others_conditions))
+        return conditions
+
+    def payload(self, valuecol: str = "value") -> Column:
+        """ Avro binary data of the messages, without the single-object
+        encoding header if any.
+
+        Parameters
+        ----------
+        valuecol: str, optional
+            Name of the column with Avro data. Default is `value`.
+
+        Returns
+        ----------
+        out: Column
+
+        Examples
+        ----------
+        >>> registry = AlertSchemaRegistry()
+        >>> version = registry.register({
+        ...     "type": "record", "name": "test", "version": "1",
+        ...     "fields": [{"name": "a", "type": "int"}]})
+        >>> df = spark.createDataFrame(
+        ...     [(bytearray(registry.encode({"a": 1}, "1")),)], ["value"])
+        >>> df.select(registry.payload().alias("body")).first().body
+        bytearray(b'\\x02')
+        """
+        return expr(
+            "CASE WHEN substring({}, 1, 2) = X'{}' "
+            "THEN substring({}, {}) ELSE {} END".format(
+                valuecol, SINGLE_OBJECT_MARKER.hex(), valuecol,
+                SINGLE_OBJECT_HEADER_SIZE + 1, valuecol))
+
+    def version_column(
+            self, valuecol: str = "value", topiccol: str = "topic") -> Column:
+        """ Version of the writer schema of the messages, routed as in
+        `decode_dataframe`.
+
+        Parameters
+        ----------
+        valuecol: str, optional
+            Name of the column with Avro data. Default is `value`.
+        topiccol: str, optional
+            Name of the column with the topic name. Default is `topic`.
+
+        Returns
+        ----------
+        out: Column
+            Version (string) of the writer schema.
+
+        Examples
+        ----------
+        >>> registry = AlertSchemaRegistry()
+        >>> _ = registry.register_from_avro(ztf_alert_sample)
+        >>> _ = registry.register_from_avro(ztf_alert_sample_3p1)
+        >>> with open(ztf_alert_sample_3p1, mode='rb') as file_data:
+        ...     alert_3p1 = next(fastavro.reader(file_data))
+        >>> df = spark.createDataFrame(
+        ...     [(bytearray(registry.encode(alert_3p1, "3.1")), "ztf")],
+        ...     ["value", "topic"])
+        >>> df.select(registry.version_column().alias("v")).first().v
+        '3.1'
+        """
+        if len(self._schemas) == 1:
+            return lit(self.reader_version)
+
+        conditions = self._conditions(valuecol, topiccol)
+        return expr("CASE {} END".format(" ".join(
+            "WHEN {} THEN '{}'".format(conditions[version], version)
+            for version in self.versions)))
+
+    def decode_dataframe(
+            self, df: DataFrame, valuecol: str = "value",
+            topiccol: str = "topic", alias: str = "decoded") -> DataFrame:
+        """ Decode the Avro column of a (streaming) DataFrame,
+        routing each row to its writer schema and projecting the result
+        into the reader schema.
+
+        With only one registered schema, this is equivalent to
+        `from_avro(df[valuecol], schema)` (after removing the single-object
+        encoding header if present).
+
+        Parameters
+        ----------
+        df: DataFrame
+            DataFrame with Avro data, typically read from Kafka.
+        valuecol: str, optional
+            Name of the column with Avro data. Default is `value`.
+        topiccol: str, optional
+            Name of the column with the topic name. Default is `topic`.
+        alias: str, optional
+            Name of the column with decoded data. Default is `decoded`.
+
+        Returns
+        ----------
+        out: DataFrame
+            Input DataFrame without `valuecol`, plus the column `alias`.
+
+        Examples
+        ----------
+        >>> registry = AlertSchemaRegistry()
+        >>> _ = registry.register_from_avro(ztf_alert_sample)
+        >>> _ = registry.register_from_avro(ztf_alert_sample_3p1)
+
+        >>> with open(ztf_alert_sample_3p1, mode='rb') as file_data:
+        ...     alert_3p1 = next(fastavro.reader(file_data))
+        >>> with open(ztf_alert_sample, mode='rb') as file_data:
+        ...     alert_3p3 = next(fastavro.reader(file_data))
+
+        >>> df = spark.createDataFrame([
+        ...     (bytearray(registry.encode(alert_3p1, "3.1")), "ztf"),
+        ...     (bytearray(registry.encode(alert_3p3, "3.3")), "ztf")],
+        ...     ["value", "topic"])
+        >>> df_decoded = registry.decode_dataframe(df)
+        >>> df_decoded.select("decoded.candidate.drb").count()
+        2
+        """
+        others = [i for i in df.columns if i != valuecol]
+        reader = self.expanded(self.reader_version)
+        body = self.payload(valuecol)
+
+        if len(self._schemas) == 1:
+            return df.select(
+                others + [from_avro(body, json.dumps(
+                    self.reader_schema)).alias(alias)])
+
+        # Decode each row with its writer schema only. Rows that cannot
+        # be routed are decoded with the reader schema.
+        conditions = self._conditions(valuecol, topiccol)
+
+        projections = []
+        for index, version in enumerate(self.versions):
+            tmpcol = "_decoded_{}".format(index)
+            df = df.withColumn(
+                tmpcol,
+                when(
+                    expr(conditions[version]),
+                    from_avro(body, json.dumps(self.schema(version)))))
+            projections.append(
+                projection_expr(tmpcol, self.expanded(version), reader))
+
+        decoded = "coalesce({}) AS {}".format(", ".join(projections), alias)
+
+        return df.selectExpr(others + [decoded])
+
+def build_registry(schemas: str, topics: str = "") -> AlertSchemaRegistry:
+    """ Build a registry from the command line arguments of the services.
+
+    Parameters
+    ----------
+    schemas: str
+        Comma-separated list of Avro files containing alert schemas.
+        The first one defines the reader schema.
+    topics: str, optional
+        Comma-separated list of `topic:version` routing rules. Topics
+        not listed are routed by fingerprint, or decoded with the
+        reader schema.
+
+    Returns
+    ----------
+    registry: AlertSchemaRegistry
+
+    Examples
+    ----------
+    >>> registry = build_registry(
+    ...     ",".join([ztf_alert_sample, ztf_alert_sample_3p1]),
+    ...     "ztf_20191101:3.1")
+    >>> registry.route(topic="ztf_20191101")
+    '3.1'
+    """
+    registry = AlertSchemaRegistry()
+    for fn in schemas.split(","):
+        if fn.strip() != "":
+            registry.register_from_avro(fn.strip())
+
+    rules = [i.split(":") for i in topics.split(",") if i.strip() != ""]
+    for topic, version in rules:
+        registry.register(
+            registry.schema(version.strip()), version.strip(),
+            topics=[topic.strip()])
+
+    return registry
+
+
+def confluent_header(schema_id: int) -> bytes:
+    """ Header of a message in the Confluent wire format.
+
+    Examples
+    ----------
+    >>> confluent_header(3)
+    b'\\x00\\x00\\x00\\x00\\x03'
+    """
+    return CONFLUENT_MAGIC_BYTE + struct.pack(">I", schema_id)
+
+class FileSchemaRegistry():
+    """ Local, file-backed stand-in for a Confluent Schema Registry.
+
+    Schemas get an integer ID, and are registered under subjects (by
+    convention `<topic>-value`). Messages are framed with the ID of their
+    writer schema (Confluent wire format), such that consumers resolve the
+    schema of each message from the registry, and decode topics mixing
+    several schemas without coordination.
+
+    Registered schemas are immutable files (`schemas/<id>.avsc`), as are
+    the versions of subjects (`subjects/<subject>/<version>.json`). Files are
+    created atomically and never overwritten, hence several processes can
+    share a registry on a local or shared file system. Schemas are cached
+    in memory once read.
+
+    Parameters
+    ----------
+    path: str
+        Root directory of the registry.
+
+    Examples
+    ----------
+    >>> registry = FileSchemaRegistry("test_registry")
+    >>> schema = {
+    ...     "type": "record", "name": "test",
+    ...     "fields": [{"name": "a", "type": "int"}]}
+    >>> registry.register("rrlyr-value", schema)
+    1
+    >>> registry.register("other-value", schema)
+    1
+    >>> schema2 = {
+    ...     "type": "record", "name": "test",
+    ...     "fields": [{"name": "a", "type": "int"},
+    ...                {"name": "b", "type": ["string", "null"]}]}
+    >>> registry.register("rrlyr-value", schema2)
+    2
+    >>> registry.ids("rrlyr-value")
+    [1, 2]
+
+    # Another process resolves schemas from the files
+    >>> FileSchemaRegistry("test_registry").latest("rrlyr-value")
+    2
+    >>> FileSchemaRegistry("test_registry").schema(2) == schema2
+    True
+
+    # Messages of both schemas are decoded
+    >>> messages = [
+    ...     registry.encode({"a": 1}, 1),
+    ...     registry.encode({"a": 2, "b": "x"}, 2)]
+    >>> messages[0]
+    b'\\x00\\x00\\x00\\x00\\x01\\x02'
+    >>> [registry.decode(m) for m in messages]
+    [{'a': 1}, {'a': 2, 'b': 'x'}]
+
+    # or projected into the latest schema of a subject
+    >>> registry.decode(messages[0], reader_id=2)
+    {'a': 1, 'b': None}
+
+    >>> import shutil
+    >>> shutil.rmtree("test_registry")
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._schemas = {}
+        self._ids = {}
+        self._parsed = {}
+        # last schema ID registered by this instance, per subject
+        self._subjects = {}
+
+    def _dir(self, *names) -> str:
+        """ Create and return a directory of the registry """
+        path = os.path.join(self.path, *names)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def _entries(path: str) -> list:
+        """ Sorted (index, filename) of the files of a directory """
+        entries = []
+        for fn in os.listdir(path):
+            root = os.path.splitext(fn)[0]
+            if root.isdigit():
+                entries.append((int(root), fn))
+        return sorted(entries)
+
+    @staticmethod
+    def _create(path: str, content) -> bool:
+        """ Atomically create a file, unless it already exists """
+        tmp = "{}.tmp-{}".format(path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(content, f)
+        try:
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+
+    def _refresh(self):
+        """ Read the schemas registered since the last refresh """
+        path = self._dir("schemas")
+        for schema_id, fn in self._entries(path):
+            if schema_id not in self._schemas:
+                with open(os.path.join(path, fn)) as f:
+                    schema = json.load(f)
+                self._schemas[schema_id] = schema
+                self._ids.setdefault(canonicalschema(schema), schema_id)
+
+    def schema(self, schema_id: int) -> dict:
+        """ Return the schema registered under `schema_id` """
+        if schema_id not in self._schemas:
+            self._refresh()
+        if schema_id not in self._schemas:
+            raise KeyError("Unknown schema ID {}".format(schema_id))
+        return self._schemas[schema_id]
+
+    def parsed(self, schema_id: int) -> dict:
+        """ Return the parsed schema (cached) for fastavro """
+        if schema_id not in self._parsed:
+            self._parsed[schema_id] = fastavro.parse_schema(
+                self.schema(schema_id))
+        return self._parsed[schema_id]
+
+    def ids(self, subject: str = None) -> list:
+        """ IDs of the schemas of a subject (or all schemas), in
+        registration order
+        """
+        if subject is None:
+            self._refresh()
+            return sorted(self._schemas)
+        path = self._dir("subjects", subject)
+        ids = []
+        for _, fn in self._entries(path):
+            with open(os.path.join(path, fn)) as f:
+                schema_id = json.load(f)["id"]
+            if schema_id not in ids:
+                ids.append(schema_id)
+        return ids
+
+    def latest(self, subject: str) -> int:
+        """ ID of the last schema registered under `subject` """
+        ids = self.ids(subject)
+        if len(ids) == 0:
+            raise KeyError("Unknown subject {}".format(subject))
+        return ids[-1]
+
+    def register(self, subject: str, schema: dict) -> int:
+        """ Register a schema under a subject.
+
+        A schema already registered (same Parsing Canonical Form) keeps
+        its ID, and registering it again under the same subject is a no-op.
+
+        Parameters
+        ----------
+        subject: str
+            Subject, typically `<topic>-value`.
+        schema: dict
+            Avro schema.
+
+        Returns
+        ----------
+        schema_id: int
+            ID of the schema.
+        """
+        canonical = canonicalschema(schema)
+        if canonical not in self._ids:
+            self._refresh()
+        while canonical not in self._ids:
+            entries = self._entries(self._dir("schemas"))
+            schema_id = entries[-1][0] + 1 if len(entries) > 0 else 1
+            fn = os.path.join(self._dir("schemas"), "{}.avsc".format(schema_id))
+            self._create(fn, schema)
+            # concurrent registrations: the first file wins
+            self._refresh()
+        schema_id = self._ids[canonical]
+
+        if self._subjects.get(subject) != schema_id:
+            path = self._dir("subjects", subject)
+            ids = self.ids(subject)
+            while len(ids) == 0 or ids[-1] != schema_id:
+                entries = self._entries(path)
+                version = entries[-1][0] + 1 if len(entries) > 0 else 1
+                self._create(
+                    os.path.join(path, "{}.json".format(version)),
+                    {"id": schema_id})
+                ids = self.ids(subject)
+            self._subjects[subject] = schema_id
+
+        return schema_id
+
+    def encode(self, record: dict, schema_id: int) -> bytes:
+        """ Encode a record in the Confluent wire format.
+
+        Parameters
+        ----------
+        record: dict
+            Data
+        schema_id: int
+            ID of the writer schema.
+
+        Returns
+        ----------
+        message: bytes
+            Header followed by the Avro binary data.
+        """
+        bytes_io = io.BytesIO()
+        bytes_io.write(confluent_header(schema_id))
+        fastavro.schemaless_writer(bytes_io, self.parsed(schema_id), record)
+        return bytes_io.getvalue()
+
+    def decode(self, message: bytes, reader_id: int = None) -> dict:
+        """ Decode a message in the Confluent wire format, resolving its
+        writer schema from the registry.
+
+        Parameters
+        ----------
+        message: bytes
+            Header followed by the Avro binary data.
+        reader_id: int, optional
+            ID of a reader schema to project the data into. Default is
+            None, that is the data follow the writer schema.
+
+        Returns
+        ----------
+        record: dict
+        """
+        if message[:1] != CONFLUENT_MAGIC_BYTE or \
+                len(message) < CONFLUENT_HEADER_SIZE:
+            raise ValueError("Message is not in the Confluent wire format")
+        schema_id = struct.unpack(">I", message[1:CONFLUENT_HEADER_SIZE])[0]
+        datum = fastavro.schemaless_reader(
+            io.BytesIO(message[CONFLUENT_HEADER_SIZE:]),
+            self.parsed(schema_id))
+        if reader_id is None or reader_id == schema_id:
+            return datum
+        return project_datum(
+            datum, expand_named_types(self.schema(schema_id)),
+            expand_named_types(self.schema(reader_id)))
+
+    def frame(self, value: Column, schema_id: int) -> Column:
+        """ Prefix Avro binary data with the header of the Confluent
+        wire format.
+
+        Parameters
+        ----------
+        value: Column
+            Avro binary data.
+        schema_id: int
+            ID of the writer schema.
+
+        Returns
+        ----------
+        out: Column
+        """
+        header = confluent_header(schema_id)
+        return concat(expr("X'{}'".format(header.hex())), value)
+
+    def decode_dataframe(
+            self, df: DataFrame, subject: str = None,
+            valuecol: str = "value", alias: str = "decoded") -> DataFrame:
+        """ Decode the Avro column (Confluent wire format) of a (streaming)
+        DataFrame. Each row is decoded with the schema of its ID, and
+        projected into the latest schema of the subject.
+
+        Schemas registered after this call are not known by the returned
+        DataFrame: a row written with an unknown schema ID makes the
+        (micro-)batch fail, rather than being decoded as nulls, such that
+        the query is restarted with the schemas of the registry.
+
+        Parameters
+        ----------
+        df: DataFrame
+            DataFrame with Avro data, typically read from Kafka.
+        subject: str, optional
+            Subject of the data. Default is None, that is all schemas
+            of the registry, the reader schema being the last one.
+        valuecol: str, optional
+            Name of the column with Avro data. Default is `value`.
+        alias: str, optional
+            Name of the column with decoded data. Default is `decoded`.
+
+        Returns
+        ----------
+        out: DataFrame
+            Input DataFrame without `valuecol`, plus the column `alias`.
+
+        Examples
+        ----------
+        >>> registry = FileSchemaRegistry("test_registry")
+        >>> registry.register("test-value", {
+        ...     "type": "record", "name": "test",
+        ...     "fields": [{"name": "a", "type": "int"}]})
+        1
+        >>> message = registry.encode({"a": 1}, 1)
+        >>> df = spark.createDataFrame([(message,)], "value binary")
+        >>> registry.decode_dataframe(df).select("decoded.a").first()[0]
+        1
+
+        A message of a schema unknown to the registry fails the batch
+        >>> message = confluent_header(2) + message[CONFLUENT_HEADER_SIZE:]
+        >>> df = spark.createDataFrame([(message,)], "value binary")
+        >>> registry.decode_dataframe(df).collect()
+        ... # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        ...
+        Py4JJavaError: ...
+
+        >>> import shutil
+        >>> shutil.rmtree("test_registry")
+        """
+        ids = self.ids(subject)
+        if len(ids) == 0:
+            raise KeyError("No schema registered for {}".format(subject))
+        reader = expand_named_types(self.schema(ids[-1]))
+
+        others = [i for i in df.columns if i != valuecol]
+        body = expr("substring({}, {})".format(
+            valuecol, CONFLUENT_HEADER_SIZE + 1))
+
+        projections = []
+        for schema_id in ids:
+            tmpcol = "_decoded_{}".format(schema_id)
+            condition = "substring({}, 1, {}) = X'{}'".format(
+                valuecol, CONFLUENT_HEADER_SIZE,
+                confluent_header(schema_id).hex())
+            df = df.withColumn(
+                tmpcol,
+                when(
+                    expr(condition),
+                    from_avro(body, json.dumps(self.schema(schema_id)))))
+            projections.append(projection_expr(
+                tmpcol, expand_named_types(self.schema(schema_id)), reader))
+
+        # Fail on schema IDs unknown to the registry, rather than
+        # decoding their rows as nulls
+        known = "{} IS NULL OR substring({}, 1, {}) IN ({})".format(
+            valuecol, valuecol, CONFLUENT_HEADER_SIZE,
+            ", ".join(
+                "X'{}'".format(confluent_header(i).hex()) for i in ids))
+        projections.insert(0, "assert_true({})".format(known))
+
+        decoded = "coalesce({}) AS {}".format(", ".join(projections), alias)
+
+        return df.selectExpr(others + [decoded])
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    globs = globals()
+    root = os.environ['FINK_HOME']
+    globs["ztf_alert_sample"] = os.path.join(
+        root, "schemas/template_schema_ZTF_3p3.avro")
+    globs["ztf_alert_sample_3p1"] = os.path.join(
+        root, "schemas/template_schema_ZTF_3p1.avro")
+
+    # Run the Spark test suite
+    spark_unit_tests(globs, withstreaming=False)
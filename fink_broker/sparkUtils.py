@@ -17,10 +17,13 @@ from pyspark.sql import SparkSession
 from pyspark.sql import DataFrame
 from pyspark.sql.column import Column, _to_java_column
 from pyspark.sql.types import StructType
-from pyspark.sql.functions import col, struct
+from pyspark.sql.functions import col, struct, lit, date_format
+from pyspark.sql.functions import current_timestamp
 
 import os
 import json
+import time
+import math
 
 from fink_broker.avroUtils import readschemafromavrofile
 from fink_broker.tester import spark_unit_tests
@@ -139,17 +142,195 @@ def write_to_csv(
         .to_csv(fn, index=False)
     batchdf.unpersist()
 
-def init_sparksession(name: str, shuffle_partitions: int = 2) -> SparkSession:
+# Options set by the performance profiles (see get_profile_conf)
+PROFILE_KEYS = [
+    "spark.serializer",
+    "spark.kryoserializer.buffer.max",
+    "spark.python.worker.reuse",
+    "spark.sql.shuffle.partitions",
+    "spark.sql.execution.arrow.maxRecordsPerBatch",
+    "spark.sql.files.openCostInBytes",
+    "spark.sql.files.maxPartitionBytes",
+]
+
+def get_system_resources() -> (int, int):
+    """ Return the number of cores and the physical memory (bytes) of
+    the machine running the driver.
+
+    Returns
+    ----------
+    ncores: int
+        Number of cores (at least 1).
+    memory: int
+        Physical memory in bytes, or 0 if unknown.
+
+    Examples
+    ----------
+    >>> ncores, memory = get_system_resources()
+    >>> ncores >= 1
+    True
+    """
+    ncores = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        memory = 0
+    return ncores, memory
+
+def shuffle_partitions_from_rate(
+        rate: float, tinterval: float, ncores: int,
+        rows_per_partition: int = 5000) -> int:
+    """ Number of shuffle partitions for micro-batches of `rate * tinterval`
+    alerts, such that each partition holds about `rows_per_partition`
+    alerts. The result is a multiple of the number of cores.
+
+    Parameters
+    ----------
+    rate: float
+        Input rate, in alerts per second.
+    tinterval: float
+        Duration of micro-batches, in seconds.
+    ncores: int
+        Number of cores available.
+    rows_per_partition: int, optional
+        Target number of alerts per partition. Default is 5000.
+
+    Returns
+    ----------
+    partitions: int
+
+    Examples
+    ----------
+    >>> shuffle_partitions_from_rate(10, 30, 4)
+    4
+    >>> shuffle_partitions_from_rate(2000, 60, 8)
+    24
+    """
+    nrows = max(rate, 0) * max(tinterval, 1)
+    partitions = int(math.ceil(nrows / rows_per_partition))
+    return max(1, int(math.ceil(partitions / ncores))) * ncores
+
+def get_profile_conf(
+        profile: str, ncores: int = None, memory: int = None) -> dict:
+    """ Spark options for a named performance profile, scaled with the
+    resources of the machine.
+
+    Profiles are:
+        - default: only the shuffle partitions (2), as historically.
+        - laptop: few cores, little memory. Small Arrow batches (alerts
+        with cutouts are large), small input partitions.
+        - single-node: one large machine. One shuffle partition per core.
+        - cluster: several executors. Larger input partitions, and
+        two shuffle partitions per core of the driver machine.
+    All profiles but default use Kryo and reuse the Python workers.
+
+    Parameters
+    ----------
+    profile: str
+        Name of the profile: default, laptop, single-node, cluster.
+    ncores: int, optional
+        Number of cores. Default is the number of cores of the machine.
+    memory: int, optional
+        Memory in bytes. Default is the memory of the machine.
+
+    Returns
+    ----------
+    conf: dict
+        Spark option -> value (str).
+
+    Examples
+    ----------
+    >>> get_profile_conf("default")
+    {'spark.sql.shuffle.partitions': '2'}
+
+    >>> conf = get_profile_conf("laptop", ncores=4, memory=8 * 1024**3)
+    >>> conf['spark.sql.shuffle.partitions']
+    '4'
+    >>> conf['spark.sql.execution.arrow.maxRecordsPerBatch']
+    '500'
+
+    >>> conf = get_profile_conf("cluster", ncores=16, memory=64 * 1024**3)
+    >>> conf['spark.sql.shuffle.partitions']
+    '32'
+
+    >>> get_profile_conf("supercomputer")
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown Spark profile supercomputer. Choose among: default, laptop, single-node, cluster
+    """
+    profiles = ["default", "laptop", "single-node", "cluster"]
+    if profile not in profiles:
+        raise ValueError(
+            "Unknown Spark profile {}. Choose among: {}".format(
+                profile, ", ".join(profiles)))
+
+    if profile == "default":
+        return {"spark.sql.shuffle.partitions": "2"}
+
+    detected_cores, detected_memory = get_system_resources()
+    ncores = ncores or detected_cores
+    memory = memory or detected_memory
+
+    # Memory per core in GB, used to size the Arrow batches
+    # (one batch per Python worker).
+    memory_per_core = memory / ncores / 1024**3 if memory > 0 else 1
+
+    if profile == "laptop":
+        partitions = ncores
+        records = 500
+        maxbytes = 32 * 1024**2
+    elif profile == "single-node":
+        partitions = ncores
+        records = 2000 if memory_per_core >= 2 else 1000
+        maxbytes = 64 * 1024**2
+    else:
+        partitions = 2 * ncores
+        records = 5000 if memory_per_core >= 4 else 2000
+        maxbytes = 128 * 1024**2
+
+    conf = {
+        "spark.serializer": "org.apache.spark.serializer.KryoSerializer",
+        "spark.kryoserializer.buffer.max": "512m",
+        "spark.python.worker.reuse": "true",
+        "spark.sql.shuffle.partitions": str(partitions),
+        "spark.sql.execution.arrow.maxRecordsPerBatch": str(records),
+        # Raw database files are small (one per partition per micro-batch):
+        # a large opening cost packs more of them in a single task.
+        "spark.sql.files.openCostInBytes": str(8 * 1024**2),
+        "spark.sql.files.maxPartitionBytes": str(maxbytes),
+    }
+    return conf
+
+def init_sparksession(
+        name: str, shuffle_partitions: int = None,
+        profile: str = "default", input_rate: float = 0.0,
+        tinterval: float = 0.0) -> SparkSession:
     """ Initialise SparkSession, the level of log for Spark and
     some configuration parameters
 
+    Options which are not runtime options (e.g. the serializer) are only
+    effective if the SparkContext is created here, and are otherwise
+    superseded by the spark-submit configuration.
+
     Parameters
     ----------
     name: str
         Name for the Spark Application.
     shuffle_partitions: int, optional
         Number of partition to use when shuffling data.
-        Typically better to keep the size of shuffles small. Default is 2.
+        Typically better to keep the size of shuffles small. Default is None,
+        that is the value of the profile (or derived from `input_rate`).
+    profile: str, optional
+        Performance profile: default, laptop, single-node, cluster.
+        See get_profile_conf. Default is default.
+    input_rate: float, optional
+        Observed input rate in alerts per second. If positive, and
+        `shuffle_partitions` is not set, the number of shuffle partitions
+        is derived from it (see shuffle_partitions_from_rate).
+        Default is 0.
+    tinterval: float, optional
+        Duration of micro-batches in seconds, used with `input_rate`.
+        Default is 0 (1 second).
 
     Returns
     ----------
@@ -163,16 +344,34 @@ def init_sparksession(name: str, shuffle_partitions: int = 2) -> SparkSession:
     >>> name = [i[1] for i in conf if i[0] == "spark.app.name"][0]
     >>> print(name)
     test
+
+    >>> spark_tmp = init_sparksession("test", profile="laptop")
+    >>> spark_tmp.conf.get("spark.sql.files.openCostInBytes")
+    '8388608'
+    >>> spark_tmp = init_sparksession("test", shuffle_partitions=2)
     """
+    conf = get_profile_conf(profile)
+
+    if shuffle_partitions is not None:
+        conf["spark.sql.shuffle.partitions"] = str(shuffle_partitions)
+    elif input_rate > 0:
+        ncores, _ = get_system_resources()
+        conf["spark.sql.shuffle.partitions"] = str(
+            shuffle_partitions_from_rate(input_rate, tinterval, ncores))
+
     # Grab the running Spark Session,
     # otherwise create it.
-    spark = SparkSession \
+    builder = SparkSession \
         .builder \
-        .appName(name) \
-        .getOrCreate()
+        .appName(name)
+    for key, value in conf.items():
+        builder = builder.config(key, value)
+    spark = builder.getOrCreate()
 
-    # keep the size of shuffles small
-    spark.conf.set("spark.sql.shuffle.partitions", shuffle_partitions)
+    # Runtime SQL options (e.g. keep the size of shuffles small)
+    for key, value in conf.items():
+        if key.startswith("spark.sql."):
+            spark.conf.set(key, value)
 
     # Set spark log level to WARN
     spark.sparkContext.setLogLevel("WARN")
@@ -203,7 +402,9 @@ def get_spark_context() -> SparkContext:
 def connect_to_kafka(
         servers: str, topic: str,
         startingoffsets: str = "latest",
-        failondataloss: bool = False) -> DataFrame:
+        failondataloss: bool = False,
+        maxoffsetspertrigger: int = None,
+        minpartitions: int = None) -> DataFrame:
     """ Initialise SparkSession, and set default Kafka parameters
 
     Parameters
@@ -221,6 +422,16 @@ def connect_to_kafka(
         If True, Spark streaming job will fail if it is asking for data offsets
         that do not exist anymore in Kafka (because they have been deleted after
         exceeding a retention period for example). Default is False.
+    maxoffsetspertrigger: int, optional
+        Maximum number of offsets (alerts) processed per micro-batch, split
+        proportionally across topic partitions. It prevents the first
+        micro-batch after a downtime to swallow the whole backlog.
+        Default is None (no limit).
+    minpartitions: int, optional
+        Minimum number of Spark partitions to read from Kafka. If larger
+        than the number of Kafka partitions, large Kafka partitions are
+        split such that more cores can be used. Default is None
+        (one Spark partition per Kafka partition).
 
     Returns
     ----------
@@ -232,6 +443,13 @@ def connect_to_kafka(
     >>> dfstream_tmp = connect_to_kafka("localhost:29092", "ztf-stream-sim")
     >>> dfstream_tmp.isStreaming
     True
+
+    Rate-controlled ingestion
+    >>> dfstream_tmp = connect_to_kafka(
+    ...     "localhost:29092", "ztf-stream-sim",
+    ...     maxoffsetspertrigger=1000, minpartitions=4)
+    >>> dfstream_tmp.isStreaming
+    True
     """
     # Grab the running Spark Session
     spark = SparkSession \
@@ -256,24 +474,460 @@ def connect_to_kafka(
 
     df = df.option("subscribe", topic) \
         .option("startingOffsets", startingoffsets) \
-        .option('failOnDataLoss', failondataloss)\
-        .load()
+        .option('failOnDataLoss', failondataloss)
+
+    # Rate control
+    if maxoffsetspertrigger is not None and maxoffsetspertrigger > 0:
+        df = df.option("maxOffsetsPerTrigger", maxoffsetspertrigger)
+    if minpartitions is not None and minpartitions > 0:
+        df = df.option("minPartitions", minpartitions)
+
+    df = df.load()
 
     return df
 
+def connect_to_avro_files(
+        path: str, ddl: str, avroschema: str,
+        maxfilespertrigger: int = None, topic: str = None) -> DataFrame:
+    """ Watch a directory of Avro files of alerts (e.g. extracted datasim
+    tarballs), as an alternative to Kafka.
+
+    Files are decoded in parallel by the executors, and the processed files
+    are tracked in the checkpoint of the query, such that each file is
+    ingested exactly once. Only files with the .avro extension are read.
+
+    Parameters
+    ----------
+    path: str
+        Directory with the Avro files.
+    ddl: str
+        Schema of the alerts, as a Spark DDL string (see
+        AlertSchemaRegistry.reader_ddl).
+    avroschema: str
+        Reader Avro schema (JSON). Files written with another (compatible)
+        version of the schema are projected into it.
+    maxfilespertrigger: int, optional
+        Maximum number of files processed per micro-batch.
+        Default is None (no limit).
+    topic: str, optional
+        Value of the `topic` column. Default is the name of the directory.
+
+    Returns
+    ----------
+    df: Streaming DataFrame
+        timestamp (ingestion time), topic, and the alert fields.
+
+    Examples
+    ----------
+    >>> from fink_broker.schemaRegistry import build_registry
+    >>> registry = build_registry(ztf_alert_sample)
+    >>> dfstream_tmp = connect_to_avro_files(
+    ...     os.path.dirname(ztf_alert_sample), registry.reader_ddl(),
+    ...     json.dumps(registry.reader_schema), maxfilespertrigger=10)
+    >>> dfstream_tmp.isStreaming
+    True
+    >>> dfstream_tmp.columns[:3]
+    ['timestamp', 'topic', 'schemavsn']
+    """
+    # Grab the running Spark Session
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    if topic is None:
+        topic = os.path.basename(os.path.normpath(path))
+
+    # Replayed files keep their original modification time (e.g. from
+    # tarballs), hence they must not be discarded as too old.
+    df = spark \
+        .readStream \
+        .format("avro") \
+        .schema(ddl) \
+        .option("avroSchema", avroschema) \
+        .option("maxFileAge", "36500d")
+
+    # Rate control
+    if maxfilespertrigger is not None and maxfilespertrigger > 0:
+        df = df.option("maxFilesPerTrigger", maxfilespertrigger)
+
+    df = df.load(path)
+
+    return df.select(
+        [
+            current_timestamp().alias("timestamp"),
+            lit(topic).alias("topic")
+        ] + [col("`{}`".format(c)) for c in df.columns])
+
+def deduplicate_alerts(
+        df: DataFrame, delay: str, key: str = "candid",
+        jdcol: str = "candidate.jd") -> DataFrame:
+    """ Drop duplicated alerts (same `key`) received within `delay`.
+
+    The event time is the observation date of the alert (Julian date), such
+    that alerts sent twice by the producer, or read twice from Kafka, share
+    the same event time. The state of the deduplication is bounded by the
+    watermark: alerts observed more than `delay` before the most recent
+    alert are not deduplicated anymore, and are dropped if they arrive
+    that late for the first time. Hence `delay` must be larger than the
+    maximum latency of alerts.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Streaming (or static) DataFrame with decoded alerts.
+    delay: str
+        Delay threshold for the watermark, e.g. "24 hours".
+    key: str, optional
+        Column identifying alerts. Default is candid.
+    jdcol: str, optional
+        Column with the observation Julian date. Default is candidate.jd.
+
+    Returns
+    ----------
+    df: DataFrame
+        DataFrame without duplicates (same columns).
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame(
+    ...     [(1, 2458800.5), (1, 2458800.5), (2, 2458800.6)], ["candid", "jd"])
+    >>> deduplicate_alerts(df, "24 hours", jdcol="jd").count()
+    2
+    """
+    cols = df.columns
+
+    # Julian date -> timestamp
+    eventtime = ((col(jdcol) - 2440587.5) * 86400.).cast("timestamp")
+
+    return df\
+        .withColumn("eventtime_dedup", eventtime)\
+        .withWatermark("eventtime_dedup", delay)\
+        .dropDuplicates([key, "eventtime_dedup"])\
+        .select(cols)
+
+def get_hadoop_path(path: str):
+    """ Return a Hadoop Path and its FileSystem (local FS, HDFS, ...)
+    from the JVM of the running Spark Session.
+
+    Parameters
+    ----------
+    path: str
+        Path to a file or a folder.
+
+    Returns
+    ----------
+    jpath: py4j.java_gateway.JavaObject
+        org.apache.hadoop.fs.Path instance.
+    fs: py4j.java_gateway.JavaObject
+        org.apache.hadoop.fs.FileSystem instance.
+
+    Examples
+    ----------
+    >>> jpath, fs = get_hadoop_path("archive/alerts_store")
+    >>> fs.exists(jpath)
+    True
+    """
+    sc = get_spark_context()
+    jpath = sc._jvm.org.apache.hadoop.fs.Path(path)
+    fs = jpath.getFileSystem(sc._jsc.hadoopConfiguration())
+    return jpath, fs
+
+def read_file_sink_log(basepath: str) -> list:
+    """ Return the files committed by a Spark file sink (e.g. the Parquet
+    sinks of stream2raw and raw2science), in order of commit.
+
+    The file sink appends each committed file to a log under
+    `basepath/_spark_metadata` (one file per micro-batch), which is
+    periodically compacted into a single `<batchId>.compact` file. Reading
+    it is much cheaper than listing the partitioned archive.
+
+    Parameters
+    ----------
+    basepath: str
+        Output path of the file sink.
+
+    Returns
+    ----------
+    files: list of dict
+        Entries of the log (path, size, modificationTime, ...).
+        Empty if the log does not exist.
+
+    Examples
+    ----------
+    >>> files = read_file_sink_log("archive/alerts_store")
+    >>> len(files) > 0
+    True
+    >>> files[0]["path"].endswith(".parquet")
+    True
+    """
+    sc = get_spark_context()
+    logpath, fs = get_hadoop_path(os.path.join(basepath, "_spark_metadata"))
+    if not fs.exists(logpath):
+        return []
+
+    # Batch files are named <batchId> or <batchId>.compact
+    batches = {}
+    for status in fs.listStatus(logpath):
+        name = status.getPath().getName()
+        batchid = name.split(".")[0]
+        if not batchid.isdigit() or name.endswith(".tmp"):
+            continue
+        batches[int(batchid)] = status.getPath()
+
+    # Start from the latest compacted batch, if any
+    compacted = [
+        k for k, v in batches.items() if v.getName().endswith(".compact")]
+    first = max(compacted) if compacted else 0
+
+    files = {}
+    ioutils = sc._jvm.org.apache.commons.io.IOUtils
+    for batchid in sorted(k for k in batches.keys() if k >= first):
+        stream = fs.open(batches[batchid])
+        try:
+            lines = ioutils.toString(stream, "UTF-8").split("\n")
+        finally:
+            stream.close()
+
+        # First line is the version of the log (v1)
+        for line in lines[1:]:
+            if line.strip() == "":
+                continue
+            entry = json.loads(line)
+            if entry.get("action", "add") == "delete":
+                files.pop(entry["path"], None)
+            else:
+                files[entry["path"]] = entry
+
+    return list(files.values())
+
+def append_to_file_sink(
+        df: DataFrame, batchid: int, basepath: str,
+        partitions: list = None):
+    """ Append a micro-batch to a Parquet database, from `foreachBatch`,
+    as the Spark file sink does: the files are committed in the sink log
+    (`_spark_metadata`) under `batchid`, and a batch already committed
+    (e.g. replayed after a failure) is skipped.
+
+    Several databases can thus be written by a single streaming query, each
+    one keeping its sink log (see read_file_sink_log).
+
+    Parameters
+    ----------
+    df: DataFrame
+        Rows of the micro-batch.
+    batchid: int
+        Index of the micro-batch.
+    basepath: str
+        Output path of the database.
+    partitions: list of str, optional
+        Partitioning columns. Default is None.
+
+    Examples
+    ----------
+    >>> path = "archive/file_sink_test"
+    >>> df = spark.range(4).selectExpr("id", "cast(id % 2 as string) as p")
+    >>> append_to_file_sink(df, 0, path, ["p"])
+    >>> append_to_file_sink(df, 0, path, ["p"])
+    >>> append_to_file_sink(df, 1, path, ["p"])
+    >>> len(read_file_sink_log(path)) > 0
+    True
+    >>> spark.read.parquet(path).count()
+    8
+    >>> jpath, fs = get_hadoop_path(path)
+    >>> fs.delete(jpath, True)
+    True
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+    jvm = get_spark_context()._jvm
+
+    sink = jvm.org.apache.spark.sql.execution.streaming.FileStreamSink(
+        spark._jsparkSession, basepath,
+        jvm.org.apache.spark.sql.execution.datasources.parquet
+        .ParquetFileFormat(),
+        jvm.PythonUtils.toSeq(partitions or []),
+        jvm.PythonUtils.toScalaMap({"path": basepath}))
+    sink.addBatch(batchid, df._jdf)
+
+def get_raw_database_schema(basepath: str) -> StructType:
+    """ Return the schema of a database written by a Spark file sink,
+    including partitioning columns.
+
+    The schema is read from the last committed file of the sink log,
+    instead of touching footers across the whole archive. If there is no
+    log, the database is read as a whole.
+
+    Parameters
+    ----------
+    basepath: str
+        Base path of the database.
+
+    Returns
+    ----------
+    schema: StructType
+
+    Examples
+    ----------
+    >>> schema = get_raw_database_schema("archive/alerts_store")
+    >>> "candidate" in schema.fieldNames()
+    True
+    >>> "hour" in schema.fieldNames()
+    True
+    """
+    # Grab the running Spark Session
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    files = read_file_sink_log(basepath)
+    if len(files) == 0:
+        return spark.read.parquet(basepath).schema
+
+    lastfile = max(files, key=lambda x: x["modificationTime"])["path"]
+    return spark\
+        .read\
+        .option("basePath", basepath)\
+        .parquet(lastfile)\
+        .schema
+
+def partition_filter_from(
+        year: str, month: str, day: str, hour: str) -> Column:
+    """ Condition selecting the hourly partitions (year/month/day/hour)
+    starting from a given hour, including partitions created later on.
+
+    It only involves partition columns: applied to a file source, the
+    other partitions are pruned before their files are read.
+
+    Parameters
+    ----------
+    year, month, day, hour: str
+        First partition to select, zero-padded (yyyy, MM, dd, HH).
+
+    Returns
+    ----------
+    condition: Column
+        Boolean column.
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame(
+    ...     [(2019, 12, 31, 21), (2019, 12, 31, 22), (2020, 1, 1, 0)],
+    ...     ["year", "month", "day", "hour"])
+    >>> df.filter(partition_filter_from("2019", "12", "31", "22")).count()
+    2
+    """
+    key = col("year").cast("long") * 1000000 + \
+        col("month").cast("long") * 10000 + \
+        col("day").cast("long") * 100 + \
+        col("hour").cast("long")
+    return key >= int(year + month + day + hour)
+
+def get_partition_values(timestamp: int) -> list:
+    """ Return the hourly partition values (yyyy, MM, dd, HH) of a
+    timestamp, computed by Spark such that the session time zone is
+    the one used when writing the partitions.
+
+    Parameters
+    ----------
+    timestamp: int
+        Unix timestamp in milliseconds.
+
+    Returns
+    ----------
+    values: list of str
+        [yyyy, MM, dd, HH]
+
+    Examples
+    ----------
+    >>> values = get_partition_values(1572566400000)
+    >>> values[0]
+    '2019'
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    row = spark.range(1).select(
+        [
+            date_format(
+                (lit(timestamp) / 1000).cast("timestamp"), fmt).alias(fmt)
+            for fmt in ["yyyy", "MM", "dd", "HH"]
+        ]).first()
+    return list(row)
+
+def get_resume_starttime(window: float, starttime: int = None) -> int:
+    """ Return the time from which a consumer of the raw/science database
+    should resume, or None if the whole database must be considered.
+
+    Parameters
+    ----------
+    window: float
+        Only the last `window` hours are considered. 0 means no window.
+    starttime: int, optional
+        Unix timestamp in milliseconds from which to resume (e.g. the
+        last distributed alert). Values below 1000 (i.e. earliest) are
+        ignored. Default is None.
+
+    Returns
+    ----------
+    starttime: int
+        Unix timestamp in milliseconds, or None.
+
+    Examples
+    ----------
+    >>> get_resume_starttime(0) is None
+    True
+    >>> get_resume_starttime(0, 100) is None
+    True
+    >>> get_resume_starttime(0, 1572566400000)
+    1572566400000
+    >>> now = int(time.time() * 1000)
+    >>> get_resume_starttime(1, 1572566400000) >= now - 3600 * 1000
+    True
+    """
+    candidates = []
+    if window > 0:
+        candidates.append(int((time.time() - window * 3600) * 1000))
+    if starttime is not None and starttime >= 1000:
+        candidates.append(starttime)
+
+    if len(candidates) == 0:
+        return None
+    return max(candidates)
+
 def connect_to_raw_database(
-        basepath: str, path: str, latestfirst: bool) -> DataFrame:
+        basepath: str, path: str, latestfirst: bool,
+        starttime: int = None, maxfileage: float = 0.0) -> DataFrame:
     """ Initialise SparkSession, and connect to the raw database (Parquet)
 
+    If `path` is `basepath` and the database has been written by a Spark
+    file sink, new files are discovered by tailing the sink log
+    (`_spark_metadata`) instead of listing the whole partitioned archive at
+    every trigger. Note that a glob in `path` (e.g. basepath + "/*")
+    disables this mechanism.
+
     Parameters
     ----------
     basepath: str
         The base path that partition discovery should start with.
     path: str
-        The path to the data (typically as basepath with a glob at the end).
+        The path to the data: basepath to use the sink log (recommended),
+        or basepath with a glob at the end to list files.
     latestfirst: bool
         whether to process the latest new files first,
         useful when there is a large backlog of files
+    starttime: int, optional
+        If set, only the hourly partitions (year/month/day/hour) starting
+        from this time (Unix timestamp in milliseconds) are read. The files
+        are still discovered from `path`, and the other partitions are
+        pruned by a filter on the partition columns before their files are
+        read. Default is None (no pruning).
+    maxfileage: float, optional
+        Maximum age of files to be considered as new, in hours (relative
+        to the newest file). Partitions compacted by the compaction service
+        must be older than this. Default is 0, that is the Spark default
+        (7 days).
 
     Returns
     ----------
@@ -286,6 +940,26 @@ def connect_to_raw_database(
     ...   "archive/alerts_store", "archive/alerts_store/*", True)
     >>> dfstream_tmp.isStreaming
     True
+
+    >>> dfstream_tmp = connect_to_raw_database(
+    ...   "archive/alerts_store", "archive/alerts_store", True)
+    >>> dfstream_tmp.isStreaming
+    True
+
+    Resume from the last 6 hours only
+    >>> starttime = int((time.time() - 6 * 3600) * 1000)
+    >>> dfstream_tmp = connect_to_raw_database(
+    ...   "archive/alerts_store", "archive/alerts_store", True, starttime)
+    >>> dfstream_tmp.isStreaming
+    True
+
+    The alerts of the archive (2019) are all pruned
+    >>> query = dfstream_tmp.writeStream.format("memory")\\
+    ...   .queryName("resumed").start()
+    >>> query.processAllAvailable()
+    >>> spark.table("resumed").count()
+    0
+    >>> query.stop()
     """
     # Grab the running Spark Session
     spark = SparkSession \
@@ -293,19 +967,28 @@ def connect_to_raw_database(
         .getOrCreate()
 
     # Create a DF from the database
-    userschema = spark\
-        .read\
-        .parquet(basepath)\
-        .schema
+    userschema = get_raw_database_schema(basepath)
 
-    df = spark \
+    dfreader = spark \
         .readStream \
         .format("parquet") \
         .schema(userschema) \
         .option("basePath", basepath) \
         .option("path", path) \
-        .option("latestFirst", latestfirst) \
-        .load()
+        .option("latestFirst", latestfirst)
+
+    if maxfileage > 0:
+        dfreader = dfreader.option(
+            "maxFileAge", "{}m".format(int(maxfileage * 60)))
+
+    df = dfreader.load()
+
+    # Prune the partitions before the start time. The source path is kept
+    # as is, such that the sink log is still used to discover files.
+    hourly = ["year", "month", "day", "hour"]
+    if starttime is not None and set(hourly).issubset(df.columns):
+        values = get_partition_values(starttime)
+        df = df.filter(partition_filter_from(*values))
 
     return df
 
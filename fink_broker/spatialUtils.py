@@ -0,0 +1,317 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Spatial index of alerts, to cluster the databases by sky position.
+
+The index is a Z-order (Morton) code of the quantized (ra, dec) position:
+the bits of the quantized ra and dec are interleaved, such that alerts close
+on the sky have close indices. Rows of compacted partitions are sorted by this
+index (see compactionUtils), and the min/max statistics of Parquet files and
+row groups let sky-region queries skip most of the data.
+"""
+from pyspark.sql import DataFrame
+from pyspark.sql.column import Column
+from pyspark.sql.functions import col, floor, least, greatest, lit
+from pyspark.sql.functions import shiftLeft, shiftRight, array, element_at
+
+import math
+from functools import reduce
+
+from fink_broker.tester import spark_unit_tests
+
+# Number of bits per coordinate (resolution of 20 arcsec in ra)
+ZORDER_BITS = 16
+
+# Name of the index column
+SKYINDEX_COLUMN = "skyindex"
+
+def quantize(ra: float, dec: float, bits: int = ZORDER_BITS) -> (int, int):
+    """ Quantize a sky position (degrees) on a grid of 2**bits x 2**bits.
+
+    Parameters
+    ----------
+    ra, dec: float
+        Position in degrees.
+    bits: int, optional
+        Number of bits per coordinate. Default is ZORDER_BITS.
+
+    Returns
+    ----------
+    x, y: int
+
+    Examples
+    ----------
+    >>> quantize(0., -90.)
+    (0, 0)
+    >>> quantize(180., 0.)
+    (32768, 32768)
+    >>> quantize(360., 90.)
+    (65535, 65535)
+    """
+    size = 2 ** bits
+    x = min(max(int(math.floor(ra / 360. * size)), 0), size - 1)
+    y = min(max(int(math.floor((dec + 90.) / 180. * size)), 0), size - 1)
+    return x, y
+
+def interleave_bits(x: int, y: int, bits: int = ZORDER_BITS) -> int:
+    """ Z-order code of (x, y): bit i of x is bit 2i of the code,
+    and bit i of y is bit 2i + 1.
+
+    Parameters
+    ----------
+    x, y: int
+        Quantized coordinates.
+    bits: int, optional
+        Number of bits per coordinate. Default is ZORDER_BITS.
+
+    Returns
+    ----------
+    z: int
+
+    Examples
+    ----------
+    >>> interleave_bits(0b11, 0b00, bits=2)
+    5
+    >>> interleave_bits(0b00, 0b11, bits=2)
+    10
+    """
+    z = 0
+    for i in range(bits):
+        z |= ((x >> i) & 1) << (2 * i)
+        z |= ((y >> i) & 1) << (2 * i + 1)
+    return z
+
+def skyindex(
+        racol: str = "candidate.ra", deccol: str = "candidate.dec",
+        bits: int = ZORDER_BITS) -> Column:
+    """ Column with the Z-order code of the sky position, computed with
+    Spark SQL functions only (same as quantize + interleave_bits).
+
+    Parameters
+    ----------
+    racol, deccol: str, optional
+        Columns with the position in degrees.
+        Default is candidate.ra and candidate.dec.
+    bits: int, optional
+        Number of bits per coordinate. Default is ZORDER_BITS.
+
+    Returns
+    ----------
+    out: Column
+        Z-order code (long).
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([(180., 0.), (10., 40.)], ["ra", "dec"])
+    >>> codes = df.select(skyindex("ra", "dec").alias("z")).collect()
+    >>> codes[0].z == interleave_bits(*quantize(180., 0.))
+    True
+    >>> codes[1].z == interleave_bits(*quantize(10., 40.))
+    True
+    """
+    size = 2 ** bits
+    x = least(
+        greatest(floor(col(racol) / 360. * size), lit(0)), lit(size - 1))
+    y = least(
+        greatest(floor((col(deccol) + 90.) / 180. * size), lit(0)),
+        lit(size - 1))
+
+    # Spread the bits of each byte with a lookup table, instead of one
+    # expression per bit (the generated code would be too large).
+    table = array(*[lit(interleave_bits(i, 0, 8)) for i in range(256)])
+
+    def spread(c):
+        return reduce(
+            lambda a, b: a + b,
+            [
+                shiftLeft(
+                    element_at(
+                        table,
+                        (shiftRight(c, 8 * k).bitwiseAND(255) + 1).cast("int"))
+                    .cast("long"), 16 * k)
+                for k in range(int(math.ceil(bits / 8)))
+            ])
+
+    return (spread(x) + shiftLeft(spread(y), 1)).cast("long")
+
+def add_skyindex(
+        df: DataFrame, racol: str = "candidate.ra",
+        deccol: str = "candidate.dec") -> DataFrame:
+    """ Add the sky index column to alerts (see skyindex).
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame of alerts.
+    racol, deccol: str, optional
+        Columns with the position in degrees.
+        Default is candidate.ra and candidate.dec.
+
+    Returns
+    ----------
+    df: DataFrame
+        DataFrame with the sky index column.
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame([(180., 0.)], ["ra", "dec"])
+    >>> add_skyindex(df, "ra", "dec").columns
+    ['ra', 'dec', 'skyindex']
+    """
+    return df.withColumn(SKYINDEX_COLUMN, skyindex(racol, deccol))
+
+def zorder_ranges(
+        xmin: int, xmax: int, ymin: int, ymax: int,
+        bits: int = ZORDER_BITS) -> list:
+    """ Ranges of Z-order codes covering a box of the quantized grid.
+
+    The grid is split recursively (quadtree) down to cells of about the
+    size of the box, hence the number of ranges stays small. Ranges may
+    cover a bit more than the box.
+
+    Parameters
+    ----------
+    xmin, xmax, ymin, ymax: int
+        Box on the quantized grid (bounds included).
+    bits: int, optional
+        Number of bits per coordinate. Default is ZORDER_BITS.
+
+    Returns
+    ----------
+    ranges: list of (int, int)
+        Sorted and merged ranges of codes (bounds included).
+
+    Examples
+    ----------
+    The whole grid is a single range
+    >>> zorder_ranges(0, 3, 0, 3, bits=2)
+    [(0, 15)]
+
+    The quadrant x >= 2, y < 2 of a 4x4 grid
+    >>> zorder_ranges(2, 3, 0, 1, bits=2)
+    [(4, 7)]
+
+    All codes in the ranges of a box
+    >>> ranges = zorder_ranges(100, 120, 3000, 3010)
+    >>> codes = [interleave_bits(x, y)
+    ...     for x in range(100, 121) for y in range(3000, 3011)]
+    >>> all(any(a <= z <= b for a, b in ranges) for z in codes)
+    True
+    >>> len(ranges) < 64
+    True
+    """
+    width = max(xmax - xmin + 1, ymax - ymin + 1)
+    maxlevel = min(bits, bits - int(math.floor(math.log2(width))) + 2)
+
+    ranges = []
+    cells = [(0, 0, 0)]
+    while len(cells) > 0:
+        level, cx, cy = cells.pop()
+        shift = bits - level
+        x0, x1 = cx << shift, ((cx + 1) << shift) - 1
+        y0, y1 = cy << shift, ((cy + 1) << shift) - 1
+
+        # Disjoint from the box
+        if x1 < xmin or x0 > xmax or y1 < ymin or y0 > ymax:
+            continue
+
+        inside = xmin <= x0 and x1 <= xmax and ymin <= y0 and y1 <= ymax
+        if inside or level == maxlevel:
+            first = interleave_bits(cx, cy, level) << (2 * shift)
+            ranges.append((first, first + 4 ** shift - 1))
+            continue
+
+        for dx in (0, 1):
+            for dy in (0, 1):
+                cells.append((level + 1, 2 * cx + dx, 2 * cy + dy))
+
+    # Merge contiguous ranges
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def sky_region_filter(
+        ra: float, dec: float, radius: float,
+        colname: str = SKYINDEX_COLUMN) -> Column:
+    """ Condition on the sky index selecting (a superset of) the alerts
+    within `radius` degrees of (ra, dec).
+
+    The condition is made of ranges on the index, which Spark pushes down
+    to the Parquet reader to skip files and row groups. Combine it with an
+    exact selection on the position if needed.
+
+    Parameters
+    ----------
+    ra, dec: float
+        Center of the region, in degrees.
+    radius: float
+        Radius of the region, in degrees.
+    colname: str, optional
+        Name of the index column. Default is SKYINDEX_COLUMN.
+
+    Returns
+    ----------
+    condition: Column
+
+    Examples
+    ----------
+    >>> df = spark.createDataFrame(
+    ...     [(10., 40.), (10.01, 40.01), (200., -20.)], ["ra", "dec"])
+    >>> df = add_skyindex(df, "ra", "dec")
+    >>> df.filter(sky_region_filter(10., 40., 0.1)).count()
+    2
+
+    Regions across ra = 0 are supported
+    >>> df = spark.createDataFrame([(359.99, 0.), (0.01, 0.)], ["ra", "dec"])
+    >>> df = add_skyindex(df, "ra", "dec")
+    >>> df.filter(sky_region_filter(0., 0., 0.1)).count()
+    2
+    """
+    decmin = max(dec - radius, -90.)
+    decmax = min(dec + radius, 90.)
+
+    # Width in ra, larger close to the poles
+    cosdec = min(math.cos(math.radians(decmin)), math.cos(math.radians(decmax)))
+    if cosdec <= 0 or radius / cosdec >= 180.:
+        rabounds = [(0., 360.)]
+    else:
+        width = radius / cosdec
+        ramin, ramax = ra - width, ra + width
+        if ramin < 0:
+            rabounds = [(0., ramax), (ramin + 360., 360.)]
+        elif ramax > 360.:
+            rabounds = [(ramin, 360.), (0., ramax - 360.)]
+        else:
+            rabounds = [(ramin, ramax)]
+
+    ranges = []
+    for rmin, rmax in rabounds:
+        xmin, ymin = quantize(rmin, decmin)
+        xmax, ymax = quantize(rmax, decmax)
+        ranges += zorder_ranges(xmin, xmax, ymin, ymax)
+
+    return reduce(
+        lambda a, b: a | b,
+        [col(colname).between(first, last) for first, last in ranges])
+
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    # Run the Spark test suite
+    spark_unit_tests(globals())
@@ -0,0 +1,582 @@
+# Copyright 2019 AstroLab Software
+# Author: Julien Peloton
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Summary of the objects seen by Fink, and Bloom filter of their objectId.
+
+The summary has one row per object: first and last date seen, number of
+alerts, last class, and last magnitude per filter. Each micro-batch of
+raw2science appends the partial summary of its alerts (a segment), and
+segments are merged on read (see load_object_summary), and periodically
+merged on disk.
+
+The Bloom filter of the known objectIds is stored next to the summary
+(BLOOM_FILE). It is updated with each micro-batch, and executors reload it
+when it changes, such that checking whether an object is new costs O(1)
+per alert without reading the summary.
+
+The filter only knows the objects already in the summary, so the flag lags
+behind the alerts: all the alerts of an object within one micro-batch, and
+the alerts arriving before the summary is updated with its first alert,
+are flagged new. The exact first detection is first_jd in the summary.
+"""
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.column import Column
+from pyspark.sql.functions import col, lit, when, struct, count
+from pyspark.sql.functions import min as spark_min, max as spark_max
+from pyspark.sql.functions import sum as spark_sum
+from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import BooleanType
+
+import os
+import math
+import struct as pystruct
+import hashlib
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from fink_broker.sparkUtils import get_hadoop_path
+from fink_broker.tester import spark_unit_tests
+
+# ZTF filters (candidate.fid) and their names in the summary
+SUMMARY_BANDS = {1: "g", 2: "r", 3: "i"}
+
+# Column of the alerts with the class given by the processors
+SUMMARY_CLASS_COLUMN = "cdsxmatch"
+
+# Bloom filter of the objectIds, relative to the summary
+BLOOM_FILE = "_bloom"
+
+# False positive probability of the Bloom filter
+BLOOM_FPP = 0.001
+
+# Minimum capacity of the Bloom filter
+BLOOM_CAPACITY = 10**6
+
+# Staging area of the merge, relative to the summary
+STAGING_DIR = "_compaction"
+
+# Last micro-batch committed into the summary, relative to the summary
+BATCH_FILE = "_last_batch"
+
+class BloomFilter(object):
+    """ Bloom filter of strings, using double hashing on the MD5 digest.
+
+    Examples
+    ----------
+    >>> bloom = BloomFilter.from_capacity(1000)
+    >>> bloom.add("ZTF19acmbyav")
+    >>> "ZTF19acmbyav" in bloom, "ZTF19acmbyaw" in bloom
+    (True, False)
+
+    >>> bloom = BloomFilter.from_bytes(bloom.to_bytes())
+    >>> "ZTF19acmbyav" in bloom
+    True
+
+    False positives are close to the expected rate
+    >>> for i in range(1000):
+    ...     bloom.add("known{}".format(i))
+    >>> fp = sum("other{}".format(i) in bloom for i in range(10000))
+    >>> fp < 50
+    True
+    """
+    def __init__(self, nbits: int, nhashes: int, bits: np.ndarray = None):
+        self.nbits = nbits
+        self.nhashes = nhashes
+        if bits is None:
+            bits = np.zeros((nbits + 7) // 8, dtype=np.uint8)
+        self.bits = bits
+
+    @classmethod
+    def from_capacity(cls, capacity: int, fpp: float = BLOOM_FPP):
+        """ Bloom filter sized for `capacity` keys and a false positive
+        probability `fpp`.
+        """
+        capacity = max(capacity, 1)
+        nbits = int(math.ceil(-capacity * math.log(fpp) / math.log(2)**2))
+        nhashes = max(1, int(round(nbits / capacity * math.log(2))))
+        return cls(nbits, nhashes)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """ Bloom filter serialised with to_bytes """
+        nbits, nhashes = pystruct.unpack("<QI", data[:12])
+        bits = np.frombuffer(data[12:], dtype=np.uint8).copy()
+        return cls(nbits, nhashes, bits)
+
+    def to_bytes(self) -> bytes:
+        """ Serialise the Bloom filter """
+        return pystruct.pack("<QI", self.nbits, self.nhashes) + \
+            self.bits.tobytes()
+
+    def _positions(self, key: str) -> list:
+        h1, h2 = pystruct.unpack(
+            "<QQ", hashlib.md5(key.encode("utf-8")).digest())
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, key: str):
+        """ Add a key to the filter """
+        for position in self._positions(key):
+            self.bits[position >> 3] |= np.uint8(1 << (position & 7))
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key))
+
+def _fs_and_path(path: str):
+    """ pyarrow HDFS client (or None for the local FS), and path """
+    uri = urlparse(path)
+    if uri.scheme == "hdfs":
+        import pyarrow
+        return pyarrow.hdfs.connect(uri.hostname, uri.port or 0), uri.path
+    return None, uri.path if uri.scheme == "file" else path
+
+def load_bloom_filter(path: str) -> BloomFilter:
+    """ Load the Bloom filter of a summary, or None if it does not exist.
+
+    Parameters
+    ----------
+    path: str
+        Path of the summary.
+
+    Returns
+    ----------
+    bloom: BloomFilter
+    """
+    fs, fn = _fs_and_path(os.path.join(path, BLOOM_FILE))
+    if fs is None:
+        if not os.path.isfile(fn):
+            return None
+        with open(fn, "rb") as f:
+            return BloomFilter.from_bytes(f.read())
+    if not fs.exists(fn):
+        return None
+    with fs.open(fn, "rb") as f:
+        return BloomFilter.from_bytes(f.read())
+
+def save_bloom_filter(bloom: BloomFilter, path: str):
+    """ Save atomically the Bloom filter of a summary.
+
+    Parameters
+    ----------
+    bloom: BloomFilter
+    path: str
+        Path of the summary.
+    """
+    fs, fn = _fs_and_path(os.path.join(path, BLOOM_FILE))
+    tmp = fn + ".tmp"
+    if fs is None:
+        os.makedirs(os.path.dirname(fn) or ".", exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(bloom.to_bytes())
+        os.replace(tmp, fn)
+    else:
+        with fs.open(tmp, "wb") as f:
+            f.write(bloom.to_bytes())
+        if fs.exists(fn):
+            fs.delete(fn)
+        fs.mv(tmp, fn)
+
+def _bloom_version(path: str):
+    """ Modification time and size of the Bloom filter of a summary """
+    fs, fn = _fs_and_path(os.path.join(path, BLOOM_FILE))
+    if fs is None:
+        if not os.path.isfile(fn):
+            return None
+        stat = os.stat(fn)
+        return (stat.st_mtime_ns, stat.st_size)
+    if not fs.exists(fn):
+        return None
+    info = fs.info(fn)
+    return (info["last_modified"], info["size"])
+
+def load_last_batch(path: str) -> int:
+    """ Last micro-batch committed into a summary, or -1 if none.
+
+    Parameters
+    ----------
+    path: str
+        Path of the summary.
+
+    Returns
+    ----------
+    batchid: int
+    """
+    fs, fn = _fs_and_path(os.path.join(path, BATCH_FILE))
+    if fs is None:
+        if not os.path.isfile(fn):
+            return -1
+        with open(fn) as f:
+            return int(f.read())
+    if not fs.exists(fn):
+        return -1
+    with fs.open(fn, "rb") as f:
+        return int(f.read().decode())
+
+def save_last_batch(batchid: int, path: str):
+    """ Save atomically the last micro-batch committed into a summary.
+
+    Parameters
+    ----------
+    batchid: int
+    path: str
+        Path of the summary.
+    """
+    fs, fn = _fs_and_path(os.path.join(path, BATCH_FILE))
+    tmp = fn + ".tmp"
+    if fs is None:
+        os.makedirs(os.path.dirname(fn) or ".", exist_ok=True)
+        with open(tmp, "w") as f:
+            f.write(str(batchid))
+        os.replace(tmp, fn)
+    else:
+        with fs.open(tmp, "wb") as f:
+            f.write(str(batchid).encode())
+        if fs.exists(fn):
+            fs.delete(fn)
+        fs.mv(tmp, fn)
+
+@lru_cache(maxsize=2)
+def _load_bloom_filter_cached(path: str, version) -> BloomFilter:
+    """ Bloom filter loaded once per version in each Python worker """
+    return load_bloom_filter(path)
+
+def new_object_column(path: str, colname: str = "objectId") -> Column:
+    """ Column telling whether the objects are new, that is not in the
+    Bloom filter of the summary (Arrow-based UDF).
+
+    The Bloom filter is loaded once by each Python worker, and loaded again
+    when the summary is updated. Because of false positives, a small
+    fraction (BLOOM_FPP) of new objects are flagged as known.
+
+    The flag can lag: the filter is not updated with the alerts being
+    flagged, so several alerts of the same object in one micro-batch are
+    all flagged new, and so are the alerts arriving before the summary
+    includes the first one. Use first_jd of the summary to find the first
+    alert of an object.
+
+    Parameters
+    ----------
+    path: str
+        Path of the summary. It must be accessible from the executors.
+    colname: str, optional
+        Column with the objectId. Default is objectId.
+
+    Returns
+    ----------
+    out: Column
+        Boolean column.
+
+    Examples
+    ----------
+    >>> path = "archive/objects_test"
+    >>> update_object_summary(df_alerts_sample, path)
+    >>> df = spark.createDataFrame([("ZTF19a",), ("ZTF20z",)], ["objectId"])
+    >>> [r[0] for r in df.select(new_object_column(path)).collect()]
+    [False, True]
+
+    Alerts of the same object not yet in the summary are all new
+    >>> df = spark.createDataFrame([("ZTF20z",), ("ZTF20z",)], ["objectId"])
+    >>> [r[0] for r in df.select(new_object_column(path)).collect()]
+    [True, True]
+    """
+    @pandas_udf(BooleanType(), PandasUDFType.SCALAR)
+    def new_object(objectid: pd.Series) -> pd.Series:
+        bloom = _load_bloom_filter_cached(path, _bloom_version(path))
+        if bloom is None:
+            return pd.Series([True] * len(objectid))
+        return pd.Series([i not in bloom for i in objectid.values])
+
+    return new_object(col(colname)).alias("new_object")
+
+def summarize_alerts(
+        df: DataFrame, classcol: str = SUMMARY_CLASS_COLUMN) -> DataFrame:
+    """ Summary of the objects of alerts.
+
+    Parameters
+    ----------
+    df: DataFrame
+        DataFrame of alerts.
+    classcol: str, optional
+        Column with the class of the alerts. Ignored if not present.
+        Default is SUMMARY_CLASS_COLUMN.
+
+    Returns
+    ----------
+    df: DataFrame
+        objectId, first_jd, last_jd, ndet, last_class (jd, class) if
+        available, and last_<band> (jd, magpsf) for each band.
+
+    Examples
+    ----------
+    >>> df = summarize_alerts(df_alerts_sample)
+    >>> df.columns
+    ['objectId', 'first_jd', 'last_jd', 'ndet', 'last_class', 'last_g', 'last_r', 'last_i']
+    >>> row = df.filter("objectId = 'ZTF19a'").first()
+    >>> row.ndet, row.last_class["class"], row.last_r
+    (2, 'Star', Row(jd=2458791.5, magpsf=17.0))
+    """
+    aggs = [
+        spark_min("candidate.jd").alias("first_jd"),
+        spark_max("candidate.jd").alias("last_jd"),
+        count(lit(1)).alias("ndet")]
+
+    # The maximum of (jd, value) is the last value
+    if classcol in df.columns:
+        aggs.append(
+            spark_max(
+                struct(
+                    col("candidate.jd").alias("jd"),
+                    col(classcol).alias("class"))).alias("last_class"))
+    for fid, band in SUMMARY_BANDS.items():
+        aggs.append(
+            spark_max(
+                when(
+                    col("candidate.fid") == fid,
+                    struct(
+                        col("candidate.jd").alias("jd"),
+                        col("candidate.magpsf").alias("magpsf"))))
+            .alias("last_" + band))
+
+    return df.groupBy("objectId").agg(*aggs)
+
+def merge_summaries(df: DataFrame) -> DataFrame:
+    """ Merge summaries of the same objects (e.g. segments).
+
+    Parameters
+    ----------
+    df: DataFrame
+        Summaries (see summarize_alerts).
+
+    Returns
+    ----------
+    df: DataFrame
+        One summary per object.
+
+    Examples
+    ----------
+    >>> df = summarize_alerts(df_alerts_sample)
+    >>> df = merge_summaries(df.union(df))
+    >>> df.filter("objectId = 'ZTF19a'").first().ndet
+    4
+    """
+    aggs = []
+    for c in df.columns:
+        if c == "objectId":
+            continue
+        elif c == "first_jd":
+            aggs.append(spark_min(c).alias(c))
+        elif c == "ndet":
+            aggs.append(spark_sum(c).alias(c))
+        else:
+            aggs.append(spark_max(c).alias(c))
+    return df.groupBy("objectId").agg(*aggs)
+
+def _summary_files(path: str) -> list:
+    """ Segments of the summary """
+    jpath, fs = get_hadoop_path(path)
+    if not fs.exists(jpath):
+        return []
+    return [
+        status.getPath() for status in fs.listStatus(jpath)
+        if status.getPath().getName().endswith(".parquet")]
+
+def load_object_summary(path: str) -> DataFrame:
+    """ Load the summary of objects, merging its segments.
+
+    Parameters
+    ----------
+    path: str
+        Path of the summary.
+
+    Returns
+    ----------
+    df: DataFrame
+        One summary per object.
+
+    Examples
+    ----------
+    >>> path = "archive/objects_test"
+    >>> update_object_summary(df_alerts_sample, path)
+    >>> df = load_object_summary(path)
+    >>> df.select("objectId").distinct().count() == df.count()
+    True
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    return merge_summaries(spark.read.parquet(path))
+
+def compact_object_summary(path: str) -> dict:
+    """ Merge the segments of the summary on disk, and rebuild its Bloom
+    filter with a capacity for twice the number of objects.
+
+    Parameters
+    ----------
+    path: str
+        Path of the summary.
+
+    Returns
+    ----------
+    report: dict
+        Number of files before, and number of objects.
+
+    Examples
+    ----------
+    >>> path = "archive/objects_test"
+    >>> update_object_summary(df_alerts_sample, path)
+    >>> compact_object_summary(path)["objects"]
+    3
+    """
+    spark = SparkSession \
+        .builder \
+        .getOrCreate()
+
+    files = _summary_files(path)
+    df = merge_summaries(
+        spark.read.parquet(*[f.toString() for f in files])).cache()
+    nobjects = df.count()
+
+    staging = os.path.join(path, STAGING_DIR)
+    df.coalesce(spark.sparkContext.defaultParallelism)\
+        .write.mode("overwrite").parquet(staging)
+
+    # Move the merged files, then remove the segments
+    jpath, fs = get_hadoop_path(path)
+    jstaging, _ = get_hadoop_path(staging)
+    for status in fs.listStatus(jstaging):
+        if status.getPath().getName().endswith(".parquet"):
+            fs.rename(
+                status.getPath(),
+                jpath.suffix("/" + status.getPath().getName()))
+    for f in files:
+        fs.delete(f, False)
+    fs.delete(jstaging, True)
+
+    bloom = BloomFilter.from_capacity(max(2 * nobjects, BLOOM_CAPACITY))
+    ncores = spark.sparkContext.defaultParallelism
+    for row in df.select("objectId").coalesce(ncores).toLocalIterator():
+        bloom.add(row["objectId"])
+    save_bloom_filter(bloom, path)
+    df.unpersist()
+
+    return {"files_before": len(files), "objects": nobjects}
+
+def _write_segment(summary: DataFrame, path: str, batchid: int):
+    """ Write the segment of a micro-batch, replacing the segment written
+    by a previous attempt of the same micro-batch.
+    """
+    staging = os.path.join(path, STAGING_DIR, "batch={}".format(batchid))
+    summary.coalesce(1).write.mode("overwrite").parquet(staging)
+
+    jpath, fs = get_hadoop_path(path)
+    jstaging, _ = get_hadoop_path(staging)
+    target = jpath.suffix("/batch-{:020d}.parquet".format(batchid))
+    for status in fs.listStatus(jstaging):
+        if status.getPath().getName().endswith(".parquet"):
+            fs.delete(target, False)
+            fs.rename(status.getPath(), target)
+    fs.delete(jstaging, True)
+
+def update_object_summary(
+        df: DataFrame, path: str, batchid: int = None,
+        classcol: str = SUMMARY_CLASS_COLUMN, maxsegments: int = 32):
+    """ Update the summary and its Bloom filter with (static) alerts.
+    Meant to be called on each micro-batch with foreachBatch.
+
+    With the ID of the micro-batch, the update is idempotent: a micro-batch
+    already committed (see load_last_batch) is skipped, and the segment of
+    a micro-batch is named after it, such that replaying a micro-batch
+    after a failure does not count its alerts twice.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Static DataFrame of alerts.
+    path: str
+        Path of the summary.
+    batchid: int, optional
+        ID of the micro-batch. Default is None, that is the segment is
+        appended.
+    classcol: str, optional
+        Column with the class of the alerts. Default is
+        SUMMARY_CLASS_COLUMN.
+    maxsegments: int, optional
+        The segments are merged when there are more than `maxsegments`.
+        Default is 32.
+
+    Examples
+    ----------
+    >>> path = "archive/objects_test"
+    >>> update_object_summary(df_alerts_sample, path)
+    >>> "ZTF19b" in load_bloom_filter(path)
+    True
+
+    Replayed micro-batches are counted once
+    >>> path = "archive/objects_batch_test"
+    >>> update_object_summary(df_alerts_sample, path, 0)
+    >>> update_object_summary(df_alerts_sample, path, 0)
+    >>> load_last_batch(path)
+    0
+    >>> load_object_summary(path).filter("objectId = 'ZTF19a'").first().ndet
+    2
+    >>> import shutil
+    >>> shutil.rmtree(path)
+    """
+    if batchid is not None and batchid <= load_last_batch(path):
+        return
+
+    summary = summarize_alerts(df, classcol).cache()
+    if summary.count() == 0:
+        summary.unpersist()
+        return
+    if batchid is None:
+        summary.coalesce(1).write.mode("append").parquet(path)
+    else:
+        _write_segment(summary, path, batchid)
+
+    bloom = load_bloom_filter(path) or \
+        BloomFilter.from_capacity(BLOOM_CAPACITY)
+    for row in summary.select("objectId").collect():
+        bloom.add(row["objectId"])
+    save_bloom_filter(bloom, path)
+    summary.unpersist()
+    if batchid is not None:
+        save_last_batch(batchid, path)
+
+    if len(_summary_files(path)) > maxsegments:
+        compact_object_summary(path)
+
+if __name__ == "__main__":
+    """ Execute the test suite with SparkSession initialised """
+
+    globs = globals()
+    spark = SparkSession.builder.getOrCreate()
+
+    candidate = "struct<jd:double,fid:int,magpsf:float>"
+    globs["df_alerts_sample"] = spark.createDataFrame(
+        [
+            ("ZTF19a", (2458790.5, 1, 17.5), "Unknown"),
+            ("ZTF19a", (2458791.5, 2, 17.), "Star"),
+            ("ZTF19b", (2458790.5, 1, 19.), "Unknown"),
+            ("ZTF19c", (2458790.5, 2, 20.), "Unknown")
+        ],
+        "objectId string, candidate {}, cdsxmatch string".format(candidate))
+
+    # Run the Spark test suite
+    spark_unit_tests(globs)
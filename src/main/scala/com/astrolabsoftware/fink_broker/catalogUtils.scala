@@ -21,6 +21,8 @@ import org.apache.spark.sql.functions._
 import org.apache.spark.sql.DataFrame
 import org.apache.spark.sql.Column
 
+import scala.collection.JavaConverters._
+
 object catalogUtils {
 
   /**
@@ -38,6 +40,55 @@ object catalogUtils {
     BinaryType -> lit(Array[Byte]())
   )
 
+  /**
+    * Flattened columns of a nested column (struct), at any depth of nesting.
+    * Null values of primitive types are replaced by fallbackValues. Fields
+    * without resolver raise an IllegalArgumentException.
+    *
+    * @param dataType : Type of the nested column
+    * @param columnName : The name (path) of the nested column.
+    * @return Flattened columns, named <path with _>_<field>.
+    */
+  def flattenedColumns(dataType: StructType, columnName: String): Seq[Column] = {
+    dataType.fields.toSeq.flatMap { structfield =>
+      val colName = s"$columnName.${structfield.name}"
+      val flattenedName = s"${columnName.replace('.','_')}_${structfield.name}"
+      structfield.dataType match {
+        case dt if fallbackValues.contains(dt) =>
+          Seq(when(isnull(col(colName)), fallbackValues(dt)).otherwise(col(colName)).alias(flattenedName))
+        case st: StructType =>
+          // recursive descent
+          flattenedColumns(st, colName)
+        case dt =>
+          throw new IllegalArgumentException(s"Missing resolver for $colName of type ${dt.simpleString}")
+      }
+    }
+  }
+
+  /**
+    * From nested columns (struct of primitives), create one column per struct element,
+    * in a single projection.
+    *
+    * @param df : Nested Spark DataFrame
+    * @param columnNames : The names of the (top-level) columns to flatten.
+    * @return Flatten DataFrame, with the flattened columns after the others.
+    */
+  def flattenStructs(df: DataFrame, columnNames: Seq[String]): DataFrame = {
+    val others = df.columns.filterNot(columnNames.contains).map(c => col(s"`$c`"))
+    val flattened = columnNames.flatMap { columnName =>
+      df.schema(columnName).dataType match {
+        case st: StructType => flattenedColumns(st, columnName)
+        case dt => throw new IllegalArgumentException(s"$columnName is not a struct: ${dt.typeName}")
+      }
+    }
+    df.select(others ++ flattened: _*)
+  }
+
+  /** Java-friendly version of flattenStructs */
+  def flattenStructs(df: DataFrame, columnNames: java.util.List[String]): DataFrame = {
+    flattenStructs(df, columnNames.asScala.toSeq)
+  }
+
   /**
     * From a nested column (struct of primitives), create one column per struct element.
     *
@@ -55,27 +106,8 @@ object catalogUtils {
     * @return Flatten DataFrame
     */
   def flattenStruct(df: DataFrame, columnName: String): DataFrame = {
-    df.select(s"$columnName.*").schema.fields.foldLeft[DataFrame](df)( (d, structfield) => {
-      val name = structfield.name
-      val dataType = structfield.dataType
-      val colName = s"$columnName.$name"
-      val flattenedName = s"${columnName.replace('.','_')}_$name"
-      if (fallbackValues.contains(dataType)) {
-        d.withColumn(
-          flattenedName,
-          when(
-            isnull(col(colName)),
-            fallbackValues(dataType)
-          ).otherwise(col(colName)))
-      } else if (dataType.typeName == "struct") {
-        // recursive decent
-        flattenStruct(d, colName)
-      } else {
-        println(s"missing resolver for structfield type columnName=$colName dataType=${dataType.typeName}")
-        d
-      }
-    })
-  }.drop(s"$columnName")
+    flattenStructs(df, Seq(columnName))
+  }
 
   /**
     * From a nested column (array of struct), create one column per array element.
@@ -97,11 +129,28 @@ object catalogUtils {
     * @return Flatten DataFrame
     */
   def explodeArrayOfStruct(df: DataFrame, columnName: String): DataFrame = {
-    val colnames = df.selectExpr(s"explode($columnName) as $columnName")
-      .select(s"${columnName}.*")
-      .schema
-      .fieldNames
-      .map(name => s"CAST(${columnName}." + name + s" as string) as ${columnName}_" + name)
+    explodeArrayOfStruct(df, columnName, false)
+  }
+
+  /**
+    * From a nested column (array of struct), create one column per array element,
+    * optionally keeping the types of the struct fields (e.g. array<double>
+    * instead of its string representation).
+    *
+    * @param df : Nested Spark DataFrame
+    * @param columnName : The name of the column to flatten.
+    * @param keepTypes : If false, the new columns are cast to string.
+    * @return Flatten DataFrame
+    */
+  def explodeArrayOfStruct(df: DataFrame, columnName: String, keepTypes: Boolean): DataFrame = {
+    val fieldNames = df.schema(columnName).dataType match {
+      case ArrayType(st: StructType, _) => st.fieldNames
+      case dt => throw new IllegalArgumentException(s"$columnName is not an array of struct: ${dt.typeName}")
+    }
+    val colnames = fieldNames.map { name =>
+      if (keepTypes) s"${columnName}.$name as ${columnName}_$name"
+      else s"CAST(${columnName}.$name as string) as ${columnName}_$name"
+    }
 
     // Include all other columns in the final dataframe
     val allColNames = "*" +: colnames
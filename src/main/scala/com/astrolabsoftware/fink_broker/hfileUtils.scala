@@ -0,0 +1,224 @@
+/*
+ * Copyright 2019 AstroLab Software
+ * Author: Julien Peloton
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+package com.astrolabsoftware.fink_broker
+
+import scala.collection.mutable.ArrayBuffer
+
+import org.apache.hadoop.conf.Configuration
+import org.apache.hadoop.fs.Path
+import org.apache.hadoop.hbase.{Cell, CellUtil, HBaseConfiguration, HColumnDescriptor, HTableDescriptor, KeyValue, TableName}
+import org.apache.hadoop.hbase.client.ConnectionFactory
+import org.apache.hadoop.hbase.io.ImmutableBytesWritable
+import org.apache.hadoop.hbase.io.hfile.{CacheConfig, HFile}
+import org.apache.hadoop.hbase.mapreduce.HFileOutputFormat2
+import org.apache.hadoop.hbase.tool.LoadIncrementalHFiles
+import org.apache.hadoop.hbase.util.Bytes
+
+import org.apache.spark.sql.DataFrame
+
+import HBase.{HBaseCatalog, InternalRowPutEncoder, RegionPartitioner}
+
+object hfileUtils {
+
+  /** Key of a cell in the HFiles: (row key, family, qualifier) */
+  type CellKey = (Array[Byte], Array[Byte], Array[Byte])
+
+  /** Order of the cells in the HFiles */
+  implicit val cellKeyOrdering: Ordering[CellKey] = new Ordering[CellKey] {
+    def compare(x: CellKey, y: CellKey): Int = {
+      val row = Bytes.compareTo(x._1, y._1)
+      if (row != 0) {
+        row
+      } else {
+        val family = Bytes.compareTo(x._2, y._2)
+        if (family != 0) family else Bytes.compareTo(x._3, y._3)
+      }
+    }
+  }
+
+  /**
+    * Start keys of the regions of a HBase table.
+    *
+    * @param tableName Name of the table (namespace:name)
+    * @return Start keys, the first one being empty.
+    */
+  def regionStartKeys(tableName: String): Array[Array[Byte]] = {
+    val connection = ConnectionFactory.createConnection(HBaseConfiguration.create())
+    try {
+      val locator = connection.getRegionLocator(TableName.valueOf(tableName))
+      try locator.getStartKeys finally locator.close()
+    } finally connection.close()
+  }
+
+  /**
+    * Create the table of a catalog, pre-split at the given keys, with the
+    * column families of the catalog. Nothing is done if the table exists.
+    *
+    * @param catalog : HBase catalog (shc JSON format)
+    * @param splitKeys : Start keys of the regions (except the first one)
+    */
+  def createTable(catalog: String, splitKeys: Array[Array[Byte]]): Unit = {
+    val hbcatalog = HBaseCatalog(catalog)
+    val connection = ConnectionFactory.createConnection(HBaseConfiguration.create())
+    try {
+      val admin = connection.getAdmin
+      try {
+        val name = TableName.valueOf(hbcatalog.tableName)
+        if (!admin.tableExists(name)) {
+          val descriptor = new HTableDescriptor(name)
+          hbcatalog.families.foreach(cf => descriptor.addFamily(new HColumnDescriptor(cf)))
+          if (splitKeys.isEmpty) admin.createTable(descriptor) else admin.createTable(descriptor, splitKeys)
+        }
+      } finally admin.close()
+    } finally connection.close()
+  }
+
+  /**
+    * HFiles of a directory written by writeHFiles (outputPath/family/file).
+    *
+    * @param outputPath : Directory of the HFiles
+    * @param conf : Hadoop configuration
+    * @return Paths of the HFiles
+    */
+  def hfilePaths(outputPath: String, conf: Configuration): Seq[Path] = {
+    val root = new Path(outputPath)
+    val fs = root.getFileSystem(conf)
+    val families = fs.listStatus(root).filter(s => s.isDirectory && !s.getPath.getName.startsWith("_"))
+    for (family <- families.toSeq; status <- fs.listStatus(family.getPath).toSeq) yield status.getPath
+  }
+
+  /**
+    * Number of cells of the HFiles of a directory, read from their trailers.
+    *
+    * @param outputPath : Directory of the HFiles
+    * @return Number of cells
+    */
+  def countHFileCells(outputPath: String): Long = {
+    val conf = HBaseConfiguration.create()
+    hfilePaths(outputPath, conf).map { path =>
+      val reader = HFile.createReader(path.getFileSystem(conf), path, new CacheConfig(conf), true, conf)
+      try reader.getEntries finally reader.close()
+    }.sum
+  }
+
+  /**
+    * Write the rows of a DataFrame into HFiles ready for bulk load. Cells are
+    * sorted, and partitioned to match the regions of the table: each task
+    * writes one HFile per column family under outputPath/family/.
+    *
+    * The number of cells is read from the HFiles once written (an
+    * accumulator would count the cells of retried tasks twice).
+    *
+    * @param df : DataFrame with the columns of the catalog
+    * @param catalog : HBase catalog (shc JSON format)
+    * @param outputPath : Directory of the HFiles (must not exist)
+    * @param startKeys : Start keys of the regions of the table (the first
+    *   one is empty).
+    * @param timestamp : Timestamp of the cells, in milliseconds
+    * @return Number of cells written
+    */
+  def writeHFiles(
+      df: DataFrame, catalog: String, outputPath: String,
+      startKeys: Array[Array[Byte]], timestamp: Long): Long = {
+    val encoder = new InternalRowPutEncoder(HBaseCatalog(catalog), df.schema)
+
+    val cells = df.queryExecution.toRdd.flatMap { row =>
+      val key = encoder.rowkey(row)
+      if (key == null) {
+        Seq()
+      } else {
+        encoder.cells(row).map { case (family, qualifier, value) =>
+          ((key, family, qualifier), value)
+        }
+      }
+    }
+
+    val sorted = cells
+      .repartitionAndSortWithinPartitions(new RegionPartitioner(startKeys))
+      .map { case ((key, family, qualifier), value) =>
+        (new ImmutableBytesWritable(key), new KeyValue(key, family, qualifier, timestamp, value): Cell)
+      }
+
+    val conf = HBaseConfiguration.create(df.sparkSession.sparkContext.hadoopConfiguration)
+    sorted.saveAsNewAPIHadoopFile(
+      outputPath,
+      classOf[ImmutableBytesWritable],
+      classOf[Cell],
+      classOf[HFileOutputFormat2],
+      conf)
+
+    countHFileCells(outputPath)
+  }
+
+  /**
+    * Bulk load HFiles written by writeHFiles into a HBase table.
+    * Loaded files are moved into the table.
+    *
+    * @param outputPath : Directory of the HFiles
+    * @param tableName : Name of the table (namespace:name)
+    */
+  def bulkLoad(outputPath: String, tableName: String): Unit = {
+    val conf = HBaseConfiguration.create()
+    val connection = ConnectionFactory.createConnection(conf)
+    try {
+      val name = TableName.valueOf(tableName)
+      val admin = connection.getAdmin
+      val table = connection.getTable(name)
+      val locator = connection.getRegionLocator(name)
+      try {
+        new LoadIncrementalHFiles(conf).doBulkLoad(new Path(outputPath), admin, table, locator)
+      } finally {
+        locator.close()
+        table.close()
+        admin.close()
+      }
+    } finally connection.close()
+  }
+
+  /**
+    * Read back the cells of the HFiles of a directory, in order. Meant for
+    * tests and checks of small outputs.
+    *
+    * @param outputPath : Directory of the HFiles (outputPath/family/file)
+    * @return (file, row key, family, qualifier, value) of each cell, values
+    *   being converted to strings with Bytes.toStringBinary.
+    */
+  def readHFiles(outputPath: String): Array[(String, String, String, String, String)] = {
+    val conf = HBaseConfiguration.create()
+    val out = ArrayBuffer[(String, String, String, String, String)]()
+
+    for (path <- hfilePaths(outputPath, conf)) {
+      val reader = HFile.createReader(path.getFileSystem(conf), path, new CacheConfig(conf), true, conf)
+      try {
+        reader.loadFileInfo()
+        val scanner = reader.getScanner(false, false)
+        if (scanner.seekTo()) {
+          do {
+            val cell = scanner.getCell
+            out += ((
+              path.toString,
+              Bytes.toStringBinary(CellUtil.cloneRow(cell)),
+              Bytes.toStringBinary(CellUtil.cloneFamily(cell)),
+              Bytes.toStringBinary(CellUtil.cloneQualifier(cell)),
+              Bytes.toStringBinary(CellUtil.cloneValue(cell))))
+          } while (scanner.next())
+        }
+      } finally reader.close()
+    }
+    out.toArray
+  }
+}
@@ -0,0 +1,550 @@
+/*
+ * Copyright 2019 AstroLab Software
+ * Author: Julien Peloton
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+package HBase
+
+import java.util.{ArrayList => JArrayList, Arrays => JArrays, List => JList}
+import java.util.concurrent.{ConcurrentHashMap, ConcurrentLinkedQueue, ExecutorService, Executors}
+
+import scala.collection.JavaConverters._
+
+import org.apache.hadoop.conf.Configuration
+import org.apache.hadoop.fs.Path
+import org.apache.hadoop.hbase.{HBaseConfiguration, HColumnDescriptor, HTableDescriptor, TableName}
+import org.apache.hadoop.hbase.client.{BufferedMutator, BufferedMutatorParams, Connection, ConnectionFactory, Put}
+import org.apache.hadoop.hbase.util.Bytes
+
+import org.apache.spark.Partitioner
+import org.apache.spark.sql.{DataFrame, SQLContext}
+import org.apache.spark.sql.catalyst.InternalRow
+import org.apache.spark.sql.execution.datasources.hbase.Logging
+import org.apache.spark.sql.execution.streaming.{HDFSMetadataLog, Sink}
+import org.apache.spark.sql.sources.{DataSourceRegister, StreamSinkProvider}
+import org.apache.spark.sql.streaming.OutputMode
+import org.apache.spark.sql.types._
+
+import org.json4s._
+import org.json4s.jackson.JsonMethods.parse
+
+/**
+  * Column of a HBase catalog (same JSON format as shc).
+  *
+  * @param name Name of the DataFrame column
+  * @param cf Column family ("rowkey" for the row key)
+  * @param qualifier Column qualifier
+  */
+case class HBaseColumn(name: String, cf: String, qualifier: String)
+
+/**
+  * HBase catalog, parsed from the JSON catalog used by shc:
+  * {{{
+  *   {"table": {"namespace": "default", "name": "test"},
+  *    "rowkey": "objectId",
+  *    "columns": {
+  *      "objectId": {"cf": "rowkey", "col": "objectId", "type": "string"},
+  *      "candid": {"cf": "i", "col": "candid", "type": "long"}}}
+  * }}}
+  * Only single-column row keys are supported.
+  */
+case class HBaseCatalog(
+    namespace: String, table: String, rowkey: String, columns: Seq[HBaseColumn]) {
+
+  def tableName: String = s"$namespace:$table"
+
+  /** DataFrame column containing the row key */
+  def rowkeyColumn: HBaseColumn = columns.find(c => c.cf == "rowkey" && c.qualifier == rowkey)
+    .getOrElse(throw new IllegalArgumentException(s"No column for the rowkey $rowkey in the catalog"))
+
+  /** Columns other than the row key */
+  def valueColumns: Seq[HBaseColumn] = columns.filter(_.cf != "rowkey")
+
+  def families: Seq[String] = valueColumns.map(_.cf).distinct
+}
+
+object HBaseCatalog {
+  def apply(json: String): HBaseCatalog = {
+    implicit val formats: Formats = DefaultFormats
+    val jvalue = parse(json)
+    val namespace = (jvalue \ "table" \ "namespace").extractOrElse[String]("default")
+    val table = (jvalue \ "table" \ "name").extract[String]
+    val rowkey = (jvalue \ "rowkey").extract[String]
+    if (rowkey.contains(":")) {
+      throw new IllegalArgumentException(s"Composite rowkeys are not supported: $rowkey")
+    }
+    val columns = (jvalue \ "columns") match {
+      case JObject(fields) => fields.map { case (name, spec) =>
+        HBaseColumn(name, (spec \ "cf").extract[String], (spec \ "col").extract[String])
+      }
+      case _ => throw new IllegalArgumentException("Missing columns in the HBase catalog")
+    }
+    HBaseCatalog(namespace, table, rowkey, columns)
+  }
+}
+
+/**
+  * Encode InternalRow into HBase Puts, without conversion to Scala Row.
+  * Values are encoded as shc does (Bytes.toBytes), such that the table can
+  * be read back with shc. Null values are not written.
+  *
+  * @param catalog HBase catalog
+  * @param schema Schema of the rows
+  */
+class InternalRowPutEncoder(catalog: HBaseCatalog, schema: StructType) extends Serializable {
+  import InternalRowPutEncoder._
+
+  private val keyIndex = schema.fieldIndex(catalog.rowkeyColumn.name)
+  private val keyEncoder = encoder(schema(keyIndex).dataType)
+
+  // (index in the row, family, qualifier, encoder) of each value column
+  private val columns = catalog.valueColumns
+    .filter(c => schema.fieldNames.contains(c.name))
+    .map { c =>
+      val index = schema.fieldIndex(c.name)
+      (index, Bytes.toBytes(c.cf), Bytes.toBytes(c.qualifier), encoder(schema(index).dataType))
+    }.toArray
+
+  /** Row key of a row, or null if the row key is null */
+  def rowkey(row: InternalRow): Array[Byte] = {
+    if (row.isNullAt(keyIndex)) null else keyEncoder(row, keyIndex)
+  }
+
+  /** (family, qualifier, value) of the non-null values of a row */
+  def cells(row: InternalRow): Seq[(Array[Byte], Array[Byte], Array[Byte])] = {
+    columns.toSeq.collect { case (index, family, qualifier, enc) if !row.isNullAt(index) =>
+      (family, qualifier, enc(row, index))
+    }
+  }
+
+  /** Put of a row, None if the row key is null or all values are null */
+  def toPut(row: InternalRow): Option[Put] = {
+    val key = rowkey(row)
+    if (key == null) {
+      None
+    } else {
+      val put = new Put(key)
+      cells(row).foreach { case (family, qualifier, value) =>
+        put.addColumn(family, qualifier, value)
+      }
+      if (put.isEmpty) None else Some(put)
+    }
+  }
+
+  /**
+    * Write rows to a target, handing Puts over by groups of `batchSize`.
+    *
+    * @return Number of Puts written
+    */
+  def write(rows: Iterator[InternalRow], target: MutationTarget, batchSize: Int): Long = {
+    val buffer = new JArrayList[Put](batchSize)
+    var count = 0L
+    rows.foreach { row =>
+      toPut(row).foreach { put =>
+        buffer.add(put)
+        count += 1
+        if (buffer.size >= batchSize) {
+          target.mutate(buffer)
+          buffer.clear()
+        }
+      }
+    }
+    if (!buffer.isEmpty) {
+      target.mutate(buffer)
+    }
+    target.flush()
+    count
+  }
+}
+
+object InternalRowPutEncoder {
+  type FieldEncoder = (InternalRow, Int) => Array[Byte]
+
+  /** Encoder of a field to bytes, following the shc encoding */
+  def encoder(dataType: DataType): FieldEncoder = dataType match {
+    case StringType => (row, i) => row.getUTF8String(i).getBytes
+    case BinaryType => (row, i) => row.getBinary(i)
+    case LongType => (row, i) => Bytes.toBytes(row.getLong(i))
+    case IntegerType => (row, i) => Bytes.toBytes(row.getInt(i))
+    case ShortType => (row, i) => Bytes.toBytes(row.getShort(i))
+    case ByteType => (row, i) => Array(row.getByte(i))
+    case DoubleType => (row, i) => Bytes.toBytes(row.getDouble(i))
+    case FloatType => (row, i) => Bytes.toBytes(row.getFloat(i))
+    case BooleanType => (row, i) => Bytes.toBytes(row.getBoolean(i))
+    // shc stores timestamps in milliseconds
+    case TimestampType => (row, i) => Bytes.toBytes(row.getLong(i) / 1000L)
+    case other => throw new IllegalArgumentException(
+      s"Unsupported type ${other.simpleString} for HBase (cast it to string or binary first)")
+  }
+}
+
+/**
+  * Destination of the Puts of a task.
+  */
+trait MutationTarget extends java.io.Closeable {
+
+  /** Start keys of the regions of the table */
+  def regionStartKeys(): Array[Array[Byte]]
+
+  /** Create the table if it does not exist */
+  def createTableIfNotExists(families: Seq[String]): Unit
+
+  /** Buffer Puts (they can be sent before flush) */
+  def mutate(puts: JList[Put]): Unit
+
+  /** Send all buffered Puts */
+  def flush(): Unit
+}
+
+/**
+  * Create MutationTarget on the driver and the executors.
+  */
+trait MutationTargetFactory extends Serializable {
+  def create(): MutationTarget
+}
+
+/**
+  * HBase table, written with a BufferedMutator. The mutator sends the
+  * buffered Puts to the region servers in parallel, with up to `maxThreads`
+  * threads, as soon as `bufferSize` bytes are buffered.
+  *
+  * @param settings HBase settings on top of hbase-site.xml
+  * @param tableName Name of the table (namespace:name)
+  * @param bufferSize Size of the mutation buffer, in bytes
+  * @param maxThreads Number of threads sending the mutations
+  */
+class HBaseMutationTargetFactory(
+    settings: Map[String, String], tableName: String,
+    bufferSize: Long, maxThreads: Int) extends MutationTargetFactory {
+
+  def create(): MutationTarget = new MutationTarget {
+    private val conf: Configuration = HBaseConfiguration.create()
+    settings.foreach { case (k, v) => conf.set(k, v) }
+
+    private val table = TableName.valueOf(tableName)
+    private val connection: Connection = ConnectionFactory.createConnection(conf)
+    private var pool: ExecutorService = _
+    private var mutator: BufferedMutator = _
+
+    def regionStartKeys(): Array[Array[Byte]] = {
+      val locator = connection.getRegionLocator(table)
+      try locator.getStartKeys finally locator.close()
+    }
+
+    def createTableIfNotExists(families: Seq[String]): Unit = {
+      val admin = connection.getAdmin
+      try {
+        if (!admin.tableExists(table)) {
+          val descriptor = new HTableDescriptor(table)
+          families.foreach(cf => descriptor.addFamily(new HColumnDescriptor(cf)))
+          admin.createTable(descriptor)
+        }
+      } finally admin.close()
+    }
+
+    def mutate(puts: JList[Put]): Unit = {
+      if (mutator == null) {
+        pool = Executors.newFixedThreadPool(maxThreads)
+        mutator = connection.getBufferedMutator(
+          new BufferedMutatorParams(table).writeBufferSize(bufferSize).pool(pool))
+      }
+      mutator.mutate(puts)
+    }
+
+    def flush(): Unit = if (mutator != null) mutator.flush()
+
+    def close(): Unit = {
+      try {
+        if (mutator != null) mutator.close()
+      } finally {
+        if (pool != null) pool.shutdown()
+        connection.close()
+      }
+    }
+  }
+}
+
+/**
+  * In-process stand-in for HBase, for tests with a local master: tables are
+  * kept in memory in the JVM of the driver.
+  */
+object InMemoryHBase {
+  type Table = ConcurrentHashMap[String, ConcurrentHashMap[String, Array[Byte]]]
+
+  private val tables = new ConcurrentHashMap[String, Table]()
+  private val splits = new ConcurrentHashMap[String, Array[Array[Byte]]]()
+  private val writers = new ConcurrentHashMap[String, ConcurrentLinkedQueue[Set[Int]]]()
+
+  /** Create a table with regions starting at `splitKeys` */
+  def createTable(name: String, splitKeys: Seq[Array[Byte]] = Seq()): Unit = {
+    tables.putIfAbsent(name, new Table())
+    splits.put(name, (Array[Byte]() +: splitKeys).toArray)
+  }
+
+  def exists(name: String): Boolean = tables.containsKey(name)
+
+  def dropTable(name: String): Unit = {
+    tables.remove(name)
+    splits.remove(name)
+    writers.remove(name)
+  }
+
+  def table(name: String): Table = Option(tables.get(name))
+    .getOrElse(throw new IllegalArgumentException(s"Table $name does not exist"))
+
+  def regionStartKeys(name: String): Array[Array[Byte]] = splits.getOrDefault(name, Array(Array[Byte]()))
+
+  /** Number of rows of a table */
+  def count(name: String): Long = table(name).size.toLong
+
+  /** Value of a cell */
+  def get(name: String, rowkey: String, family: String, qualifier: String): Option[Array[Byte]] = {
+    Option(table(name).get(rowkey)).flatMap(row => Option(row.get(s"$family:$qualifier")))
+  }
+
+  /** Record the regions written by a target (e.g. a task) */
+  def addWriter(name: String, regions: Set[Int]): Unit = {
+    writers.computeIfAbsent(name, new java.util.function.Function[String, ConcurrentLinkedQueue[Set[Int]]] {
+      def apply(k: String) = new ConcurrentLinkedQueue[Set[Int]]()
+    }).add(regions)
+  }
+
+  /** Regions written by each target of a table, in order */
+  def writerRegions(name: String): Seq[Set[Int]] = {
+    Option(writers.get(name)).map(_.asScala.toSeq).getOrElse(Seq())
+  }
+}
+
+/**
+  * Targets writing to a table of InMemoryHBase. Each target records the
+  * regions it wrote to when closed (see InMemoryHBase.writerRegions).
+  */
+class InMemoryMutationTargetFactory(tableName: String) extends MutationTargetFactory {
+  def create(): MutationTarget = new MutationTarget {
+    private val buffer = new JArrayList[Put]()
+    private var regions = Set[Int]()
+
+    def regionStartKeys(): Array[Array[Byte]] = InMemoryHBase.regionStartKeys(tableName)
+
+    def createTableIfNotExists(families: Seq[String]): Unit = {
+      if (!InMemoryHBase.exists(tableName)) {
+        InMemoryHBase.createTable(tableName)
+      }
+    }
+
+    def mutate(puts: JList[Put]): Unit = buffer.addAll(puts)
+
+    def flush(): Unit = {
+      val table = InMemoryHBase.table(tableName)
+      val partitioner = new RegionPartitioner(regionStartKeys())
+      buffer.asScala.foreach { put =>
+        regions += partitioner.getPartition(put.getRow)
+        val row = table.computeIfAbsent(
+          Bytes.toString(put.getRow),
+          new java.util.function.Function[String, ConcurrentHashMap[String, Array[Byte]]] {
+            def apply(k: String) = new ConcurrentHashMap[String, Array[Byte]]()
+          })
+        put.getFamilyCellMap.asScala.foreach { case (_, cells) =>
+          cells.asScala.foreach { cell =>
+            val family = Bytes.toString(cell.getFamilyArray, cell.getFamilyOffset, cell.getFamilyLength)
+            val qualifier = Bytes.toString(cell.getQualifierArray, cell.getQualifierOffset, cell.getQualifierLength)
+            val value = JArrays.copyOfRange(cell.getValueArray, cell.getValueOffset, cell.getValueOffset + cell.getValueLength)
+            row.put(s"$family:$qualifier", value)
+          }
+        }
+      }
+      buffer.clear()
+    }
+
+    def close(): Unit = {
+      flush()
+      if (regions.nonEmpty) InMemoryHBase.addWriter(tableName, regions)
+    }
+  }
+}
+
+/**
+  * Partition rows by region, given the start keys of the regions, such that
+  * each task writes to a single region.
+  *
+  * @param startKeys Sorted start keys of the regions (the first one is empty)
+  */
+class RegionPartitioner(startKeys: Array[Array[Byte]]) extends Partitioner {
+  override def numPartitions: Int = math.max(startKeys.length, 1)
+
+  override def getPartition(key: Any): Int = {
+    // Row key, or (row key, family, qualifier) for sorted cells
+    val rowkey = key match {
+      case (row: Array[Byte], _, _) => row
+      case row: Array[Byte] => row
+    }
+    // Last region whose start key is lower than or equal to the row key
+    var low = 0
+    var high = startKeys.length - 1
+    while (low < high) {
+      val mid = (low + high + 1) / 2
+      if (Bytes.compareTo(startKeys(mid), rowkey) <= 0) low = mid else high = mid - 1
+    }
+    low
+  }
+}
+
+/**
+  * Commit of a micro-batch in the HBase table.
+  */
+case class HBaseSinkCommit(batchId: Long, puts: Long)
+
+/**
+  * Streaming sink writing micro-batches to a HBase table with batched Puts,
+  * encoded directly from the InternalRows of the micro-batch.
+  *
+  * Options (see HBaseBatchedSinkProvider):
+  *  - hbase.catalog: HBase catalog (shc JSON format)
+  *  - hbase.bufferSize: size of the mutation buffer, in bytes (default 8MB)
+  *  - hbase.batchSize: number of Puts handed over at once (default 1000)
+  *  - hbase.maxThreads: threads sending the mutations per task (default 8)
+  *  - hbase.partitionByRegion: shuffle the rows by region such that each task
+  *    writes to a single region (default true, skipped for a single region)
+  *  - hbase.target: hbase (default), or memory for the in-process InMemoryHBase
+  *  - other hbase.* options are passed to the HBase configuration
+  *    (e.g. hbase.zookeeper.quorum).
+  *
+  * Micro-batches are committed in a log under the checkpoint location, such
+  * that a batch already written is skipped on restart. A batch interrupted
+  * before its commit is written again: Puts are idempotent (same cells with
+  * the same values).
+  */
+class HBaseBatchedStreamSink(sqlContext: SQLContext,
+                             parameters: Map[String, String],
+                             partitionColumns: Seq[String],
+                             outputMode: OutputMode)
+    extends Sink
+    with Logging {
+  import HBaseBatchedStreamSink._
+
+  private val catalog = HBaseCatalog(parameters.getOrElse(CATALOG,
+    throw new IllegalArgumentException(s"Option $CATALOG is required")))
+
+  private val bufferSize = parameters.getOrElse(BUFFER_SIZE, "8388608").toLong
+  private val batchSize = parameters.getOrElse(BATCH_SIZE, "1000").toInt
+  private val maxThreads = parameters.getOrElse(MAX_THREADS, "8").toInt
+  private val partitionByRegion = parameters.getOrElse(PARTITION_BY_REGION, "true").toBoolean
+
+  private val targetFactory: MutationTargetFactory = parameters.getOrElse(TARGET, "hbase") match {
+    case "memory" => new InMemoryMutationTargetFactory(catalog.tableName)
+    case "hbase" =>
+      val settings = parameters.filterKeys(k => k.startsWith("hbase.") && !OPTIONS.contains(k))
+      new HBaseMutationTargetFactory(settings.map(identity), catalog.tableName, bufferSize, maxThreads)
+    case other => throw new IllegalArgumentException(s"Unknown HBase target $other")
+  }
+
+  private val commitLog = parameters.get("checkpointLocation").map { location =>
+    new HDFSMetadataLog[HBaseSinkCommit](
+      sqlContext.sparkSession, new Path(location, "hbaseSink").toString)
+  }
+  if (commitLog.isEmpty) {
+    logWarning("No checkpointLocation option: committed batches are not tracked across restarts")
+  }
+
+  @volatile private var latestBatchId = commitLog.flatMap(_.getLatest()).map(_._1).getOrElse(-1L)
+
+  private var tableChecked = false
+
+  /**
+    * Write the rows of a micro-batch to the HBase table, skipping batchId
+    * already committed.
+    *
+    * @param batchId Spark Structured Streaming batch index.
+    * @param data Input DataFrame
+    */
+  override def addBatch(batchId: Long, data: DataFrame): Unit = synchronized {
+    if (batchId <= latestBatchId) {
+      logInfo(s"Skipping already committed batch $batchId")
+    } else {
+      // use local variables to make sure the closures do not capture the sink
+      val encoder = new InternalRowPutEncoder(catalog, data.schema)
+      val factory = targetFactory
+      val size = batchSize
+
+      // The table is created (if needed) and its regions listed on the driver
+      val target = factory.create()
+      val startKeys = try {
+        if (!tableChecked) {
+          target.createTableIfNotExists(catalog.families)
+          tableChecked = true
+        }
+        if (partitionByRegion) target.regionStartKeys() else Array[Array[Byte]]()
+      } finally target.close()
+
+      val rows = data.queryExecution.toRdd
+      val partitioned = if (startKeys.length > 1) {
+        // Rows are reused by the iterators, hence the copy
+        rows.map(row => (encoder.rowkey(row), row.copy()))
+          .filter(_._1 != null)
+          .partitionBy(new RegionPartitioner(startKeys))
+          .values
+      } else {
+        rows
+      }
+
+      val puts = partitioned.mapPartitions { iterator =>
+        val target = factory.create()
+        val count = try encoder.write(iterator, target, size) finally target.close()
+        Iterator(count)
+      }.collect().sum
+
+      commitLog.foreach(_.add(batchId, HBaseSinkCommit(batchId, puts)))
+      latestBatchId = batchId
+      logInfo(s"Batch $batchId: $puts Puts written to ${catalog.tableName}")
+    }
+  }
+}
+
+object HBaseBatchedStreamSink {
+  val CATALOG = "hbase.catalog"
+  val BUFFER_SIZE = "hbase.bufferSize"
+  val BATCH_SIZE = "hbase.batchSize"
+  val MAX_THREADS = "hbase.maxThreads"
+  val PARTITION_BY_REGION = "hbase.partitionByRegion"
+  val TARGET = "hbase.target"
+
+  val OPTIONS = Set(CATALOG, BUFFER_SIZE, BATCH_SIZE, MAX_THREADS, PARTITION_BY_REGION, TARGET)
+}
+
+/**
+  * Add a batched sink in Spark Structured Streaming to HBase table.
+  *
+  * {{{
+  *   inputDF.
+  *    writeStream.
+  *    format("HBase.HBaseBatchedSinkProvider").
+  *    option("checkpointLocation", checkPointProdPath).
+  *    option("hbase.catalog", catalog).
+  *    option("hbase.bufferSize", 8 * 1024 * 1024).
+  *    trigger(Trigger.ProcessingTime(30.seconds)).
+  *    start
+  * }}}
+  */
+class HBaseBatchedSinkProvider
+    extends StreamSinkProvider
+    with DataSourceRegister {
+  def createSink(sqlContext: SQLContext,
+                 parameters: Map[String, String],
+                 partitionColumns: Seq[String],
+                 outputMode: OutputMode): Sink = {
+    new HBaseBatchedStreamSink(sqlContext, parameters, partitionColumns, outputMode)
+  }
+
+  def shortName(): String = "hbase-batched"
+}
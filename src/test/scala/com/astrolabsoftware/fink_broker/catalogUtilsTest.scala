@@ -0,0 +1,93 @@
+/*
+ * Copyright 2019 AstroLab Software
+ * Author: Julien Peloton
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+package com.astrolabsoftware.fink_broker
+
+import org.apache.spark.sql.{Row, SparkSession}
+import org.apache.spark.sql.types._
+
+import org.scalatest.{BeforeAndAfterAll, FunSuite}
+
+import scala.collection.JavaConverters._
+
+/**
+  * Test class for the catalogUtils object.
+  */
+class catalogUtilsTest extends FunSuite with BeforeAndAfterAll {
+
+  private val spark = SparkSession.builder()
+    .master("local[2]")
+    .appName("catalogUtilsTest")
+    .getOrCreate()
+
+  override def afterAll(): Unit = {
+    spark.stop()
+  }
+
+  private val subType = StructType(Seq(
+    StructField("name", StringType),
+    StructField("n", IntegerType)))
+
+  private val candidateType = StructType(Seq(
+    StructField("jd", DoubleType),
+    StructField("fid", IntegerType),
+    StructField("sub", subType)))
+
+  private val prvType = ArrayType(StructType(Seq(
+    StructField("jd", DoubleType),
+    StructField("fid", IntegerType))))
+
+  private val schema = StructType(Seq(
+    StructField("candid", LongType),
+    StructField("candidate", candidateType),
+    StructField("prv", prvType)))
+
+  private def alerts = spark.createDataFrame(
+    Seq(Row(1L, Row(2458788.5, null, Row("a", 3)), Seq(Row(2458787.5, 1), Row(2458786.5, 2)))).asJava,
+    schema)
+
+  test("flattenStructs flattens nested structs, and fills null values") {
+    val df = catalogUtils.flattenStructs(alerts, Seq("candidate"))
+    assert(df.columns.toSeq == Seq(
+      "candid", "prv", "candidate_jd", "candidate_fid", "candidate_sub_name", "candidate_sub_n"))
+    val row = df.drop("prv").first()
+    assert(row == Row(1L, 2458788.5, 0, "a", 3))
+  }
+
+  test("flattenStruct is flattenStructs of a single column") {
+    val df = catalogUtils.flattenStruct(alerts, "candidate")
+    assert(df.columns.toSeq == catalogUtils.flattenStructs(alerts, Seq("candidate")).columns.toSeq)
+  }
+
+  test("flattenStructs rejects fields without resolver and non-struct columns") {
+    intercept[IllegalArgumentException] {
+      catalogUtils.flattenStructs(alerts.selectExpr("struct(prv) as s"), Seq("s"))
+    }
+    intercept[IllegalArgumentException] {
+      catalogUtils.flattenStructs(alerts, Seq("candid"))
+    }
+  }
+
+  test("explodeArrayOfStruct casts the fields to string, or keeps their types") {
+    val df = catalogUtils.explodeArrayOfStruct(alerts, "prv")
+    assert(df.columns.toSeq == Seq("candid", "candidate", "prv_jd", "prv_fid"))
+    assert(df.schema("prv_fid").dataType == StringType)
+
+    val typed = catalogUtils.explodeArrayOfStruct(alerts, "prv", true)
+    assert(typed.schema("prv_fid").dataType == ArrayType(IntegerType))
+    assert(typed.first().getAs[Seq[Int]]("prv_fid") == Seq(1, 2))
+  }
+}
@@ -0,0 +1,91 @@
+/*
+ * Copyright 2019 AstroLab Software
+ * Author: Julien Peloton
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+package com.astrolabsoftware.fink_broker
+
+import java.nio.file.Files
+
+import org.apache.hadoop.hbase.util.Bytes
+
+import org.apache.spark.sql.SparkSession
+
+import org.scalatest.{BeforeAndAfterAll, FunSuite}
+
+/**
+  * Test class for the hfileUtils object: HFiles are written and read back,
+  * without HBase.
+  */
+class hfileUtilsTest extends FunSuite with BeforeAndAfterAll {
+
+  private val spark = SparkSession.builder()
+    .master("local[2]")
+    .appName("hfileUtilsTest")
+    .getOrCreate()
+
+  import spark.implicits._
+
+  override def afterAll(): Unit = {
+    spark.stop()
+  }
+
+  private val catalog = """
+    |{"table": {"namespace": "default", "name": "test"},
+    | "rowkey": "objectId",
+    | "columns": {
+    |   "objectId": {"cf": "rowkey", "col": "objectId", "type": "string"},
+    |   "magpsf": {"cf": "i", "col": "magpsf", "type": "double"},
+    |   "fid": {"cf": "d", "col": "fid", "type": "int"}}}""".stripMargin
+
+  // Rows in a random order, with a null value (not written)
+  private def alerts = Seq(
+    ("ZTF19e", Some(19.5), 2), ("ZTF19a", Some(17.5), 1), ("ZTF19d", None, 1),
+    ("ZTF19b", Some(18.0), 2), ("ZTF19c", Some(18.5), 1)
+  ).toDF("objectId", "magpsf", "fid").repartition(3)
+
+  private def outputPath: String = Files.createTempDirectory("hfiles").resolve("out").toString
+
+  test("writeHFiles writes sorted cells, one HFile per region and family") {
+    val startKeys = Array(Array[Byte](), Bytes.toBytes("ZTF19c"))
+    val path = outputPath
+    val ncells = hfileUtils.writeHFiles(alerts, catalog, path, startKeys, 1000L)
+
+    // 5 fid and 4 magpsf
+    assert(ncells == 9)
+    assert(hfileUtils.countHFileCells(path) == 9)
+
+    val cells = hfileUtils.readHFiles(path)
+    assert(cells.length == 9)
+
+    cells.groupBy(_._1).values.foreach { file =>
+      // A single family and region per file, rows sorted
+      assert(file.map(_._3).distinct.length == 1)
+      assert(file.map(_._2 >= "ZTF19c").distinct.length == 1)
+      assert(file.map(_._2).toSeq == file.map(_._2).toSeq.sorted)
+    }
+
+    // Values round trip with the shc encoding
+    val magpsf = cells.filter(c => c._2 == "ZTF19a" && c._4 == "magpsf").map(_._5)
+    assert(magpsf.toSeq == Seq(Bytes.toStringBinary(Bytes.toBytes(17.5))))
+    assert(!cells.exists(c => c._2 == "ZTF19d" && c._4 == "magpsf"))
+  }
+
+  test("writeHFiles counts the cells written, not the rows") {
+    val path = outputPath
+    val ncells = hfileUtils.writeHFiles(alerts.filter("fid = 1"), catalog, path, Array(Array[Byte]()), 1000L)
+    assert(ncells == 5)
+    assert(hfileUtils.readHFiles(path).length == 5)
+  }
+}
@@ -0,0 +1,127 @@
+/*
+ * Copyright 2019 AstroLab Software
+ * Author: Julien Peloton
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+package HBase
+
+import java.nio.file.Files
+
+import org.apache.hadoop.hbase.util.Bytes
+
+import org.apache.spark.sql.{DataFrame, SparkSession}
+import org.apache.spark.sql.streaming.OutputMode
+
+import org.scalatest.{BeforeAndAfterAll, BeforeAndAfterEach, FunSuite}
+
+/**
+  * Test class for the batched HBase sink, written to InMemoryHBase.
+  */
+class HBaseBatchedSinkTest extends FunSuite with BeforeAndAfterAll with BeforeAndAfterEach {
+
+  private val spark = SparkSession.builder()
+    .master("local[4]")
+    .appName("HBaseBatchedSinkTest")
+    .getOrCreate()
+
+  import spark.implicits._
+
+  private val tableName = "default:test"
+
+  private val catalog = """
+    |{"table": {"namespace": "default", "name": "test"},
+    | "rowkey": "objectId",
+    | "columns": {
+    |   "objectId": {"cf": "rowkey", "col": "objectId", "type": "string"},
+    |   "magpsf": {"cf": "i", "col": "magpsf", "type": "double"},
+    |   "fid": {"cf": "i", "col": "fid", "type": "int"}}}""".stripMargin
+
+  override def afterAll(): Unit = {
+    spark.stop()
+  }
+
+  override def afterEach(): Unit = {
+    InMemoryHBase.dropTable(tableName)
+  }
+
+  private def alerts(magpsf: Double, n: Int = 26): DataFrame = {
+    ('a' until ('a' + n).toChar).map(c => (s"ZTF19$c", magpsf, 1)).toDF("objectId", "magpsf", "fid")
+      .repartition(4)
+  }
+
+  private def sink(checkpoint: String, options: (String, String)*): HBaseBatchedStreamSink = {
+    val parameters = Map(
+      "hbase.catalog" -> catalog,
+      "hbase.target" -> "memory",
+      "hbase.batchSize" -> "3",
+      "checkpointLocation" -> checkpoint) ++ options
+    new HBaseBatchedStreamSink(spark.sqlContext, parameters, Seq(), OutputMode.Append())
+  }
+
+  private def magpsf(rowkey: String): Double = {
+    Bytes.toDouble(InMemoryHBase.get(tableName, rowkey, "i", "magpsf").get)
+  }
+
+  test("RegionPartitioner finds the region of row keys and cells") {
+    val partitioner = new RegionPartitioner(Array(Array[Byte](), Bytes.toBytes("b"), Bytes.toBytes("d")))
+    assert(partitioner.numPartitions == 3)
+    assert(partitioner.getPartition(Bytes.toBytes("a")) == 0)
+    assert(partitioner.getPartition(Bytes.toBytes("b")) == 1)
+    assert(partitioner.getPartition(Bytes.toBytes("c")) == 1)
+    assert(partitioner.getPartition((Bytes.toBytes("d"), Bytes.toBytes("i"), Bytes.toBytes("x"))) == 2)
+    assert(new RegionPartitioner(Array()).numPartitions == 1)
+  }
+
+  test("Batches are written once: a replayed batchId is skipped") {
+    val checkpoint = Files.createTempDirectory("hbaseSink").toString
+
+    val first = sink(checkpoint)
+    first.addBatch(0, alerts(17.5))
+    assert(InMemoryHBase.count(tableName) == 26)
+    assert(magpsf("ZTF19a") == 17.5)
+
+    // Replay of the same batch (e.g. restart before the query commit)
+    first.addBatch(0, alerts(18.5))
+    assert(magpsf("ZTF19a") == 17.5)
+
+    // The commits survive a restart of the sink
+    val restarted = sink(checkpoint)
+    restarted.addBatch(0, alerts(18.5))
+    assert(magpsf("ZTF19a") == 17.5)
+    restarted.addBatch(1, alerts(19.5))
+    assert(magpsf("ZTF19a") == 19.5)
+    assert(InMemoryHBase.count(tableName) == 26)
+  }
+
+  test("Rows are partitioned by region, each task writing to a single region") {
+    InMemoryHBase.createTable(tableName, Seq("ZTF19h", "ZTF19p").map(Bytes.toBytes))
+    val checkpoint = Files.createTempDirectory("hbaseSink").toString
+
+    sink(checkpoint).addBatch(0, alerts(17.5))
+    assert(InMemoryHBase.count(tableName) == 26)
+
+    val writers = InMemoryHBase.writerRegions(tableName)
+    assert(writers.forall(_.size == 1))
+    assert(writers.flatten.toSet == Set(0, 1, 2))
+  }
+
+  test("Without partitioning, tasks write to several regions") {
+    InMemoryHBase.createTable(tableName, Seq("ZTF19h", "ZTF19p").map(Bytes.toBytes))
+    val checkpoint = Files.createTempDirectory("hbaseSink").toString
+
+    sink(checkpoint, "hbase.partitionByRegion" -> "false").addBatch(0, alerts(17.5))
+    assert(InMemoryHBase.count(tableName) == 26)
+    assert(InMemoryHBase.writerRegions(tableName).exists(_.size > 1))
+  }
+}